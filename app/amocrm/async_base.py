@@ -0,0 +1,267 @@
+from .base import AmoCRM
+from .exceptions import (UnexpectedResponseCustomException,
+                         BadResponseCustomException,
+                         NotAuthorizedCustomException,
+                         TooManyRequestsCustomException)
+from .http_pool import get_async_http_session
+from .tokens import RefreshLock, save_token_expires_at
+from .retry import RETRY_STATUS_CODES, can_retry, get_retry_delay
+from app.logger import logger
+
+import aiohttp
+import asyncio
+import json
+import time
+from functools import partial
+from typing import AsyncGenerator, List, Mapping, Tuple, Union
+
+
+class AsyncResponse:
+    """Прочитанный ответ aiohttp с тем же интерфейсом, что нужен исключениям из requests.Response"""
+
+    def __init__(self, url: str, status_code: int, headers: Mapping[str, str], text: str) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self) -> dict:
+        return json.loads(self.text)
+
+
+def make_query_params(data: Union[dict, None]) -> List[Tuple[str, str]]:
+    """Развернуть параметры в список пар, списки -> повторяющиеся ключи, как в requests"""
+
+    params = []
+    for key, value in (data or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        params.extend((key, str(item)) for item in values)
+    return params
+
+
+class AsyncAmoCRM(AmoCRM):
+    """
+    Асинхронный клиент AmoCRM API с тем же интерфейсом, что и AmoCRM: все методы
+    с запросами - корутины. Страницы get_many запрашиваются параллельно в пределах
+    общего лимита. Работает с менеджерами из async_managers.py
+    """
+
+    is_async = True
+
+    async def authorize(self, grant_type: str, token: str) -> None:
+        """
+        Пройти авторизацию с указанным grant_type,
+        поддерживаются refresh_token и authorization_code
+        """
+
+        if grant_type == "refresh_token":
+            token_field = grant_type
+        elif grant_type == "authorization_code":
+            token_field = "code"
+        else:
+            raise ValueError(f"Invalid grant type `grant_type={grant_type}`")
+        data = {
+            "client_id": self._client_id,
+            "client_secret": self._client_secret,
+            "redirect_uri": self._redirect_url or self.url,
+            "grant_type": grant_type,
+            token_field: token,
+        }
+        result = await self.make_request(
+            "post", "oauth2/access_token", data, is_auth=True)
+
+        self._access_token = result["access_token"]
+        self._refresh_token = result["refresh_token"]
+        self._expires_at = time.time() + int(result.get("expires_in", 86400))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, save_token_expires_at, self._client_id, self._expires_at)
+
+        if self._on_auth is not None:
+            # Обработчик работает с базой синхронно, поэтому уносим его из event loop
+            await loop.run_in_executor(None, partial(
+                self._on_auth, self._client_id, self._access_token,
+                self._refresh_token, instance=self))
+
+    async def refresh_tokens(self, stale_access_token: str) -> None:
+        """
+        Обновить токены один раз на интеграцию, см. AmoCRM.refresh_tokens.
+        Блокировка и чтение хранилища синхронные и выполняются вне event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        lock = RefreshLock(self._client_id)
+        await loop.run_in_executor(None, lock.acquire)
+        try:
+            if self._access_token != stale_access_token:
+                return
+            if await loop.run_in_executor(None, self.load_tokens, stale_access_token):
+                return
+            try:
+                await self.authorize("refresh_token", self._refresh_token)
+            except (UnexpectedResponseCustomException, BadResponseCustomException):
+                await self.authorize("authorization_code", self._auth_code)
+        finally:
+            lock.release()
+
+    async def make_request(
+        self, method: str, path: str, data: Union[dict, List[dict]] = None, is_auth: bool = False
+    ) -> dict:
+        """Сделать запрос к API amoCRM"""
+
+        if not is_auth and self.token_expires_soon():
+            await self.refresh_tokens(self._access_token)
+
+        access_token = self._access_token
+        kwargs = {"headers": {"authorization": f"Bearer {access_token}"}}
+
+        if method.lower() == "get":
+            kwargs["params"] = make_query_params(data)
+        elif method.lower() == "post":
+            kwargs["json"] = data
+        else:
+            kwargs["data"] = data
+            kwargs["headers"]["content-type"] = "application/json"
+
+        response = await self.send(method, path, is_auth, **kwargs)
+        if not is_auth and response.status_code == 401:
+            await self.refresh_tokens(access_token)
+            return await self.make_request(method, path, data)
+
+        if response.status_code == 401:
+            raise NotAuthorizedCustomException(response)
+        elif response.status_code == 400:
+            raise BadResponseCustomException(response)
+        elif response.status_code == 429:
+            raise TooManyRequestsCustomException(response)
+        elif response.status_code >= 300:
+            raise UnexpectedResponseCustomException(response)
+        if response.status_code == 204:
+            return {}
+        result = response.json()
+        logger.info(f"Response: {response.status_code} {result}")
+        return result
+
+    async def send(self, method: str, path: str, is_auth: bool = False, **kwargs) -> AsyncResponse:
+        """
+        Отправить запрос в рамках лимита. Ответы 429 и 5xx, а также обрывы соединения
+        повторяются с экспоненциальной задержкой с учетом Retry-After, если это
+        безопасно для метода (см. can_retry)
+        """
+
+        max_retries = self.settings.amocrm_max_retries
+        session = get_async_http_session()
+        attempt = 0
+        while True:
+            await self._rate_limiter.acquire_async(self.priority)
+            self.stats.add_request()
+            try:
+                async with session.request(method, f"{self.url}/{path}", **kwargs) as raw:
+                    response = AsyncResponse(str(raw.url), raw.status, raw.headers, await raw.text())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= max_retries or not can_retry(
+                        method, sent=not isinstance(e, aiohttp.ClientConnectorError), is_auth=is_auth):
+                    raise
+                status_code, headers, reason = None, None, repr(e)
+            else:
+                if (response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries
+                        or not can_retry(method, response.status_code, is_auth=is_auth)):
+                    self.stats.last_call_retries = attempt
+                    return response
+                status_code, headers, reason = response.status_code, response.headers, response.text
+
+            delay = get_retry_delay(attempt, headers)
+            self.stats.add_retry(status_code, delay)
+            logger.warning(
+                f"Retry {attempt + 1}/{max_retries} {method} {path} in {delay:.2f}s: {status_code} {reason}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_page(self, path: str, params: dict, page: int, limit: int) -> dict:
+        """Получить одну страницу списка"""
+
+        page_params = dict(params)
+        page_params.update({"page": page, "limit": limit})
+        return await self.make_request("get", path, page_params)
+
+    async def get_pages(
+        self, entity: str, path: str, params: dict = None, limit: int = 50, start_page: int = 1,
+        step: int = 1
+    ) -> AsyncGenerator[Tuple[int, List[dict]], None]:
+        """
+        Получить сущности постранично, см. AmoCRM.get_pages. Страницы идут по порядку
+        одна за другой: по ним сдвигаются чекпоинты и делятся шарды
+        """
+
+        page = start_page
+        while True:
+            result = await self.get_page(path, params or {}, page, limit)
+            if not result:
+                return
+            yield page, result["_embedded"][entity]
+            if "next" not in result["_links"]:
+                return
+            page += step
+
+    async def get_many(
+        self, entity: str, path: str, params: dict = None, limit: int = 50, start_page: int = 1
+    ) -> AsyncGenerator[dict, None]:
+        """
+        Получить все сущности в виде асинхронного генератора. Первая страница
+        запрашивается одна: короткий список стоит одного запроса. Дальше, пока есть
+        _links.next, страницы запрашиваются окнами, которые растут вдвое до
+        amocrm_concurrency. Если amoCRM вернул _page_count, окна не выходят за него
+        """
+
+        params = params or {}
+        concurrency = self.settings.amocrm_concurrency
+        result = await self.get_page(path, params, start_page, limit)
+        if not result:
+            return
+        for item in result["_embedded"][entity]:
+            yield item
+        page_count = result.get("_page_count")
+        page = start_page + 1
+        window = 1
+        while "next" in result["_links"]:
+            window = min(window * 2, concurrency)
+            last = page + window if page_count is None else min(page + window, page_count + 1)
+            if last <= page:
+                return
+            results = await asyncio.gather(
+                *(self.get_page(path, params, number, limit) for number in range(page, last)))
+            for result in results:
+                if not result:
+                    return
+                for item in result["_embedded"][entity]:
+                    yield item
+                if "next" not in result["_links"]:
+                    return
+            page = last
+
+    async def create_hook(self) -> Union[dict, None]:
+        """Создать хук на изменение сделки"""
+
+        webhook_endpoint = self.settings.app_host + "settings/handle-hook"
+
+        webhook_post_data = {
+            "destination": webhook_endpoint,
+            "settings": ["restore_lead", "add_lead", "status_lead", "delete_lead"]
+        }
+
+        params = {
+            "filter[destination]": webhook_endpoint
+        }
+
+        current_hooks = await self.make_request(
+            "get", "api/v4/webhooks", data=params)
+
+        if webhook_endpoint not in current_hooks:
+            return await self.make_request("post", "api/v4/webhooks",
+                                           data=webhook_post_data)
+
+    async def delete_hook(self) -> None:
+        """Удалить хук на изменение сделки"""
+
+        webhook_endpoint = self.settings.app_host + "settings/handle-hook"
+        await self.make_request("delete", "api/v4/webhooks",
+                                {"destination": webhook_endpoint})
@@ -0,0 +1,320 @@
+from app.amocrm.async_base import AsyncAmoCRM
+from app.settings.services import get_stage_ids
+from .identity_map import IdentityMap
+from .managers import EVENTS_LIMIT, ContactManager, CompanyManager, LeadManager
+from .records import EntityRecord, LeadRecord
+from .helpers import (classify_success_and_active_leads,
+                      get_embedded_leads,
+                      make_patch_request_data,
+                      make_many_patch_request_data,
+                      get_fields_from_many,
+                      get_value_and_label_from_list,
+                      make_success_and_active_filters,
+                      split_custom_fields,
+                      make_etag,
+                      chunked)
+from .cache import TTLCache
+from app.app_settings import get_settings
+
+import asyncio
+import json
+from typing import AsyncGenerator, Iterable, List, Tuple
+from sqlmodel import Session
+
+
+async def collect(generator: AsyncGenerator) -> list:
+    """Собрать асинхронный генератор в список"""
+
+    return [item async for item in generator]
+
+
+# Кастомные поля по аккаунту: (данные, etag)
+custom_fields_cache = TTLCache(get_settings().custom_fields_cache_ttl)
+
+
+class AsyncEntityMixin:
+    """
+    Запросы контактов и компаний через асинхронный клиент. Разбор ответов, identity map
+    и поля сделок - от синхронных менеджеров, здесь только методы с запросами
+    """
+
+    is_async = True
+    # Тип сущностей: contacts | companies
+    entity: str
+
+    async def get_one(self, entity_id: int) -> EntityRecord:
+        if (entity_data := self.get_cached(self.entity, entity_id)) is not None:
+            return entity_data
+        return self.cache(self.entity, entity_id, await self.amocrm.make_request(
+            "get", f"/api/v4/{self.entity}/{entity_id}", {"with": "leads"}))
+
+    async def get_many(self, limit: int = 50, with_leads: bool = True,
+                       start_page: int = 1) -> AsyncGenerator[EntityRecord, None]:
+        params = {"with": "leads"} if with_leads else None
+        async for item in self.amocrm.get_many(
+                self.entity, f"api/v4/{self.entity}", params, limit=limit, start_page=start_page):
+            yield self.parse(item)
+
+    async def get_pages(self, limit: int = 50, with_leads: bool = True, start_page: int = 1,
+                        step: int = 1) -> AsyncGenerator[Tuple[int, List[EntityRecord]], None]:
+        """Получить сущности постранично, начиная со страницы start_page, через step страниц"""
+
+        params = {"with": "leads"} if with_leads else None
+        async for page, items in self.amocrm.get_pages(
+                self.entity, f"api/v4/{self.entity}", params, limit, start_page, step):
+            yield page, list(self.parse_many(items))
+
+    async def get_updated_since(self, updated_from: int) -> AsyncGenerator[EntityRecord, None]:
+        """Получить сущности, измененные не раньше updated_from"""
+
+        params = {"filter[updated_at][from]": updated_from}
+        async for item in self.amocrm.get_many(
+                self.entity, f"api/v4/{self.entity}", params, limit=AsyncAmoCRM.MAX_LIMIT):
+            yield self.parse(item)
+
+    async def get_chunk(self, entity_ids: List[int], with_leads: bool) -> List[EntityRecord]:
+        """Получить одну пачку сущностей по id, со сделками они попадают в identity map"""
+
+        params = {"filter[id][]": entity_ids}
+        if with_leads:
+            params["with"] = "leads"
+        items = await collect(self.amocrm.get_many(
+            self.entity, f"api/v4/{self.entity}", params, limit=AsyncAmoCRM.MAX_LIMIT))
+        if not with_leads:
+            return list(self.parse_many(items))
+        return [self.cache(self.entity, item["id"], item) for item in items]
+
+    async def get_many_by_ids(self, entity_ids: Iterable[int], with_leads: bool = False) -> List[EntityRecord]:
+        """Получить сущности по списку id, пачки запрашиваются параллельно"""
+
+        entity_ids = list(dict.fromkeys(entity_ids))
+        result = []
+        if with_leads:
+            missing_ids = []
+            for entity_id in entity_ids:
+                if (entity_data := self.get_cached(self.entity, entity_id)) is not None:
+                    result.append(entity_data)
+                else:
+                    missing_ids.append(entity_id)
+            entity_ids = missing_ids
+        chunks = await asyncio.gather(*(self.get_chunk(chunk, with_leads)
+                                        for chunk in chunked(entity_ids, AsyncAmoCRM.MAX_LIMIT)))
+        for chunk in chunks:
+            result.extend(chunk)
+        return result
+
+    async def get_leads(self, entity_id: int) -> Tuple[int, ...]:
+        response = await self.get_one(entity_id)
+        return response.lead_ids or ()
+
+    async def get_success_leads(self, entity_id: int, months: int, entity_data: EntityRecord = None,
+                                stage_ids=None) -> Tuple[List[int], List[int]]:
+        leads = get_embedded_leads(entity_data)
+        if leads is None:
+            leads = await self.get_leads(entity_id)
+        return await get_success_and_active_leads(self.lead_manager(), months, leads, stage_ids)
+
+    async def set_field(self, entity_id: int, field_id: int, value: int) -> dict:
+        data = make_patch_request_data(field_id, value)
+        return await self.amocrm.make_request("patch", f"api/v4/{self.entity}/{entity_id}", json.dumps(data))
+
+    async def set_many_fields(self, entries: List[dict]) -> dict:
+        return await self.amocrm.make_request("patch", f"api/v4/{self.entity}", json.dumps(entries))
+
+    async def get_all_custom_fields(self) -> List[dict]:
+        """Получить все кастомные поля одним проходом"""
+
+        return await collect(self.amocrm.get_many(
+            "custom_fields", f"api/v4/{self.entity}/custom_fields", limit=AsyncAmoCRM.MAX_LIMIT))
+
+    async def get_custom_fields(self, field_type: str) -> List[dict]:
+        fields = get_fields_from_many(await self.get_all_custom_fields(), field_type)
+        return get_value_and_label_from_list(fields)
+
+    def lead_manager(self) -> "AsyncLeadManager":
+        """Менеджер сделок с общей identity map"""
+
+        return AsyncLeadManager(self.amocrm, self.session, self.identity_map, self.lead_field_ids)
+
+
+class AsyncContactManager(AsyncEntityMixin, ContactManager):
+    """Асинхронный класс для запроса по контактам AmoCRM"""
+
+    entity = "contacts"
+
+
+class AsyncCompanyManager(AsyncEntityMixin, CompanyManager):
+    """Асинхронный класс для запроса по компаниям AmoCRM"""
+
+    entity = "companies"
+
+
+class AsyncLeadManager(LeadManager):
+    """Асинхронный класс для запроса по сделкам AmoCRM"""
+
+    is_async = True
+
+    async def get_one(self, lead_id) -> LeadRecord:
+        if (lead_data := self.get_cached("leads", lead_id)) is not None:
+            return lead_data
+        return self.cache("leads", lead_id, await self.amocrm.make_request(
+            "get", f"/api/v4/leads/{lead_id}", {"with": "contacts"}))
+
+    async def get_updated_since(self, updated_from: int, updated_to: int = None) -> AsyncGenerator[LeadRecord, None]:
+        """Получить сделки, измененные не раньше updated_from (и не позже updated_to), от новых к старым"""
+
+        params = {"with": "contacts",
+                  "filter[updated_at][from]": updated_from,
+                  "order[updated_at]": "desc"}
+        if updated_to is not None:
+            params["filter[updated_at][to]"] = updated_to
+        async for item in self.amocrm.get_many("leads", "api/v4/leads", params, limit=AsyncAmoCRM.MAX_LIMIT):
+            yield self.parse(item)
+
+    async def get_deleted_since(self, deleted_from: int) -> AsyncGenerator[int, None]:
+        """Получить id сделок, удаленных не раньше deleted_from, из списка событий"""
+
+        params = {"filter[type]": "lead_deleted",
+                  "filter[created_at][from]": deleted_from}
+        async for event in self.amocrm.get_many("events", "api/v4/events", params, limit=EVENTS_LIMIT):
+            yield int(event["entity_id"])
+
+    async def get_chunk(self, lead_ids: List[int]) -> List[LeadRecord]:
+        """Получить одну пачку сделок по id"""
+
+        params = {"filter[id][]": lead_ids, "with": "contacts"}
+        leads = await collect(self.amocrm.get_many(
+            "leads", "api/v4/leads", params, limit=AsyncAmoCRM.MAX_LIMIT))
+        return [self.cache("leads", lead["id"], lead) for lead in leads]
+
+    async def get_many_by_ids(self, lead_ids: Iterable[int]) -> List[LeadRecord]:
+        """Получить сделки по списку id, пачки запрашиваются параллельно"""
+
+        result = []
+        missing_ids = []
+        for lead_id in dict.fromkeys(lead_ids):
+            if (lead_data := self.get_cached("leads", lead_id)) is not None:
+                result.append(lead_data)
+            else:
+                missing_ids.append(lead_id)
+
+        chunks = await asyncio.gather(
+            *(self.get_chunk(chunk) for chunk in chunked(missing_ids, AsyncAmoCRM.MAX_LIMIT)))
+        for chunk in chunks:
+            result.extend(chunk)
+        return result
+
+    async def get_pipelines(self) -> List[dict]:
+        """Получить воронки со статусами, в рамках identity map - одним запросом"""
+
+        if self.identity_map is not None and (pipelines := self.identity_map.values("pipelines")):
+            return pipelines
+        response = await self.amocrm.make_request("get", "api/v4/leads/pipelines")
+        pipelines = response["_embedded"]["pipelines"]
+        if self.identity_map is not None:
+            for pipeline in pipelines:
+                self.identity_map.add("pipelines", pipeline["id"], pipeline)
+        return pipelines
+
+    async def get_filtered_chunk(self, lead_ids: List[int], filters: dict) -> List[dict]:
+        """Получить одну пачку сделок по id с фильтром по статусам"""
+
+        params = {"filter[id][]": lead_ids, "with": "contacts", **filters}
+        return await collect(self.amocrm.get_many(
+            "leads", "api/v4/leads", params, limit=AsyncAmoCRM.MAX_LIMIT))
+
+    async def get_success_and_active_by_ids(self, lead_ids: Iterable[int], stage_ids,
+                                            months: int) -> List[LeadRecord]:
+        """
+        Получить из lead_ids только успешные в окне months месяцев и активные сделки,
+        отбор делает amoCRM, пачки запрашиваются параллельно
+        """
+
+        result = []
+        missing_ids = []
+        for lead_id in dict.fromkeys(lead_ids):
+            if (lead_data := self.get_cached("leads", lead_id)) is not None:
+                result.append(lead_data)
+            else:
+                missing_ids.append(lead_id)
+        if not missing_ids:
+            return result
+
+        filters = make_success_and_active_filters(stage_ids, months, await self.get_pipelines())
+        chunks = await asyncio.gather(*(self.get_filtered_chunk(chunk, params)
+                                        for params in filters
+                                        for chunk in chunked(missing_ids, AsyncAmoCRM.MAX_LIMIT)))
+        seen = set()
+        for chunk in chunks:
+            for lead_data in chunk:
+                if lead_data["id"] not in seen:
+                    seen.add(lead_data["id"])
+                    result.append(self.cache("leads", lead_data["id"], lead_data))
+        return result
+
+    async def get_all_custom_fields(self) -> List[dict]:
+        """Получить все кастомные поля одним проходом"""
+
+        return await collect(self.amocrm.get_many(
+            "custom_fields", "api/v4/leads/custom_fields", limit=AsyncAmoCRM.MAX_LIMIT))
+
+    async def get_custom_fields(self, field_type: str = "numeric") -> List[dict]:
+        """Только поля numeric используются для сущности лид"""
+
+        fields = get_fields_from_many(await self.get_all_custom_fields(), field_type)
+        return get_value_and_label_from_list(fields)
+
+    async def set_field(self, lead_id: int, lead_field_id: int, value: int) -> dict:
+        data = make_patch_request_data(lead_field_id, value)
+        return await self.amocrm.make_request("patch", f"api/v4/leads/{lead_id}", json.dumps(data))
+
+    async def set_many_fields(self, entries: List[dict]) -> dict:
+        data = make_many_patch_request_data(entries)
+        return await self.amocrm.make_request("patch", "api/v4/leads", json.dumps(data))
+
+
+async def get_success_and_active_leads(lead_manager: AsyncLeadManager, months, lead_ids: List[int],
+                                       stage_ids=None) -> Tuple[List[int], List[int]]:
+    """Получить успешные и активные сделки, настройки без снимка читаются вне event loop"""
+
+    if stage_ids is None:
+        loop = asyncio.get_running_loop()
+        stage_ids = await loop.run_in_executor(None, get_stage_ids, lead_manager.session)
+    leads_data = await lead_manager.get_success_and_active_by_ids(lead_ids, stage_ids, months)
+    return classify_success_and_active_leads(leads_data, stage_ids, months)
+
+
+class AsyncMetaManager:
+    """Объединяющий класс для асинхронного клиента"""
+
+    def __init__(self, amocrm: AsyncAmoCRM, session: Session, identity_map: IdentityMap = None,
+                 lead_field_ids: Tuple[int, ...] = ()):
+        self.amocrm = amocrm
+        self.identity_map = identity_map
+        self.contacts = AsyncContactManager(amocrm, session, identity_map, lead_field_ids)
+        self.companies = AsyncCompanyManager(amocrm, session, identity_map, lead_field_ids)
+        self.leads = AsyncLeadManager(amocrm, session, identity_map, lead_field_ids)
+
+    async def get_custom_fields(self) -> dict:
+        """Получить кастомные поля для всех сущностей, по одному параллельному проходу на тип"""
+
+        fields = await asyncio.gather(
+            self.companies.get_all_custom_fields(),
+            self.contacts.get_all_custom_fields(),
+            self.leads.get_all_custom_fields(),
+        )
+        return split_custom_fields(*fields)
+
+    async def get_custom_fields_cached(self) -> Tuple[dict, str]:
+        """Получить кастомные поля и их etag из кэша, при промахе - из amoCRM"""
+
+        key = self.amocrm.url
+        if (cached := custom_fields_cache.get(key)) is not None:
+            return cached
+        data = await self.get_custom_fields()
+        return custom_fields_cache.set(key, (data, make_etag(data)))
+
+    def invalidate_custom_fields(self) -> None:
+        """Сбросить кэш кастомных полей аккаунта"""
+
+        custom_fields_cache.invalidate(self.amocrm.url)
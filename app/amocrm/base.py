@@ -1,20 +1,40 @@
 from .exceptions import (UnexpectedResponseCustomException,
                          BadResponseCustomException,
-                         NotAuthorizedCustomException)
+                         NotAuthorizedCustomException,
+                         TooManyRequestsCustomException)
+from .http_pool import get_http_session
+from .rate_limit import TokenBucket, PRIORITY_HIGH, get_rate_limiter
+from .retry import RETRY_STATUS_CODES, can_retry, RequestStats, get_retry_delay
+from .tokens import RefreshLock, get_token_expires_at, save_token_expires_at
 from app.app_settings import get_settings
 import requests
 import time
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 
-from typing import Callable, Union, List, Generator
+from typing import Callable, Union, List, Generator, Tuple
 from app.logger import logger
 from celery.utils.log import get_task_logger
 celery_logger = get_task_logger(__name__)
 
 
+def request_was_sent(error: requests.RequestException) -> bool:
+    """Ошибка после установки соединения: запрос мог дойти до amoCRM"""
+
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return not isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
 class AmoCRM:
     """Базовый класс для работы с AmoCRM API"""
 
+    # Максимальное количество сущностей на странице и в одном пакетном запросе
+    MAX_LIMIT = 250
+    # Методы клиента - корутины. Менеджеры проверяют, что клиент им подходит
+    is_async = False
+
     def __init__(
         self,
         account: str,
@@ -25,6 +45,10 @@ class AmoCRM:
         refresh_token: str = None,
         auth_code: str = None,
         on_auth: Callable = None,
+        on_token_load: Callable[[], Tuple[str, str]] = None,
+        http_session: requests.Session = None,
+        rate_limiter: TokenBucket = None,
+        priority: str = PRIORITY_HIGH,
     ):
         self._account = account
         self._client_id = client_id
@@ -34,7 +58,16 @@ class AmoCRM:
         self._refresh_token = refresh_token
         self._auth_code = auth_code
         self._on_auth = on_auth
+        self._on_token_load = on_token_load
+        self._expires_at = get_token_expires_at(client_id)
         self.settings = get_settings()
+        # Сессия общая для всех менеджеров и тасков процесса, см. get_http_session
+        self._http = http_session or get_http_session()
+        self._timeout = (self.settings.amocrm_connect_timeout,
+                         self.settings.amocrm_read_timeout)
+        self._rate_limiter = rate_limiter or get_rate_limiter(account)
+        self.priority = priority
+        self.stats = RequestStats()
 
     @property
     def url(self) -> str:
@@ -70,17 +103,61 @@ class AmoCRM:
 
         self._access_token = result["access_token"]
         self._refresh_token = result["refresh_token"]
+        self._expires_at = time.time() + int(result.get("expires_in", 86400))
+        save_token_expires_at(self._client_id, self._expires_at)
 
         if self._on_auth is not None:
             self._on_auth(self._client_id, self._access_token,
                           self._refresh_token, instance=self)
 
+    def token_expires_soon(self) -> bool:
+        """Проверить, что access token скоро истекает и его пора обновить заранее"""
+
+        if self._expires_at is None:
+            return False
+        return time.time() >= self._expires_at - self.settings.amocrm_token_refresh_margin
+
+    def load_tokens(self, stale_access_token: str) -> bool:
+        """
+        Взять токены из хранилища, если другой процесс уже обновил их
+        после того, как мы использовали stale_access_token
+        """
+
+        if self._on_token_load is None:
+            return False
+        access_token, refresh_token = self._on_token_load()
+        if not access_token or access_token == stale_access_token:
+            return False
+        self._access_token = access_token
+        self._refresh_token = refresh_token
+        self._expires_at = get_token_expires_at(self._client_id)
+        return True
+
+    def refresh_tokens(self, stale_access_token: str) -> None:
+        """
+        Обновить токены один раз на интеграцию: под общей блокировкой сначала
+        проверяем хранилище и обновляем сами, только если никто не успел раньше
+        """
+
+        with RefreshLock(self._client_id):
+            if self._access_token != stale_access_token or self.load_tokens(stale_access_token):
+                return
+            # Поочередно пробуем авторизоваться через refresh_token и authorization_code
+            try:
+                self.authorize("refresh_token", self._refresh_token)
+            except (UnexpectedResponseCustomException, BadResponseCustomException):
+                self.authorize("authorization_code", self._auth_code)
+
     def make_request(
         self, method: str, path: str, data: Union[dict, List[dict]] = None, is_auth: bool = False
     ) -> dict:
         """Сделать запрос к API amoCRM"""
 
-        kwargs = {"headers": {"authorization": f"Bearer {self._access_token}"}}
+        if not is_auth and self.token_expires_soon():
+            self.refresh_tokens(self._access_token)
+
+        access_token = self._access_token
+        kwargs = {"headers": {"authorization": f"Bearer {access_token}"}}
 
         if method.lower() == "get":
             kwargs["params"] = data
@@ -89,51 +166,94 @@ class AmoCRM:
         else:
             kwargs["data"] = data
 
-        response = requests.request(method, f"{self.url}/{path}", **kwargs)
+        response = self.send(method, path, is_auth, **kwargs)
         if not is_auth and response.status_code == 401:
-            # Если вернулся код 401 и этот запрос не связан с авторизацией, то мы
-            # поочередно пробуем авторизоваться через refresh_token и authorization_code
-            try:
-                self.authorize("refresh_token", self._refresh_token)
-            except UnexpectedResponseCustomException:
-                self.authorize("authorization_code", self._auth_code)
-
+            # Если вернулся код 401 и этот запрос не связан с авторизацией,
+            # обновляем токены (или берем уже обновленные) и повторяем запрос
+            self.refresh_tokens(access_token)
             return self.make_request(method, path, data)
 
         if response.status_code == 401:
             raise NotAuthorizedCustomException(response)
         elif response.status_code == 400:
             raise BadResponseCustomException(response)
+        elif response.status_code == 429:
+            raise TooManyRequestsCustomException(response)
         elif response.status_code >= 300:
             raise UnexpectedResponseCustomException(response)
-        logger.info(f"Response: {response.status_code} {response.json()}")
-        return response.json()
+        # Сервер может вернуть 204 без тела, при определенных фильтрах, это означает,
+        # что сущностей подходящих под этот фильтр не найдено
+        if response.status_code == 204:
+            return {}
+        result = response.json()
+        logger.info(f"Response: {response.status_code} {result}")
+        return result
 
-    def get_many(
-        self, entity: str, path: str, params: dict = None, limit: int = 50
-    ) -> Generator[dict, None, None]:
-        """Получить все сущности в виде генератора"""
+    def send(self, method: str, path: str, is_auth: bool = False, **kwargs) -> requests.Response:
+        """
+        Отправить запрос в рамках лимита. Ответы 429 и 5xx, а также обрывы соединения
+        повторяются с экспоненциальной задержкой с учетом Retry-After, если это
+        безопасно для метода (см. can_retry)
+        """
+
+        max_retries = self.settings.amocrm_max_retries
+        attempt = 0
+        while True:
+            self._rate_limiter.acquire(self.priority)
+            self.stats.add_request()
+            try:
+                response = self._http.request(
+                    method, f"{self.url}/{path}", timeout=self._timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= max_retries or not can_retry(
+                        method, sent=request_was_sent(e), is_auth=is_auth):
+                    raise
+                status_code, headers, reason = None, None, repr(e)
+            else:
+                if (response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries
+                        or not can_retry(method, response.status_code, is_auth=is_auth)):
+                    self.stats.last_call_retries = attempt
+                    return response
+                status_code, headers, reason = response.status_code, response.headers, response.text
 
-        if params is None:
-            params = {}
+            delay = get_retry_delay(attempt, headers)
+            self.stats.add_retry(status_code, delay)
+            logger.warning(
+                f"Retry {attempt + 1}/{max_retries} {method} {path} in {delay:.2f}s: {status_code} {reason}")
+            time.sleep(delay)
+            attempt += 1
 
-        params.update({"page": 1, "limit": limit})
+    def get_pages(
+        self, entity: str, path: str, params: dict = None, limit: int = 50, start_page: int = 1,
+        step: int = 1
+    ) -> Generator[Tuple[int, List[dict]], None, None]:
+        """
+        Получить сущности постранично: (номер страницы, сущности страницы).
+        step > 1 - каждая step-ая страница, для разбиения списка между шардами
+        """
+
+        params = dict(params or {})
+        params.update({"page": start_page, "limit": limit})
 
+        # Паузы между страницами не нужны - частоту запросов ограничивает лимитер
         while True:
-            try:
-                result = self.make_request("get", path, params)
-            # Сервер может вернуть 204 код, при определенных фильтрах, это означает,
-            # что сущностей подходящих под этот фильтр не найдено
-            except UnexpectedResponseCustomException as e:
-                if e.response.status_code == 204:
-                    break
-
-            yield from result["_embedded"][entity]
+            result = self.make_request("get", path, params)
+            if not result:
+                break
+
+            yield params["page"], result["_embedded"][entity]
             if "next" not in result["_links"]:
                 break
-            time.sleep(10)  # лимит в 50 сущностей -> 5 сущностей в секунду
 
-            params["page"] += 1
+            params["page"] += step
+
+    def get_many(
+        self, entity: str, path: str, params: dict = None, limit: int = 50, start_page: int = 1
+    ) -> Generator[dict, None, None]:
+        """Получить все сущности в виде генератора, начиная со страницы start_page"""
+
+        for _, items in self.get_pages(entity, path, params, limit, start_page):
+            yield from items
 
     def create_hook(self) -> Union[dict, None]:
         """Создать хук на изменение сделки"""
@@ -142,7 +262,7 @@ class AmoCRM:
 
         webhook_post_data = {
             "destination": webhook_endpoint,
-            "settings": ["restore_lead", "add_lead", "status_lead"]
+            "settings": ["restore_lead", "add_lead", "status_lead", "delete_lead"]
         }
 
         params = {
@@ -0,0 +1,39 @@
+import threading
+import time
+from typing import Any, Dict, Hashable, Tuple, Union
+
+
+class TTLCache:
+    """Потокобезопасный кэш в памяти процесса, записи живут ttl секунд"""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Union[Any, None]:
+        """Получить значение, если оно есть и не устарело"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: Hashable, value: Any) -> Any:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """Удалить запись, а без ключа - очистить кэш"""
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
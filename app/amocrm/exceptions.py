@@ -40,3 +40,13 @@ class BadResponseCustomException(BaseResponseCustomException):
 
     def __str__(self):
         return f'Bad response: {self.url} - {self.status_code} - {self.text}'
+
+
+class TooManyRequestsCustomException(UnexpectedResponseCustomException):
+    """Класс исключение для ответа 429 от amoCRM, когда повторы исчерпаны"""
+
+    def __init__(self, response: Response):
+        super().__init__(response)
+
+    def __str__(self):
+        return f'Too many requests: {self.url} - {self.status_code} - {self.text}'
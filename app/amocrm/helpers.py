@@ -1,7 +1,9 @@
-from app.app_settings import get_settings
 from app.settings.services import get_stage_ids
+from .records import EntityRecord, LeadRecord
 from datetime import datetime, timedelta
-from typing import Union, List, Generator, Tuple
+import hashlib
+import json
+from typing import Dict, Union, List, Generator, Tuple, Iterable
 
 
 def get_lead_path(link) -> str:
@@ -17,46 +19,82 @@ def get_lead_id(link) -> int:
     return int(path[-(path[::-1].find("/")):])
 
 
-def check_lead_younger_than(lead: dict, months: int) -> bool:
+def check_lead_younger_than(lead: LeadRecord, months: int) -> bool:
     """Проверить, что количество месяцев с момента создания сделки меньше months"""
 
-    created_at = lead["created_at"]
+    created_at = lead.created_at
     date = datetime.fromtimestamp(created_at)
     if datetime.now() - date > timedelta(days=int(months)*30):
         return False
     return True
 
 
-def check_lead_is_in_success_stage(lead: dict, stage_ids) -> bool:
+def get_created_from(months: int, now: int = None) -> int:
+    """
+    Timestamp начала окна в months месяцев, по тем же правилам что check_lead_younger_than.
+    now - момент, от которого считается окно, по умолчанию текущий
+    """
+
+    date = datetime.now() if now is None else datetime.fromtimestamp(now)
+    return int((date - timedelta(days=int(months)*30)).timestamp())
+
+
+def make_statuses_filter(statuses: List[Tuple[int, int]]) -> dict:
+    """Сформировать filter[statuses] для списка пар (pipeline_id, status_id)"""
+
+    params = {}
+    for index, (pipeline_id, status_id) in enumerate(statuses):
+        params[f"filter[statuses][{index}][pipeline_id]"] = pipeline_id
+        params[f"filter[statuses][{index}][status_id]"] = status_id
+    return params
+
+
+def make_success_and_active_filters(stage_ids, months: int, pipelines: List[dict]) -> List[dict]:
+    """
+    Фильтры списка сделок для подсчета итогов: успешный этап с созданием в окне months
+    месяцев и все статусы воронок, кроме неактивных. Остальные сделки на итоги не влияют
+    """
+
+    filters = []
+    if stage_ids.pipeline_id is not None and stage_ids.success_stage_id is not None:
+        success = make_statuses_filter([(stage_ids.pipeline_id, stage_ids.success_stage_id)])
+        success["filter[created_at][from]"] = get_created_from(months)
+        filters.append(success)
+    inactive_stage_ids = stage_ids.inactive_stage_ids or []
+    statuses = [(pipeline["id"], status["id"])
+                for pipeline in pipelines
+                for status in pipeline["_embedded"]["statuses"]
+                if status["id"] not in inactive_stage_ids]
+    if statuses:
+        filters.append(make_statuses_filter(statuses))
+    return filters
+
+
+def check_lead_is_in_success_stage(lead: LeadRecord, stage_ids) -> bool:
     """Проверить, что сделка находится в разделе Продажа на этапе Закрыто, оплата получена"""
     # settings = get_settings()
 
-    if lead["status_id"] == stage_ids.success_stage_id and lead["pipeline_id"] == stage_ids.pipeline_id:
+    if lead.status_id == stage_ids.success_stage_id and lead.pipeline_id == stage_ids.pipeline_id:
         return True
     return False
 
 
-def check_lead_is_active(lead: dict, stage_ids) -> bool:
+def check_lead_is_active(lead: LeadRecord, stage_ids) -> bool:
     """Проверить, что сделка активна"""
 
-    if lead["status_id"] not in stage_ids.inactive_stage_ids:
+    if lead.status_id not in stage_ids.inactive_stage_ids:
         return True
     return False
 
 
-def check_lead_is_fully_paid(lead: dict) -> Union[int, None]:
-    """Проверить, что сделка полностью оплачена"""
-
-    settings = get_settings()
+def check_lead_is_fully_paid(lead: LeadRecord) -> Union[int, None]:
+    """Проверить, что сделка полностью оплачена, значение поля оплаты сохранено в записи"""
 
-    price = lead["price"]
     try:
-        for field in lead["custom_fields_values"]:
-            if field["field_id"] == settings.lead_paid_field:
-                if int(field["values"][0]["value"]) == int(price):
-                    return int(price)
+        if int(lead.paid) == int(lead.price):
+            return int(lead.price)
         return None
-    except TypeError:
+    except (TypeError, ValueError):
         return None
 
 
@@ -89,6 +127,28 @@ def make_many_patch_request_data(entries: List[dict]) -> List[dict]:
     return data
 
 
+def make_many_entities_patch_request_data(values: Dict[int, Dict[int, Union[str, int]]]) -> List[dict]:
+    """Сформировать дату для patch запроса из {entity_id: {field_id: value}}"""
+
+    data = []
+    for entity_id, fields in values.items():
+        data.append({
+            "id": entity_id,
+            "custom_fields_values": [
+                {"field_id": field_id, "values": [{"value": value}]}
+                for field_id, value in fields.items()
+            ]
+        })
+    return data
+
+
+def make_etag(data) -> str:
+    """Посчитать ETag для JSON-ответа"""
+
+    body = json.dumps(data, sort_keys=True, ensure_ascii=False)
+    return '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+
+
 def get_value_and_label_from_list(items: List) -> List[dict]:
     """Получить value и label для кастомных полей сущности"""
 
@@ -107,34 +167,81 @@ def get_fields_from_many(fields: Generator, field_type: str) -> List[dict]:
     return fields_of_type
 
 
-def get_success_and_active_leads(lead_manager, months, leads) -> Tuple[List[dict], List[int]]:
-    """Получить успешные и активные сделки"""
+def split_custom_fields(company_fields: List[dict], contact_fields: List[dict], lead_fields: List[dict]) -> dict:
+    """Разложить кастомные поля сущностей по типам в формат виджета"""
+
+    def of_type(fields: List[dict], field_type: str) -> List[dict]:
+        return get_value_and_label_from_list(get_fields_from_many(fields, field_type))
+
+    return {
+        "companyNumericFields": of_type(company_fields, "numeric"),
+        "companyStringFields": of_type(company_fields, "text"),
+        "contactNumericFields": of_type(contact_fields, "numeric"),
+        "contactStringFields": of_type(contact_fields, "text"),
+        "leadFields": of_type(lead_fields, "numeric"),
+    }
+
+
+def chunked(items: Iterable, size: int) -> Generator[list, None, None]:
+    """Разбить последовательность на списки длиной не больше size"""
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def classify_success_and_active_leads(leads_data: Iterable[LeadRecord], stage_ids, months) -> Tuple[List[int], List[int]]:
+    """Разделить сделки на успешные (цены) и активные (id)"""
 
     success_leads = []
     active_leads = []
-    stage_ids = get_stage_ids(lead_manager.session)
-
-    for lead in leads:
-        lead_id = get_lead_id(lead["_links"]["self"]["href"])
-        lead_data = lead_manager.get_one(lead_id)
+    for lead_data in leads_data:
         if check_lead_is_in_success_stage(lead_data, stage_ids) and check_lead_younger_than(lead_data, months):
-            success_leads.append(lead_data["price"])
+            success_leads.append(lead_data.price)
         elif check_lead_is_active(lead_data, stage_ids):
-            active_leads.append(lead_data["id"])
+            active_leads.append(lead_data.id)
     return success_leads, active_leads
 
 
-def get_lead_id_from_data(data) -> int:
-    """Получить id сделки из даты сущности"""
+def get_success_and_active_leads(lead_manager, months, lead_ids: List[int], stage_ids=None) -> Tuple[List[int], List[int]]:
+    """Получить успешные и активные сделки, stage_ids из снимка настроек, если он есть"""
+
+    if stage_ids is None:
+        stage_ids = get_stage_ids(lead_manager.session)
+    leads_data = lead_manager.get_success_and_active_by_ids(lead_ids, stage_ids, months)
+    return classify_success_and_active_leads(leads_data, stage_ids, months)
+
+
+def get_embedded_leads(entity_data: Union[EntityRecord, None]) -> Union[Tuple[int, ...], None]:
+    """Получить id сделок, пришедших вместе с сущностью (with=leads), если они есть"""
+
+    if not entity_data:
+        return None
+    return entity_data.lead_ids
+
+
+def get_lead_ids_from_data(data) -> List[int]:
+    """Получить id всех сделок хука из всех событий без повторов, удаленные сделки пропускаются"""
+
+    lead_ids = {}
+    for event, leads in data["leads"].items():
+        if event != "delete":
+            lead_ids.update((int(lead["id"]), None) for lead in leads or [])
+    return list(lead_ids)
+
+
+def get_deleted_lead_ids(data) -> List[int]:
+    """Получить id удаленных сделок из хука"""
 
-    lead_id = list(data["leads"].items())[0][1][0]["id"]
-    return int(lead_id)
+    return [int(lead["id"]) for lead in data["leads"].get("delete") or []]
 
 
-def get_lead_main_contact_id(lead) -> int:
+def get_lead_main_contact_id(lead: LeadRecord) -> Union[int, None]:
     """Получить id основного контакта сделки"""
 
-    contacts = lead["_embedded"]["contacts"]
-    for contact in contacts:
-        if contact["is_main"]:
-            return int(contact["id"])
+    return lead.main_contact_id
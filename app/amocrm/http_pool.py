@@ -0,0 +1,73 @@
+import asyncio
+import os
+import threading
+from typing import Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.app_settings import get_settings
+
+
+_lock = threading.Lock()
+_http_session: Optional[requests.Session] = None
+_http_session_pid: Optional[int] = None
+_async_http_session: Optional[aiohttp.ClientSession] = None
+_async_http_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def make_http_session(pool_size: int) -> requests.Session:
+    """Создать сессию с пулом keep-alive соединений"""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """
+    Получить общую для процесса сессию к amoCRM. Сессия переживает таски Celery
+    в одном воркере и пересоздается после fork, чтобы не делить сокеты с родителем
+    """
+
+    global _http_session, _http_session_pid
+
+    pid = os.getpid()
+    if _http_session is not None and _http_session_pid == pid:
+        return _http_session
+    with _lock:
+        if _http_session is None or _http_session_pid != pid:
+            _http_session = make_http_session(get_settings().amocrm_pool_size)
+            _http_session_pid = pid
+    return _http_session
+
+
+def get_async_http_session() -> aiohttp.ClientSession:
+    """Получить общую для event loop асинхронную сессию к amoCRM"""
+
+    global _async_http_session, _async_http_session_loop
+
+    loop = asyncio.get_running_loop()
+    if _async_http_session is None or _async_http_session.closed or _async_http_session_loop is not loop:
+        settings = get_settings()
+        connector = aiohttp.TCPConnector(limit=settings.amocrm_pool_size)
+        timeout = aiohttp.ClientTimeout(connect=settings.amocrm_connect_timeout,
+                                        sock_read=settings.amocrm_read_timeout)
+        _async_http_session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout)
+        _async_http_session_loop = loop
+    return _async_http_session
+
+
+async def close_async_http_session() -> None:
+    """Закрыть асинхронную сессию, например при остановке приложения"""
+
+    global _async_http_session
+
+    if _async_http_session is not None and not _async_http_session.closed:
+        await _async_http_session.close()
+    _async_http_session = None
@@ -0,0 +1,37 @@
+from typing import Dict, List, Tuple, Union
+
+
+class IdentityMap:
+    """
+    Кэш сущностей amoCRM в рамках одной задачи (например, обработки хука):
+    каждая сущность запрашивается не больше одного раза
+    """
+
+    def __init__(self) -> None:
+        self._entities: Dict[Tuple[str, int], dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, entity: str, entity_id: int) -> Union[dict, None]:
+        """Получить сущность из кэша, если она уже запрашивалась"""
+
+        data = self._entities.get((entity, int(entity_id)))
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def add(self, entity: str, entity_id: int, data: dict) -> dict:
+        """Запомнить сущность"""
+
+        self._entities[(entity, int(entity_id))] = data
+        return data
+
+    def values(self, entity: str) -> List[dict]:
+        """Все запомненные сущности одного типа"""
+
+        return [data for (name, _), data in self._entities.items() if name == entity]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entities)}
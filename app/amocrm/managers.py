@@ -1,22 +1,102 @@
 from abc import abstractmethod, ABC
 from app.amocrm.base import AmoCRM
+from .identity_map import IdentityMap
+from .records import EntityRecord, LeadRecord
 from .helpers import (get_success_and_active_leads,
                       make_patch_request_data,
                       make_many_patch_request_data,
                       get_fields_from_many,
-                      get_value_and_label_from_list)
+                      get_value_and_label_from_list,
+                      make_success_and_active_filters,
+                      split_custom_fields,
+                      get_embedded_leads,
+                      chunked)
 
 import json
-from typing import Generator, List, Tuple
+from typing import Generator, Iterable, List, Tuple, Union
 from sqlmodel import Session
 
 
+# Максимум событий на странице /api/v4/events
+EVENTS_LIMIT = 100
+
+
 class EntityManager(ABC):
     """Базовый класс для запросов к сущностям AmoCRM"""
 
-    def __init__(self, amocrm: AmoCRM, session: Session) -> None:
+    # Во что разбирается ответ amoCRM, полные JSON сущностей не хранятся
+    record = EntityRecord
+    # Менеджеры синхронного клиента, асинхронные - в async_managers.py
+    is_async = False
+
+    def __init__(self, amocrm: AmoCRM, session: Session, identity_map: IdentityMap = None,
+                 lead_field_ids: Tuple[int, ...] = ()) -> None:
+        if getattr(amocrm, "is_async", False) != self.is_async:
+            raise TypeError(f"{type(self).__name__} does not work with {type(amocrm).__name__}")
         self.amocrm = amocrm
         self.session = session
+        self.identity_map = identity_map
+        # Поля сделок, которые пишут проверки: только они хранятся в записях сделок
+        self.lead_field_ids = lead_field_ids
+
+    def parse(self, data: dict) -> Union[EntityRecord, LeadRecord]:
+        """Разобрать одну сущность ответа в запись"""
+
+        return self.record.from_data(data)
+
+    def get_cached(self, entity: str, entity_id: int) -> Union[EntityRecord, LeadRecord, None]:
+        """Получить сущность из identity map, если она есть"""
+
+        if self.identity_map is None:
+            return None
+        return self.identity_map.get(entity, entity_id)
+
+    def cache(self, entity: str, entity_id: int, data: dict) -> Union[EntityRecord, LeadRecord, None]:
+        """Разобрать ответ в запись и запомнить ее в identity map, если она есть"""
+
+        if not data:
+            return None
+        record = self.parse(data)
+        if self.identity_map is not None:
+            self.identity_map.add(entity, entity_id, record)
+        return record
+
+    def parse_many(self, items: Iterable[dict]) -> Generator[Union[EntityRecord, LeadRecord], None, None]:
+        """Разобрать страницы списка в записи"""
+
+        for data in items:
+            yield self.parse(data)
+
+    def fetch_many_by_ids(self, entity: str, entity_ids: Iterable[int],
+                          with_leads: bool = False) -> Generator[EntityRecord, None, None]:
+        """
+        Получить контакты или компании по списку id пакетными запросами. Со сделками
+        они такие же, как из get_one: уже полученные берутся из identity map, новые туда попадают
+        """
+
+        entity_ids = list(dict.fromkeys(entity_ids))
+        if not with_leads:
+            for chunk in chunked(entity_ids, AmoCRM.MAX_LIMIT):
+                yield from self.parse_many(self.amocrm.get_many(
+                    entity, f"api/v4/{entity}", {"filter[id][]": chunk}, limit=AmoCRM.MAX_LIMIT))
+            return
+
+        missing_ids = []
+        for entity_id in entity_ids:
+            if (entity_data := self.get_cached(entity, entity_id)) is not None:
+                yield entity_data
+            else:
+                missing_ids.append(entity_id)
+        for chunk in chunked(missing_ids, AmoCRM.MAX_LIMIT):
+            params = {"filter[id][]": chunk, "with": "leads"}
+            for entity_data in self.amocrm.get_many(
+                    entity, f"api/v4/{entity}", params, limit=AmoCRM.MAX_LIMIT):
+                yield self.cache(entity, entity_data["id"], entity_data)
+
+    def lead_manager(self) -> "LeadManager":
+        """Менеджер сделок с общей identity map"""
+
+        return LeadManager(self.amocrm, self.session, self.identity_map, self.lead_field_ids)
 
     @abstractmethod
     def get_one(self):
@@ -64,99 +144,240 @@ class EntityManager(ABC):
 class ContactManager(EntityManager):
     """Класс для запроса по контактам AmoCRM"""
 
-    def get_one(self, contact_id: int) -> dict:
+    def get_one(self, contact_id: int) -> EntityRecord:
+        if (contact_data := self.get_cached("contacts", contact_id)) is not None:
+            return contact_data
         data = {"with": "leads"}
-        return self.amocrm.make_request(
-            "get", f"/api/v4/contacts/{contact_id}", data)
+        return self.cache("contacts", contact_id, self.amocrm.make_request(
+            "get", f"/api/v4/contacts/{contact_id}", data))
 
-    def get_many(self) -> Generator[dict, None, None]:
-        yield from self.amocrm.get_many("contacts", "api/v4/contacts")
+    def get_many(self, limit: int = 50, with_leads: bool = True, start_page: int = 1) -> Generator[EntityRecord, None, None]:
+        for _, contacts in self.get_pages(limit, with_leads, start_page):
+            yield from contacts
 
-    def get_leads(self, contact_id: int) -> List[dict]:
-        data = {"with": "leads"}
-        response = self.amocrm.make_request(
-            "get", f"/api/v4/contacts/{contact_id}", data)
-        return response["_embedded"]["leads"]
+    def get_pages(self, limit: int = 50, with_leads: bool = True, start_page: int = 1,
+                  step: int = 1) -> Generator[Tuple[int, List[EntityRecord]], None, None]:
+        """Получить сущности постранично, начиная со страницы start_page, через step страниц"""
+
+        params = {"with": "leads"} if with_leads else None
+        for page, items in self.amocrm.get_pages("contacts", "api/v4/contacts", params, limit, start_page, step):
+            yield page, list(self.parse_many(items))
+
+    def get_updated_since(self, updated_from: int) -> Generator[EntityRecord, None, None]:
+        """Получить сущности, измененные не раньше updated_from"""
+
+        params = {"filter[updated_at][from]": updated_from}
+        yield from self.parse_many(self.amocrm.get_many(
+            "contacts", "api/v4/contacts", params, limit=AmoCRM.MAX_LIMIT))
 
-    def get_success_leads(self, contact_id: int, months: int) -> Tuple[List[dict], List[int]]:
-        leads = self.get_leads(contact_id)
-        return get_success_and_active_leads(LeadManager(self.amocrm, self.session), months, leads)
+    def get_many_by_ids(self, contact_ids: Iterable[int], with_leads: bool = False) -> Generator[EntityRecord, None, None]:
+        """Получить сущности по списку id пакетными запросами"""
+
+        yield from self.fetch_many_by_ids("contacts", contact_ids, with_leads)
+
+    def get_leads(self, contact_id: int) -> Tuple[int, ...]:
+        response = self.get_one(contact_id)
+        return response.lead_ids or ()
+
+    def get_success_leads(self, contact_id: int, months: int, contact_data: EntityRecord = None, stage_ids=None) -> Tuple[List[int], List[int]]:
+        leads = get_embedded_leads(contact_data)
+        if leads is None:
+            leads = self.get_leads(contact_id)
+        return get_success_and_active_leads(self.lead_manager(), months, leads, stage_ids)
 
     def set_field(self, contact_id: int, contact_field_id: int, value: int) -> dict:
         data = make_patch_request_data(contact_field_id, value)
         return self.amocrm.make_request("patch", f"api/v4/contacts/{contact_id}", json.dumps(data))
 
     def set_many_fields(self, entries: List[dict]) -> dict:
-        return self.amocrm.make_request("patch", f"api/v4/contacts", json.dumps(entries))
+        return self.amocrm.make_request("patch", "api/v4/contacts", json.dumps(entries))
+
+    def get_all_custom_fields(self) -> List[dict]:
+        """Получить все кастомные поля одним проходом"""
+
+        return list(self.amocrm.get_many(
+            "custom_fields", "/api/v4/contacts/custom_fields", limit=AmoCRM.MAX_LIMIT))
 
     def get_custom_fields(self, field_type: str) -> List[dict]:
-        generator = self.amocrm.get_many(
-            "custom_fields", f"/api/v4/contacts/custom_fields")
-        fields = get_fields_from_many(generator, field_type)
+        fields = get_fields_from_many(self.get_all_custom_fields(), field_type)
         return get_value_and_label_from_list(fields)
 
 
 class CompanyManager(EntityManager):
     """Класс для запроса по компаниям AmoCRM"""
 
-    def get_one(self, company_id: int) -> dict:
+    def get_one(self, company_id: int) -> EntityRecord:
+        if (company_data := self.get_cached("companies", company_id)) is not None:
+            return company_data
         data = {"with": "leads"}
-        return self.amocrm.make_request(
-            "get", f"/api/v4/companies/{company_id}", data)
+        return self.cache("companies", company_id, self.amocrm.make_request(
+            "get", f"/api/v4/companies/{company_id}", data))
 
-    def get_many(self) -> Generator[dict, None, None]:
-        yield from self.amocrm.get_many("companies", "api/v4/companies")
+    def get_many(self, limit: int = 50, with_leads: bool = True, start_page: int = 1) -> Generator[EntityRecord, None, None]:
+        for _, companies in self.get_pages(limit, with_leads, start_page):
+            yield from companies
 
-    def get_leads(self, company_id: int) -> List[dict]:
-        data = {"with": "leads"}
-        response = self.amocrm.make_request(
-            "get", f"/api/v4/companies/{company_id}", data)
-        return response["_embedded"]["leads"]
+    def get_pages(self, limit: int = 50, with_leads: bool = True, start_page: int = 1,
+                  step: int = 1) -> Generator[Tuple[int, List[EntityRecord]], None, None]:
+        """Получить сущности постранично, начиная со страницы start_page, через step страниц"""
 
-    def get_success_leads(self, company_id: int, months: int) -> Tuple[List[dict], List[int]]:
-        leads = self.get_leads(company_id)
-        return get_success_and_active_leads(LeadManager(self.amocrm, self.session), months, leads)
+        params = {"with": "leads"} if with_leads else None
+        for page, items in self.amocrm.get_pages("companies", "api/v4/companies", params, limit, start_page, step):
+            yield page, list(self.parse_many(items))
+
+    def get_updated_since(self, updated_from: int) -> Generator[EntityRecord, None, None]:
+        """Получить сущности, измененные не раньше updated_from"""
+
+        params = {"filter[updated_at][from]": updated_from}
+        yield from self.parse_many(self.amocrm.get_many(
+            "companies", "api/v4/companies", params, limit=AmoCRM.MAX_LIMIT))
+
+    def get_many_by_ids(self, company_ids: Iterable[int], with_leads: bool = False) -> Generator[EntityRecord, None, None]:
+        """Получить сущности по списку id пакетными запросами"""
+
+        yield from self.fetch_many_by_ids("companies", company_ids, with_leads)
+
+    def get_leads(self, company_id: int) -> Tuple[int, ...]:
+        response = self.get_one(company_id)
+        return response.lead_ids or ()
+
+    def get_success_leads(self, company_id: int, months: int, company_data: EntityRecord = None, stage_ids=None) -> Tuple[List[int], List[int]]:
+        leads = get_embedded_leads(company_data)
+        if leads is None:
+            leads = self.get_leads(company_id)
+        return get_success_and_active_leads(self.lead_manager(), months, leads, stage_ids)
 
     def set_field(self, company_id: int, company_field_id: int, value: int) -> dict:
         data = make_patch_request_data(company_field_id, value)
         return self.amocrm.make_request("patch", f"api/v4/companies/{company_id}", json.dumps(data))
 
     def set_many_fields(self, entries: List[dict]) -> dict:
-        return self.amocrm.make_request("patch", f"api/v4/companies", json.dumps(entries))
+        return self.amocrm.make_request("patch", "api/v4/companies", json.dumps(entries))
+
+    def get_all_custom_fields(self) -> List[dict]:
+        """Получить все кастомные поля одним проходом"""
+
+        return list(self.amocrm.get_many(
+            "custom_fields", "/api/v4/companies/custom_fields", limit=AmoCRM.MAX_LIMIT))
 
     def get_custom_fields(self, field_type: str) -> List[dict]:
-        generator = self.amocrm.get_many(
-            "custom_fields", f"/api/v4/companies/custom_fields")
-        fields = get_fields_from_many(generator, field_type)
+        fields = get_fields_from_many(self.get_all_custom_fields(), field_type)
         return get_value_and_label_from_list(fields)
 
 
 class LeadManager(EntityManager):
     """Класс для запроса по сделкам AmoCRM"""
 
-    def get_one(self, lead_id) -> dict:
-        return self.amocrm.make_request(
-            "get", f"/api/v4/leads/{lead_id}", {"with": "contacts"})
+    record = LeadRecord
+
+    def parse(self, data: dict) -> LeadRecord:
+        return LeadRecord.from_data(data, self.lead_field_ids)
+
+    def get_one(self, lead_id) -> LeadRecord:
+        if (lead_data := self.get_cached("leads", lead_id)) is not None:
+            return lead_data
+        return self.cache("leads", lead_id, self.amocrm.make_request(
+            "get", f"/api/v4/leads/{lead_id}", {"with": "contacts"}))
+
+    def get_updated_since(self, updated_from: int, updated_to: int = None) -> Generator[LeadRecord, None, None]:
+        """Получить сделки, измененные не раньше updated_from (и не позже updated_to), от новых к старым"""
+
+        params = {"with": "contacts",
+                  "filter[updated_at][from]": updated_from,
+                  "order[updated_at]": "desc"}
+        if updated_to is not None:
+            params["filter[updated_at][to]"] = updated_to
+        yield from self.parse_many(self.amocrm.get_many(
+            "leads", "api/v4/leads", params, limit=AmoCRM.MAX_LIMIT))
+
+    def get_deleted_since(self, deleted_from: int) -> Generator[int, None, None]:
+        """Получить id сделок, удаленных не раньше deleted_from, из списка событий"""
+
+        params = {"filter[type]": "lead_deleted",
+                  "filter[created_at][from]": deleted_from}
+        for event in self.amocrm.get_many("events", "api/v4/events", params, limit=EVENTS_LIMIT):
+            yield int(event["entity_id"])
+
+    def get_many_by_ids(self, lead_ids: Iterable[int]) -> Generator[LeadRecord, None, None]:
+        """Получить сделки по списку id пакетными запросами, уже полученные берутся из identity map"""
+
+        missing_ids = []
+        for lead_id in dict.fromkeys(lead_ids):
+            if (lead_data := self.get_cached("leads", lead_id)) is not None:
+                yield lead_data
+            else:
+                missing_ids.append(lead_id)
+
+        for chunk in chunked(missing_ids, AmoCRM.MAX_LIMIT):
+            params = {"filter[id][]": chunk, "with": "contacts"}
+            for lead_data in self.amocrm.get_many(
+                    "leads", "api/v4/leads", params, limit=AmoCRM.MAX_LIMIT):
+                yield self.cache("leads", lead_data["id"], lead_data)
+
+    def get_pipelines(self) -> List[dict]:
+        """Получить воронки со статусами, в рамках identity map - одним запросом"""
+
+        if self.identity_map is not None and (pipelines := self.identity_map.values("pipelines")):
+            return pipelines
+        pipelines = self.amocrm.make_request("get", "api/v4/leads/pipelines")["_embedded"]["pipelines"]
+        if self.identity_map is not None:
+            for pipeline in pipelines:
+                self.identity_map.add("pipelines", pipeline["id"], pipeline)
+        return pipelines
+
+    def get_success_and_active_by_ids(self, lead_ids: Iterable[int], stage_ids,
+                                      months: int) -> Generator[LeadRecord, None, None]:
+        """
+        Получить из lead_ids только сделки, влияющие на итоги: успешные в окне months месяцев
+        и активные. Отбор по статусам и created_at делает amoCRM, уже полученные сделки
+        берутся из identity map, сделка из обеих выборок отдается один раз
+        """
+
+        missing_ids = []
+        for lead_id in dict.fromkeys(lead_ids):
+            if (lead_data := self.get_cached("leads", lead_id)) is not None:
+                yield lead_data
+            else:
+                missing_ids.append(lead_id)
+        if not missing_ids:
+            return
+
+        seen = set()
+        for filters in make_success_and_active_filters(stage_ids, months, self.get_pipelines()):
+            for chunk in chunked(missing_ids, AmoCRM.MAX_LIMIT):
+                params = {"filter[id][]": chunk, "with": "contacts", **filters}
+                for lead_data in self.amocrm.get_many(
+                        "leads", "api/v4/leads", params, limit=AmoCRM.MAX_LIMIT):
+                    if lead_data["id"] not in seen:
+                        seen.add(lead_data["id"])
+                        yield self.cache("leads", lead_data["id"], lead_data)
 
     def get_custom_fields(self, field_type: str = "numeric") -> List[dict]:
         """Только поля numeric используются для сущности лид"""
 
-        generator = self.amocrm.get_many(
-            "custom_fields", f"/api/v4/leads/custom_fields")
-        numeric_fields = get_fields_from_many(generator, field_type)
+        numeric_fields = get_fields_from_many(
+            self.get_all_custom_fields(), field_type)
         return get_value_and_label_from_list(numeric_fields)
 
+    def get_all_custom_fields(self) -> List[dict]:
+        """Получить все кастомные поля одним проходом"""
+
+        return list(self.amocrm.get_many(
+            "custom_fields", "/api/v4/leads/custom_fields", limit=AmoCRM.MAX_LIMIT))
+
     def set_field(self, lead_id: int, lead_field_id: int, value: int) -> dict:
         data = make_patch_request_data(lead_field_id, value)
         return self.amocrm.make_request("patch", f"api/v4/leads/{lead_id}", json.dumps(data))
 
     def set_many_fields(self, entries: List[dict]) -> dict:
         data = make_many_patch_request_data(entries)
-        return self.amocrm.make_request("patch", f"api/v4/leads", json.dumps(data))
+        return self.amocrm.make_request("patch", "api/v4/leads", json.dumps(data))
 
     """Для сущности сделка методы ниже не нужны или не имеют смысла"""
 
     def get_many(self):
+        """Полный список сделок не запрашивается: проверки читают копию сделок"""
+
         pass
 
     def get_leads(self):
@@ -169,19 +390,16 @@ class LeadManager(EntityManager):
 class MetaManager:
     """Объединяющий класс"""
 
-    def __init__(self, amocrm: AmoCRM, session: Session):
-        self.contacts = ContactManager(amocrm, session)
-        self.companies = CompanyManager(amocrm, session)
-        self.leads = LeadManager(amocrm, session)
+    def __init__(self, amocrm: AmoCRM, session: Session, identity_map: IdentityMap = None,
+                 lead_field_ids: Tuple[int, ...] = ()):
+        self.identity_map = identity_map
+        self.contacts = ContactManager(amocrm, session, identity_map, lead_field_ids)
+        self.companies = CompanyManager(amocrm, session, identity_map, lead_field_ids)
+        self.leads = LeadManager(amocrm, session, identity_map, lead_field_ids)
 
     def get_custom_fields(self) -> dict:
-        """Получить кастомные поля для всех сущностей"""
-
-        data = {
-            "companyNumericFields": self.companies.get_custom_fields("numeric"),
-            "companyStringFields": self.companies.get_custom_fields("text"),
-            "contactNumericFields": self.contacts.get_custom_fields("numeric"),
-            "contactStringFields": self.contacts.get_custom_fields("text"),
-            "leadFields": self.leads.get_custom_fields("numeric"),
-        }
-        return data
+        """Получить кастомные поля для всех сущностей, по одному проходу на тип сущности"""
+
+        return split_custom_fields(self.companies.get_all_custom_fields(),
+                                   self.contacts.get_all_custom_fields(),
+                                   self.leads.get_all_custom_fields())
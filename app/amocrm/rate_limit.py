@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Union
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from app.app_settings import get_settings
+from app.logger import logger
+from app.redis_client import get_redis
+
+
+# Хуки чувствительны к задержке, поэтому идут с высоким приоритетом,
+# полные проверки - с низким
+PRIORITY_HIGH = "high"
+PRIORITY_LOW = "low"
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: пополняется на rate токенов в секунду,
+    но не больше чем до capacity. Запросы с низким приоритетом не могут
+    опустить баланс ниже reserve - этот остаток достается только высокому приоритету
+    """
+
+    def __init__(self, rate: float, capacity: float = None, reserve: float = 0) -> None:
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.reserve = float(reserve)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def floor(self, priority: str) -> float:
+        """Минимальный баланс, который должен остаться после списания токена"""
+
+        return 0.0 if priority == PRIORITY_HIGH else self.reserve
+
+    def try_acquire(self, priority: str = PRIORITY_HIGH) -> float:
+        """Забрать токен. Вернуть 0, если удалось, иначе сколько секунд подождать"""
+
+        floor = self.floor(priority)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens - 1 >= floor:
+                self._tokens -= 1
+                return 0.0
+            return (floor + 1 - self._tokens) / self.rate
+
+    def acquire(self, priority: str = PRIORITY_HIGH) -> None:
+        """Дождаться токена для запроса"""
+
+        while (wait := self.try_acquire(priority)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, priority: str = PRIORITY_HIGH) -> None:
+        """Дождаться токена для запроса, не блокируя event loop"""
+
+        while (wait := self.try_acquire(priority)) > 0:
+            await asyncio.sleep(wait)
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket в Redis, общий для всех процессов, работающих с одним аккаунтом.
+    При недоступности Redis переключается на локальный bucket процесса
+    """
+
+    # Пополнение и списание атомарны, время берется с сервера Redis,
+    # чтобы расхождение часов между воркерами не влияло на лимит
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local floor = tonumber(ARGV[3])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+    local wait = 0
+    if tokens - 1 >= floor then
+        tokens = tokens - 1
+    else
+        wait = (floor + 1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+    return tostring(wait)
+    """
+
+    def __init__(self, redis: Redis, key: str, rate: float, capacity: float = None, reserve: float = 0) -> None:
+        super().__init__(rate, capacity, reserve)
+        self.key = key
+        self._script = redis.register_script(self.SCRIPT)
+
+    def try_acquire(self, priority: str = PRIORITY_HIGH) -> float:
+        try:
+            wait = self._script(keys=[self.key], args=[
+                self.rate, self.capacity, self.floor(priority)])
+        except RedisError as e:
+            logger.warning(f"Redis rate limiter unavailable, using local: {e}")
+            return super().try_acquire(priority)
+        return float(wait)
+
+    async def acquire_async(self, priority: str = PRIORITY_HIGH) -> None:
+        """Дождаться токена: запрос к Redis блокирующий, поэтому идет в пуле потоков, а не в event loop"""
+
+        loop = asyncio.get_running_loop()
+        while (wait := await loop.run_in_executor(None, self.try_acquire, priority)) > 0:
+            await asyncio.sleep(wait)
+
+
+_lock = threading.Lock()
+_limiters: Dict[str, TokenBucket] = {}
+
+
+def get_rate_limiter(account: str) -> Union[TokenBucket, RedisTokenBucket]:
+    """
+    Получить лимитер запросов к аккаунту amoCRM: общий для всех процессов,
+    если настроен Redis, иначе общий для процесса
+    """
+
+    with _lock:
+        if account not in _limiters:
+            settings = get_settings()
+            redis = get_redis()
+            if redis is None:
+                _limiters[account] = TokenBucket(
+                    settings.amocrm_rps, settings.amocrm_burst, settings.amocrm_priority_reserve)
+            else:
+                _limiters[account] = RedisTokenBucket(
+                    redis, f"amocrm:rate:{account}", settings.amocrm_rps,
+                    settings.amocrm_burst, settings.amocrm_priority_reserve)
+        return _limiters[account]
@@ -0,0 +1,106 @@
+from app.app_settings import get_settings
+
+from typing import Collection, Dict, Tuple, Union
+
+
+def get_embedded_ids(data: dict, entity: str) -> Union[Tuple[int, ...], None]:
+    """id сущностей из _embedded, None если они не запрашивались"""
+
+    embedded = data.get("_embedded") or {}
+    items = embedded.get(entity)
+    if items is None:
+        return None
+    return tuple(int(item["id"]) for item in items)
+
+
+def get_first_values(data: dict, field_ids: Collection[int] = None
+                     ) -> Dict[int, Union[str, int, float, bool, None]]:
+    """Первые значения кастомных полей: {field_id: value}, только field_ids, если они заданы"""
+
+    return {
+        int(field["field_id"]): (field["values"][0]["value"] if field["values"] else None)
+        for field in data.get("custom_fields_values") or []
+        if field_ids is None or int(field["field_id"]) in field_ids
+    }
+
+
+class LeadRecord:
+    """
+    Сделка без лишних полей ответа amoCRM: только то, что нужно проверкам.
+    paid - значение поля оплаты сделки (lead_paid_field), если оно заполнено,
+    fields - значения полей сделки, которые пишут проверки, чтобы не отправлять то же значение повторно
+    """
+
+    __slots__ = ("id", "price", "status_id", "pipeline_id", "created_at", "updated_at",
+                 "paid", "main_contact_id", "contact_ids", "company_ids", "fields")
+
+    def __init__(self, id: int, price: int, status_id: int, pipeline_id: int, created_at: int,
+                 updated_at: int = 0, paid: Union[str, int, None] = None, main_contact_id: int = None,
+                 contact_ids: Tuple[int, ...] = (), company_ids: Tuple[int, ...] = (),
+                 fields: Dict[int, Union[str, int, None]] = None) -> None:
+        self.id = id
+        self.price = price
+        self.status_id = status_id
+        self.pipeline_id = pipeline_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.paid = paid
+        self.main_contact_id = main_contact_id
+        self.contact_ids = contact_ids
+        self.company_ids = company_ids
+        self.fields = fields if fields is not None else {}
+
+    @classmethod
+    def from_data(cls, data: dict, field_ids: Collection[int] = ()) -> "LeadRecord":
+        """field_ids - какие кастомные поля сохранить в fields, остальные не хранятся"""
+
+        embedded = data.get("_embedded") or {}
+        contacts = embedded.get("contacts") or []
+        main_contact_id = next(
+            (int(contact["id"]) for contact in contacts if contact.get("is_main")), None)
+        paid_field = get_settings().lead_paid_field
+        values = get_first_values(data, {paid_field, *field_ids})
+        return cls(
+            int(data["id"]),
+            int(data["price"] or 0),
+            int(data["status_id"]),
+            int(data["pipeline_id"]),
+            int(data["created_at"]),
+            int(data.get("updated_at") or 0),
+            values.get(paid_field),
+            main_contact_id,
+            tuple(int(contact["id"]) for contact in contacts),
+            get_embedded_ids(data, "companies") or (),
+            {field_id: values[field_id] for field_id in field_ids if field_id in values},
+        )
+
+    def __repr__(self) -> str:
+        return f"LeadRecord(id={self.id}, price={self.price}, status_id={self.status_id})"
+
+
+class EntityRecord:
+    """
+    Контакт или компания: первые значения кастомных полей и связи.
+    lead_ids равен None, если сделки не запрашивались (with=leads)
+    """
+
+    __slots__ = ("id", "fields", "lead_ids", "company_ids")
+
+    def __init__(self, id: int, fields: Dict[int, Union[str, int, None]] = None,
+                 lead_ids: Tuple[int, ...] = None, company_ids: Tuple[int, ...] = ()) -> None:
+        self.id = id
+        self.fields = fields if fields is not None else {}
+        self.lead_ids = lead_ids
+        self.company_ids = company_ids
+
+    @classmethod
+    def from_data(cls, data: dict) -> "EntityRecord":
+        return cls(
+            int(data["id"]),
+            get_first_values(data),
+            get_embedded_ids(data, "leads"),
+            get_embedded_ids(data, "companies") or (),
+        )
+
+    def __repr__(self) -> str:
+        return f"EntityRecord(id={self.id}, fields={self.fields})"
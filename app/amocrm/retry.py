@@ -0,0 +1,93 @@
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Union
+
+from app.app_settings import get_settings
+
+
+# Коды, при которых запрос к amoCRM имеет смысл повторить
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Методы, повтор которых после 5xx или обрыва не меняет результат
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def can_retry(method: str, status_code: int = None, sent: bool = True, is_auth: bool = False) -> bool:
+    """
+    Можно ли повторить запрос. Запросы авторизации не повторяются: обмен refresh токена
+    мог пройти, а повтор отправит уже использованный токен. POST и PATCH повторяются
+    только после 429 и ошибок до отправки запроса - иначе запись может выполниться дважды
+    """
+
+    if is_auth:
+        return False
+    if status_code == 429 or not sent:
+        return True
+    return method.upper() in IDEMPOTENT_METHODS
+
+
+def parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    """Получить задержку в секундах из заголовка Retry-After (число или HTTP-дата)"""
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_delay(attempt: int, headers: Mapping[str, str] = None) -> float:
+    """
+    Задержка перед повтором номер attempt (с нуля): экспоненциальная с полным jitter,
+    но не меньше, чем просит сервер в Retry-After
+    """
+
+    settings = get_settings()
+    backoff = min(settings.amocrm_retry_max_delay,
+                  settings.amocrm_retry_base_delay * 2 ** attempt)
+    delay = random.uniform(0, backoff)
+    retry_after = parse_retry_after((headers or {}).get("Retry-After"))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, settings.amocrm_retry_max_delay))
+    return delay
+
+
+class RequestStats:
+    """Счетчики запросов к amoCRM: сколько повторов и сколько времени ушло на ожидание"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.retry_wait = 0.0
+        self.retries_by_status = {}
+        self.last_call_retries = 0
+
+    def add_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def add_retry(self, status_code: Union[int, None], delay: float) -> None:
+        with self._lock:
+            self.retries += 1
+            self.retry_wait += delay
+            key = str(status_code or "connection")
+            self.retries_by_status[key] = self.retries_by_status.get(key, 0) + 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "retry_wait": round(self.retry_wait, 3),
+                "retries_by_status": dict(self.retries_by_status),
+            }
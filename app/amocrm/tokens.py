@@ -0,0 +1,87 @@
+import threading
+from typing import Dict, Union
+
+from redis.exceptions import RedisError
+
+from app.app_settings import get_settings
+from app.logger import logger
+from app.redis_client import get_redis
+
+
+_lock = threading.Lock()
+_local_locks: Dict[str, threading.Lock] = {}
+_local_expires_at: Dict[str, float] = {}
+
+
+class RefreshLock:
+    """
+    Блокировка обновления токенов интеграции: в Redis - общая для всех процессов,
+    без Redis - общая для процесса. Может освобождаться из другого потока
+    """
+
+    def __init__(self, client_id: str) -> None:
+        settings = get_settings()
+        self._redis_lock = None
+        redis = get_redis()
+        if redis is not None:
+            self._redis_lock = redis.lock(
+                f"amocrm:refresh:{client_id}", timeout=settings.amocrm_refresh_lock_timeout,
+                blocking_timeout=settings.amocrm_refresh_lock_timeout, thread_local=False)
+        with _lock:
+            self._local_lock = _local_locks.setdefault(
+                client_id, threading.Lock())
+        self._acquired_redis = False
+
+    def acquire(self) -> None:
+        self._local_lock.acquire()
+        if self._redis_lock is None:
+            return
+        try:
+            self._acquired_redis = self._redis_lock.acquire()
+        except RedisError as e:
+            logger.warning(f"Redis refresh lock unavailable: {e}")
+        if not self._acquired_redis:
+            logger.warning("Refresh lock not acquired, refreshing without it")
+
+    def release(self) -> None:
+        if self._acquired_redis:
+            try:
+                self._redis_lock.release()
+            except RedisError as e:
+                logger.warning(f"Redis refresh lock release failed: {e}")
+            self._acquired_redis = False
+        self._local_lock.release()
+
+    def __enter__(self) -> "RefreshLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+def save_token_expires_at(client_id: str, expires_at: float) -> None:
+    """Сохранить время истечения access token, чтобы его видели все процессы"""
+
+    _local_expires_at[client_id] = expires_at
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        redis.set(f"amocrm:token_expires_at:{client_id}", expires_at)
+    except RedisError as e:
+        logger.warning(f"Redis unavailable, token expiry kept locally: {e}")
+
+
+def get_token_expires_at(client_id: str) -> Union[float, None]:
+    """Получить время истечения access token, если оно известно"""
+
+    redis = get_redis()
+    if redis is not None:
+        try:
+            value = redis.get(f"amocrm:token_expires_at:{client_id}")
+            if value is not None:
+                return float(value)
+        except RedisError as e:
+            logger.warning(f"Redis unavailable, using local token expiry: {e}")
+    return _local_expires_at.get(client_id)
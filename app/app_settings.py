@@ -1,6 +1,6 @@
 from functools import lru_cache
 from pydantic import BaseSettings, PostgresDsn
-from typing import List
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -11,6 +11,43 @@ class Settings(BaseSettings):
     client_secret: str
     lead_paid_field: int
     company_last_payment_field: int
+    redis_url: Optional[str] = None
+
+    # Пул соединений к amoCRM
+    amocrm_pool_size: int = 10
+    amocrm_connect_timeout: float = 5
+    amocrm_read_timeout: float = 30
+    # Сколько страниц асинхронный клиент запрашивает одновременно
+    amocrm_concurrency: int = 4
+
+    # Лимит amoCRM - не более 7 запросов в секунду на интеграцию
+    amocrm_rps: float = 7
+    amocrm_burst: int = 7
+    # Сколько токенов bucket придерживает для запросов хуков
+    amocrm_priority_reserve: float = 2
+
+    # Повторы запросов при 429 и 5xx
+    amocrm_max_retries: int = 5
+    amocrm_retry_base_delay: float = 1
+    amocrm_retry_max_delay: float = 60
+
+    # Обновлять токен заранее, за столько секунд до истечения
+    amocrm_token_refresh_margin: float = 300
+    amocrm_refresh_lock_timeout: float = 60
+
+    # Окно, за которое хуки по одним сущностям сливаются в один пересчет, 0 - без окна
+    hook_debounce_window: float = 5
+
+    # Сколько секунд хранить кастомные поля для виджета
+    custom_fields_cache_ttl: float = 300
+
+    # На сколько шардов делить список сущностей в шардированной проверке
+    check_shards: int = 4
+    # Конвейер полной проверки: потоков расчета и размер очередей между стадиями (в страницах)
+    check_pipeline_evaluators: int = 2
+    check_pipeline_queue_size: int = 4
+    # Сколько секунд живет отметка запущенной проверки без продления (см. CheckLock)
+    check_lock_ttl: int = 120
 
 
 @lru_cache
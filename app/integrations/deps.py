@@ -1,6 +1,8 @@
 from fastapi import HTTPException, Depends
 
 from app.amocrm.base import AmoCRM
+from app.amocrm.async_base import AsyncAmoCRM
+from app.amocrm.rate_limit import PRIORITY_HIGH
 from app.database import get_session
 from app.app_settings import get_settings
 from . import services
@@ -51,14 +53,22 @@ def get_amocrm(
     return services.make_amocrm(session, integration)
 
 
-def get_amocrm_from_first_integration() -> AmoCRM:
+def get_async_amocrm(
+    session: Session = Depends(get_session),
+    integration: Integration = Depends(get_integration),
+) -> AsyncAmoCRM:
+    """Создать инстанс AsyncAmoCRM по интеграции из x-auth-token"""
+    return services.make_async_amocrm(session, integration)
+
+
+def get_amocrm_from_first_integration(priority: str = PRIORITY_HIGH) -> AmoCRM:
     """Получить объект AmoCRM из первой интеграции (без запроса от AmoCRM-виджета)"""
 
     session = next(get_session())
     integration = services.get_first_integration(session)
     if integration is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    return services.make_amocrm(session, integration)
+    return services.make_amocrm(session, integration, priority)
 
 
 def get_logger() -> Logger:
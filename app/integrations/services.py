@@ -1,11 +1,14 @@
 from app.amocrm.base import AmoCRM
+from app.amocrm.async_base import AsyncAmoCRM
+from app.amocrm.rate_limit import PRIORITY_HIGH
 from app.settings.ids_setter import StageIdsSetter
 from .schemas import IntegrationInstall, Integration, IntegrationUpdate
 from app.app_settings import get_settings
+from app.database import engine
 
 from sqlmodel import Session
 
-from typing import List, Union
+from typing import Callable, List, Tuple, Union
 
 
 def get_integration(session: Session, client_id: str) -> Union[Integration, None]:
@@ -52,7 +55,23 @@ def delete_integration(session: Session, client_id: str) -> None:
     session.flush()
 
 
-def make_amocrm(session: Session, integration: Integration) -> AmoCRM:
+def make_token_loader(client_id: str) -> Callable[[], Tuple[str, str]]:
+    """
+    Создать функцию чтения актуальных токенов интеграции из базы. Читает в отдельной
+    сессии, чтобы увидеть токены, закомиченные другим процессом
+    """
+
+    def load_tokens() -> Tuple[Union[str, None], Union[str, None]]:
+        with Session(engine) as session:
+            integration = get_integration(session, client_id)
+            if integration is None:
+                return None, None
+            return integration.access_token, integration.refresh_token
+
+    return load_tokens
+
+
+def make_amocrm(session: Session, integration: Integration, priority: str = PRIORITY_HIGH) -> AmoCRM:
     """Создать инстанс AmoCRM для интеграции с хуком на обновление токенов"""
 
     def on_auth_handler(client_id: str, access_token: str, refresh_token: str, instance: AmoCRM):
@@ -74,4 +93,37 @@ def make_amocrm(session: Session, integration: Integration) -> AmoCRM:
         access_token=integration.access_token,
         refresh_token=integration.refresh_token,
         on_auth=on_auth_handler,
+        on_token_load=make_token_loader(integration.client_id),
+        priority=priority,
+    )
+
+
+def make_async_amocrm(session: Session, integration: Integration, priority: str = PRIORITY_HIGH) -> AsyncAmoCRM:
+    """
+    Создать инстанс AsyncAmoCRM для интеграции. После обновления токенов настройка
+    этапов и хука выполняется синхронным клиентом, обработчик запускается вне event loop
+    """
+
+    def on_auth_handler(client_id: str, access_token: str, refresh_token: str, instance: AsyncAmoCRM):
+        data = IntegrationUpdate(
+            access_token=access_token, refresh_token=refresh_token)
+        update_integration(session, integration, data)
+        amocrm = make_amocrm(session, integration, priority)
+        setter = StageIdsSetter(amocrm, session)
+        setter.set_ids()
+        amocrm.create_hook()
+        session.commit()
+
+    settings = get_settings()
+
+    return AsyncAmoCRM(
+        account=integration.account,
+        client_id=integration.client_id,
+        client_secret=settings.client_secret,
+        redirect_url=f"{settings.app_host}integrations/install/",
+        access_token=integration.access_token,
+        refresh_token=integration.refresh_token,
+        on_auth=on_auth_handler,
+        on_token_load=make_token_loader(integration.client_id),
+        priority=priority,
     )
@@ -10,6 +10,8 @@ from app.integrations.deps import get_amocrm_from_first_integration
 from app.settings.routes import router as settings_router
 from app.settings import services
 from app.settings.ids_setter import StageIdsSetter
+from app.settings.checkpoint import get_checkpoints
+from app.amocrm.http_pool import close_async_http_session
 from sqlmodel import SQLModel, Session
 from .database import engine
 
@@ -29,8 +31,10 @@ app.add_middleware(
 async def on_startup():
     SQLModel.metadata.create_all(engine)
     session = Session(engine)
-    services.set_company_check_status(session, False)
-    services.set_contact_check_status(session, False)
+    # Прерванные проверки продолжит воркер при старте, их статус не сбрасываем
+    interrupted = {checkpoint.name for checkpoint in get_checkpoints(session)}
+    services.set_company_check_status(session, bool(interrupted & {"companies", "full"}))
+    services.set_contact_check_status(session, bool(interrupted & {"contacts", "full"}))
     session.commit()
     try:
         amocrm = get_amocrm_from_first_integration()
@@ -40,6 +44,11 @@ async def on_startup():
         pass
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await close_async_http_session()
+
+
 """Для отображения docs, в силу того что дефолтный cdn не подгружается"""
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
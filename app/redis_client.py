@@ -0,0 +1,16 @@
+from functools import lru_cache
+from typing import Union
+
+from redis import Redis
+
+from .app_settings import get_settings
+
+
+@lru_cache
+def get_redis() -> Union[Redis, None]:
+    """Получить клиент Redis, если он настроен (REDIS_URL), иначе None"""
+
+    redis_url = get_settings().redis_url
+    if redis_url is None:
+        return None
+    return Redis.from_url(redis_url)
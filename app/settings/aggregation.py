@@ -0,0 +1,98 @@
+from app.amocrm.helpers import (check_lead_is_in_success_stage,
+                                check_lead_younger_than,
+                                check_lead_is_active)
+from app.amocrm.records import LeadRecord
+from .mirror import LeadsMirror
+from .schemas import StageIds
+
+from itertools import chain
+from typing import Dict, Generator, Iterable, List
+
+
+class EntityAggregate:
+    """
+    Итоги по сделкам одной сущности: сумма и количество успешных, активные сделки.
+    statuses - заранее посчитанные значения Статуса клиента по полям, если есть,
+    lead_fields - текущие поля активных сделок {lead_id: {field_id: value}}
+    """
+
+    def __init__(self, sum_: int = 0, amount: int = 0, active_leads: List[int] = None,
+                 statuses: Dict[int, str] = None, lead_fields: Dict[int, dict] = None) -> None:
+        self.sum = sum_
+        self.amount = amount
+        self.active_leads: List[int] = active_leads if active_leads is not None else []
+        self.statuses = statuses
+        self.lead_fields: Dict[int, dict] = lead_fields if lead_fields is not None else {}
+
+    def add_success(self, price: int) -> None:
+        self.sum += price
+        self.amount += 1
+
+
+class LeadsAggregator:
+    """
+    Собирает итоги для всех контактов и компаний за один проход по сделкам.
+    Месяцы в настройках контакта и компании могут отличаться, поэтому
+    сделка классифицируется отдельно для каждого типа сущности
+    """
+
+    def __init__(self, stage_ids: StageIds, contact_months: int, company_months: int) -> None:
+        self._stage_ids = stage_ids
+        self._contact_months = contact_months
+        self._company_months = company_months
+        self.contacts: Dict[int, EntityAggregate] = {}
+        self.companies: Dict[int, EntityAggregate] = {}
+
+    def add_to(self, aggregates: Dict[int, EntityAggregate], entity_ids: Iterable[int], lead: LeadRecord, months: int) -> None:
+        """Учесть сделку в итогах сущностей одного типа"""
+
+        if not entity_ids:
+            return
+        if check_lead_is_in_success_stage(lead, self._stage_ids) and check_lead_younger_than(lead, months):
+            for entity_id in entity_ids:
+                aggregates.setdefault(
+                    entity_id, EntityAggregate()).add_success(lead.price)
+        elif check_lead_is_active(lead, self._stage_ids):
+            for entity_id in entity_ids:
+                aggregate = aggregates.setdefault(entity_id, EntityAggregate())
+                aggregate.active_leads.append(lead.id)
+                aggregate.lead_fields[lead.id] = lead.fields
+
+    def add(self, lead: LeadRecord) -> None:
+        """Учесть сделку в итогах ее контактов и компаний"""
+
+        self.add_to(self.contacts, lead.contact_ids, lead, self._contact_months)
+        self.add_to(self.companies, lead.company_ids, lead, self._company_months)
+
+    def collect(self, mirror: LeadsMirror) -> "LeadsAggregator":
+        """
+        Пройти по сделкам, которые могут повлиять на итоги: успешным в окне
+        наибольшего из сроков и активным. Фильтрация происходит в запросах к локальной
+        копии сделок, сделка из обеих выборок учитывается один раз
+        """
+
+        for lead in self.iter_leads(mirror):
+            self.add(lead)
+        return self
+
+    def iter_leads(self, mirror: LeadsMirror) -> Generator[LeadRecord, None, None]:
+        """Сделки успешные в окне и активные, без повторов"""
+
+        months = max(int(self._contact_months), int(self._company_months))
+        seen = set()
+        for lead in chain(mirror.get_success_leads_since(self._stage_ids, months),
+                          mirror.get_active_leads(self._stage_ids)):
+            if lead.id in seen:
+                continue
+            seen.add(lead.id)
+            yield lead
+
+
+def aggregate_entities(leads: Iterable[LeadRecord], entity: str, stage_ids: StageIds,
+                       months: int) -> Dict[int, EntityAggregate]:
+    """Итоги для сущностей одного типа (contacts | companies) по сделкам, связанным с ними"""
+
+    aggregator = LeadsAggregator(stage_ids, contact_months=months, company_months=months)
+    for lead in leads:
+        aggregator.add(lead)
+    return getattr(aggregator, entity)
@@ -0,0 +1,165 @@
+from .schemas import CheckCheckpoint
+from app.app_settings import get_settings
+from app.database import engine
+from app.redis_client import get_redis
+
+import threading
+import time
+from redis.exceptions import LockError, RedisError
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import Session
+from typing import List, Union
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+# Порядок типов сущностей в полной проверке
+ENTITY_ORDER = ("contacts", "companies")
+
+
+def get_checkpoints(session: Session) -> List[CheckCheckpoint]:
+    """Все сохраненные точки возобновления - проверки, которые не дошли до конца"""
+
+    return session.query(CheckCheckpoint).all()
+
+
+class Checkpoint:
+    """
+    Точка возобновления одной проверки (contacts | companies | full): тип сущностей,
+    следующая страница, сколько сущностей проверено и неотправленные обновления.
+    Сохраняется после каждой страницы и удаляется, когда проверка дошла до конца
+    """
+
+    def __init__(self, session: Session, name: str, version: int) -> None:
+        self._session = session
+        self.name = name
+        self.version = version
+        self._instance: Union[CheckCheckpoint, None] = session.query(
+            CheckCheckpoint).where(CheckCheckpoint.name == name).first()
+        # Время начала проверки, при возобновлении - начало прерванной
+        self.started_at = int(time.time())
+        if self._instance is not None and self._instance.version != version:
+            # Уже проверенные страницы считались по другим настройкам
+            logger.info(f"Settings changed, restarting {name} check from scratch")
+            self.clear()
+        if self._instance is not None:
+            self.started_at = self._instance.started_at
+            logger.info(f"Resuming {name} check from {self._instance.entity} "
+                        f"page {self._instance.page}, {self._instance.processed} processed")
+
+    @property
+    def exists(self) -> bool:
+        """Есть прерванная проверка, которую нужно продолжить"""
+
+        return self._instance is not None
+
+    def is_done(self, entity: str) -> bool:
+        """Сущности этого типа уже проверены до прерывания (для полной проверки)"""
+
+        if self._instance is None:
+            return False
+        return ENTITY_ORDER.index(entity) < ENTITY_ORDER.index(self._instance.entity)
+
+    def get_position(self, entity: str) -> tuple:
+        """Страница, количество проверенных и неотправленные обновления для типа сущностей"""
+
+        if self._instance is None or self._instance.entity != entity:
+            return 1, 0, {}
+        return self._instance.page, self._instance.processed, self._instance.pending or {}
+
+    def save(self, entity: str, page: int, processed: int, pending: dict) -> None:
+        """Сохранить позицию и сразу закоммитить, чтобы она пережила перезапуск воркера"""
+
+        fields = {"entity": entity, "page": page, "processed": processed, "pending": pending,
+                  "version": self.version, "started_at": self.started_at, "updated_at": int(time.time())}
+        if self._instance is None:
+            self._instance = CheckCheckpoint.create(self._session, name=self.name, **fields)
+        else:
+            self._instance.update(self._session, **fields)
+        self._session.commit()
+
+    def clear(self) -> None:
+        """Удалить точку возобновления, проверка завершена или начинается заново"""
+
+        if self._instance is not None:
+            self._session.delete(self._instance)
+            self._session.commit()
+            self._instance = None
+            self.started_at = int(time.time())
+
+
+class CheckLock:
+    """
+    Отметка, что проверка name сейчас идет. С Redis - блокировка с TTL, без Redis -
+    свежий updated_at ее чекпоинта. Владелец продлевает отметку из фонового потока,
+    у упавшего воркера она истекает через check_lock_ttl
+    """
+
+    prefix = "checks:running"
+
+    def __init__(self, name: str, ttl: int = None) -> None:
+        self.name = name
+        self.ttl = ttl or get_settings().check_lock_ttl
+        redis = get_redis()
+        self._redis_lock = None if redis is None else redis.lock(
+            f"{self.prefix}:{name}", timeout=self.ttl, thread_local=False)
+        self.acquired = False
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def is_held(self) -> bool:
+        """Проверку сейчас ведет живой воркер"""
+
+        if self._redis_lock is not None:
+            try:
+                return self._redis_lock.locked()
+            except RedisError as e:
+                logger.warning(f"Redis unavailable, checking {self.name} heartbeat instead: {e}")
+        with Session(engine) as session:
+            instance = session.query(CheckCheckpoint).where(CheckCheckpoint.name == self.name).first()
+            return instance is not None and instance.updated_at > time.time() - self.ttl
+
+    def acquire(self) -> bool:
+        """Занять отметку без ожидания. False - проверку уже ведет другой воркер"""
+
+        if self._redis_lock is not None:
+            try:
+                self.acquired = self._redis_lock.acquire(blocking=False)
+            except RedisError as e:
+                logger.warning(f"Redis unavailable, running {self.name} check on heartbeat only: {e}")
+                self._redis_lock = None
+        if self._redis_lock is None:
+            self.acquired = not self.is_held()
+        if self.acquired:
+            self._thread = threading.Thread(target=self.heartbeat, daemon=True)
+            self._thread.start()
+        return self.acquired
+
+    def heartbeat(self) -> None:
+        """Продлевать отметку, пока проверка идет"""
+
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if self._redis_lock is not None:
+                    self._redis_lock.reacquire()
+                else:
+                    with Session(engine) as session:
+                        session.execute(update(CheckCheckpoint.__table__)
+                                        .where(CheckCheckpoint.__table__.c.name == self.name)
+                                        .values(updated_at=int(time.time())))
+                        session.commit()
+            except (LockError, RedisError, SQLAlchemyError) as e:
+                logger.warning(f"Check {self.name} heartbeat failed: {e}")
+
+    def release(self) -> None:
+        if not self.acquired:
+            return
+        self._stop.set()
+        self._thread.join()
+        if self._redis_lock is not None:
+            try:
+                self._redis_lock.release()
+            except (LockError, RedisError) as e:
+                logger.warning(f"Check {self.name} lock release failed: {e}")
+        self.acquired = False
@@ -0,0 +1,77 @@
+from app.app_settings import get_settings
+from app.redis_client import get_redis
+
+from redis import Redis
+from redis.exceptions import RedisError
+from typing import Dict, Iterable, Union
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+# Типы сущностей, которые пересчитываются по хукам
+ENTITIES = ("contacts", "companies")
+
+
+class HookDebouncer:
+    """
+    Копит сущности, затронутые хуками, в Redis: {entity_id: сколько хуков}.
+    Первый хук окна планирует пересчет через window секунд, остальные хуки окна
+    только добавляют сущности - каждая пересчитается один раз
+    """
+
+    prefix = "hooks:debounce"
+
+    def __init__(self, redis: Redis, window: float) -> None:
+        self._redis = redis
+        self.window = window
+
+    @classmethod
+    def from_settings(cls) -> Union["HookDebouncer", None]:
+        """Без Redis или с нулевым окном хуки обрабатываются сразу"""
+
+        redis = get_redis()
+        window = get_settings().hook_debounce_window
+        if redis is None or window <= 0:
+            return None
+        return cls(redis, window)
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    def add(self, entity_ids: Dict[str, Iterable[int]]) -> Union[bool, None]:
+        """
+        Добавить сущности хука. True - это первый хук окна и нужно запланировать
+        пересчет, False - пересчет уже запланирован, None - Redis недоступен
+        """
+
+        try:
+            pipeline = self._redis.pipeline()
+            pipeline.incr(self.key("events"))
+            for entity in ENTITIES:
+                for entity_id in entity_ids.get(entity, ()):
+                    pipeline.hincrby(self.key(entity), entity_id, 1)
+            pipeline.execute()
+            # Флаг живет дольше окна, чтобы потерянный пересчет не блокировал новые
+            return bool(self._redis.set(self.key("scheduled"), 1, nx=True,
+                                        ex=int(self.window) + 60))
+        except RedisError as e:
+            logger.warning(f"Redis unavailable, handling hook without debounce: {e}")
+            return None
+
+    def pop(self) -> dict:
+        """
+        Забрать накопленное: {"events": ..., "contacts": {id: хуков}, "companies": {...}}.
+        Флаг снимается до чтения: хук после этого момента запланирует новый пересчет
+        """
+
+        self._redis.delete(self.key("scheduled"))
+        pipeline = self._redis.pipeline()
+        pipeline.getdel(self.key("events"))
+        for entity in ENTITIES:
+            pipeline.hgetall(self.key(entity))
+            pipeline.delete(self.key(entity))
+        events, *results = pipeline.execute()
+        pending = {"events": int(events or 0)}
+        for entity, counts in zip(ENTITIES, results[::2]):
+            pending[entity] = {int(entity_id): int(count) for entity_id, count in counts.items()}
+        return pending
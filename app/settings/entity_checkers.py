@@ -3,11 +3,18 @@ from app.logger import logger as app_logger
 from abc import ABC, abstractmethod
 
 from .schemas import CompanySetting, ContactSetting, StatusSetting
-from . import services
+from .aggregation import EntityAggregate
+from .checkpoint import Checkpoint
+from .pipeline import CheckPipeline
+from .snapshot import SettingsSnapshot, get_settings_snapshot
+from .status_index import StatusIndex
+from app.amocrm.base import AmoCRM
 from app.amocrm.managers import EntityManager, LeadManager
+from app.amocrm.records import EntityRecord
+from app.amocrm.helpers import make_many_entities_patch_request_data
 from sqlmodel import Session
 
-from typing import List, Union, Tuple
+from typing import Dict, Iterable, List, Union, Tuple
 
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
@@ -16,15 +23,26 @@ logger = get_task_logger(__name__)
 class EntityChecker(ABC):
     """Базовый класс для проверки сущностей на соответствие настройкам"""
 
-    def __init__(self, manager: EntityManager, lead_manager: LeadManager, session: Session) -> None:
-        self._setting: CompanySetting = None
-        self._status_settings: List[StatusSetting] = None
-        # [{"id": ..., "field_id": ..., "value": ...}, ...]
-        self._update_values = []
-        self._update_leads_values = []
+    # Сколько сущностей отправлять в одном PATCH запросе
+    chunk_size = AmoCRM.MAX_LIMIT
+    # Тип сущностей: contacts | companies
+    entity: str
+    # Отправлять полные пакеты сразу. Без этого обновления только копятся (стадия расчета конвейера)
+    auto_flush = True
+
+    def __init__(self, manager: EntityManager, lead_manager: LeadManager, session: Session,
+                 snapshot: SettingsSnapshot = None) -> None:
+        # Все настройки берутся из снимка, во время проверки к базе не обращаемся
+        self._snapshot = snapshot or get_settings_snapshot(session)
+        # {entity_id: {field_id: value, ...}, ...}
+        self._update_values: Dict[int, Dict[int, Union[str, int]]] = {}
+        # {lead_id: {"id": ..., "field_id": ..., "value": ...}, ...}
+        self._update_leads_values: Dict[int, dict] = {}
         self._lead_manager = lead_manager
         self._manager = manager
         self._session = session
+        # Сколько сущностей и сделок отправлено на обновление
+        self.sent = {"entities": 0, "leads": 0}
 
     @property
     @abstractmethod
@@ -38,134 +56,226 @@ class EntityChecker(ABC):
         """Настройки со страницы Статус клиента"""
         pass
 
+    @property
+    @abstractmethod
+    def status_index(self) -> StatusIndex:
+        """Настройки со страницы Статус клиента, скомпилированные для поиска"""
+        pass
+
     def set_field(self, entity_id, field_id, value) -> dict:
         """Установить поле сущности. Паттерн Стратегия для менеджера сущности"""
         return self._manager.set_field(entity_id, field_id, value)
 
-    def set_many_fields(self) -> None:
-        """Установить поля для нескольких сущностей."""
+    def flush_values(self) -> None:
+        """Отправить накопленные обновления сущностей"""
 
         if len(self._update_values) > 0:
-            self._manager.set_many_fields(self._update_values)
-            self._update_values = []
+            self._manager.set_many_fields(
+                make_many_entities_patch_request_data(self._update_values))
+            self.sent["entities"] += len(self._update_values)
+            self._update_values = {}
 
-    def get_success_leads(self, entity_id: int, months: int) -> Tuple[List[dict], List[int], Union[int, None]]:
-        """Получить успешные сделки сущности контакт или компания"""
-        return self._manager.get_success_leads(entity_id, months)
+    def flush_leads_values(self) -> None:
+        """Отправить накопленные обновления сделок"""
 
-    def update_active_leads(self, leads: List[int], value: int) -> None:
-        """Обновить поля активных сделок"""
+        if len(self._update_leads_values) > 0:
+            self._lead_manager.set_many_fields(
+                list(self._update_leads_values.values()))
+            self.sent["leads"] += len(self._update_leads_values)
+            self._update_leads_values = {}
 
+    def set_many_fields(self) -> None:
+        """Установить поля для нескольких сущностей, отправив все, что еще не отправлено"""
+
+        self.flush_values()
+        self.flush_leads_values()
+
+    def dump_pending(self) -> dict:
+        """Неотправленные обновления в виде для JSON, ключи JSON - строки"""
+
+        return {
+            "values": {str(entity_id): {str(field_id): value for field_id, value in fields.items()}
+                       for entity_id, fields in self._update_values.items()},
+            "leads": list(self._update_leads_values.values()),
+        }
+
+    def load_pending(self, pending: dict) -> None:
+        """Восстановить неотправленные обновления из dump_pending"""
+
+        self._update_values = {
+            int(entity_id): {int(field_id): value for field_id, value in fields.items()}
+            for entity_id, fields in (pending.get("values") or {}).items()}
+        self._update_leads_values = {
+            int(entry["id"]): entry for entry in pending.get("leads") or []}
+
+    def copy(self, auto_flush: bool = True) -> EntityChecker:
+        """Проверка того же типа с теми же настройками и пустыми обновлениями"""
+
+        checker = type(self)(self._manager, self._lead_manager, self._session, self._snapshot)
+        checker.auto_flush = auto_flush
+        return checker
+
+    def take_pending(self) -> Tuple[dict, dict]:
+        """Забрать накопленные обновления сущностей и сделок, очистив их"""
+
+        pending = self._update_values, self._update_leads_values
+        self._update_values, self._update_leads_values = {}, {}
+        return pending
+
+    def add_pending(self, pending: Tuple[dict, dict]) -> None:
+        """Добавить обновления из take_pending другой проверки, полные пакеты отправляются"""
+
+        values, leads = pending
+        for entity_id, fields in values.items():
+            for field_id, value in fields.items():
+                self.update_or_append_values(entity_id, field_id, value)
+        for lead_id, entry in leads.items():
+            self._update_leads_values[lead_id] = entry
+            if self.auto_flush and len(self._update_leads_values) >= self.chunk_size:
+                self.flush_leads_values()
+
+    def get_success_leads(self, entity_id: int, months: int, entity_data: EntityRecord = None) -> Tuple[List[int], List[int]]:
+        """
+        Получить успешные сделки сущности контакт или компания. Если сделки уже
+        пришли вместе с сущностью, повторно она не запрашивается
+        """
+        return self._manager.get_success_leads(entity_id, months, entity_data, self._snapshot.stage_ids)
+
+    def get_lead_fields(self, lead_id: int, lead_fields: Dict[int, dict] = None) -> Union[dict, None]:
+        """Текущие поля сделки: из итогов или из уже запрошенных сделок, None если неизвестны"""
+
+        if lead_fields and lead_id in lead_fields:
+            return lead_fields[lead_id]
+        lead = self._lead_manager.get_cached("leads", lead_id)
+        return None if lead is None else lead.fields
+
+    def update_active_leads(self, leads: List[int], value: int, lead_fields: Dict[int, dict] = None) -> None:
+        """
+        Обновить поля активных сделок. Сделки, где значение уже такое же, не отправляются:
+        лишний PATCH сдвигает updated_at сделки, и инкрементальная проверка сочтет ее измененной
+        """
+
+        field_id = self.setting.lead_field_id
         for lead in leads:
-            self._update_leads_values.append(
-                {"id": lead, "field_id": self.setting.lead_field_id, "value": value})
-        if len(self._update_leads_values) > 0:
-            self._lead_manager.set_many_fields(self._update_leads_values)
-            self._update_leads_values.clear()
+            fields = self.get_lead_fields(lead, lead_fields)
+            current = None if fields is None else fields.get(field_id)
+            if current is not None and str(current) == str(value):
+                continue
+            self._update_leads_values[lead] = {
+                "id": lead, "field_id": self.setting.lead_field_id, "value": value}
+            if self.auto_flush and len(self._update_leads_values) >= self.chunk_size:
+                self.flush_leads_values()
 
     def update_or_append_values(self, entity_id, field_id, value) -> None:
-        """Добавить значение на обновление сущностей"""
-
-        logger.info(f"Update values: {self._update_values}")
-        for update_value in self._update_values:
-            if update_value["id"] == entity_id:
-                update_value["custom_fields_values"].append(
-                    {"field_id": field_id, "values": [{"value": value}]})
-                return
-        self._update_values.append(
-            {"id": entity_id, "custom_fields_values": [{"field_id": field_id, "values": [{"value": value}]}]})
-
-    def set_field_if_different(self, entity_id: int, field_id: int, value: Union[str, int], entity_data) -> None:
+        """
+        Добавить значение на обновление сущностей. Полный пакет отправляется перед
+        новой сущностью, а не после ее первого поля, чтобы поля одной сущности
+        не разошлись по разным PATCH запросам
+        """
+
+        if (self.auto_flush and entity_id not in self._update_values
+                and len(self._update_values) >= self.chunk_size):
+            self.flush_values()
+        self._update_values.setdefault(entity_id, {})[field_id] = value
+
+    def set_field_if_different(self, entity_id: int, field_id: int, value: Union[str, int],
+                               entity_data: EntityRecord) -> None:
         """Добавить значение на обновление, если оно отлично от текущего"""
 
         try:
-            if entity_data["custom_fields_values"] is None:
+            current = entity_data.fields.get(int(field_id))
+            # если нет полей с таким id, значение тоже отправляется
+            if current is None or str(current) != str(value):
                 self.update_or_append_values(
                     entity_id, field_id, value)
-                return
-            for custom_field in entity_data["custom_fields_values"]:
-                if int(custom_field["field_id"]) == int(field_id):
-                    if str(custom_field["values"][0]["value"]) != str(value):
-                        self.update_or_append_values(
-                            entity_id, field_id, value)
-                    else:
-                        logger.info(
-                            f"\nValues equal: {custom_field['values'][0]['value']} == {value}")
-                        app_logger.info(
-                            f"\nValues equal: {custom_field['values'][0]['value']} == {value}")
-                    return
-            # если нет полей с таким id
-            # self._update_values.append(
-            #     {"id": entity_id, "field_id": field_id, "value": value})
-            self.update_or_append_values(
-                entity_id, field_id, value)
-        except TypeError:
+            else:
+                logger.info(
+                    f"\nValues equal: {current} == {value}")
+                app_logger.info(
+                    f"\nValues equal: {current} == {value}")
+        except (AttributeError, TypeError):
             logger.info(
                 f"\nTypeError:\nentity_id: {entity_id}\nvalue: {value}\n\ndata:\n{entity_data}\n\n\n")
 
-    def apply_one_status_setting(self, entity_id: int, status_setting: StatusSetting, comparison_value: int, entity_data) -> None:
-        """Сравнить переданное значение с настройкой Статуса клиента и добавить на обновление в случае успеха"""
+    def apply_status_settings(self, entity_id: int, sum_: int, amount: int, entity_data: EntityRecord,
+                              statuses: Dict[int, str] = None) -> None:
+        """
+        Найти статус для каждого поля Статуса клиента по сумме или количеству и добавить
+        на обновление. Статусы могут быть уже посчитаны пакетно, тогда поиск не нужен
+        """
 
         logger.info(
-            f"Applying one status setting.\nstatus_setting: {status_setting}\n\ncomparison: {comparison_value}\ndata:\n\n{entity_data}\n\n\n")
-
-        if comparison_value <= status_setting.to_amount:
-            if status_setting.from_amount is None:
-                self.set_field_if_different(
-                    entity_id, status_setting.field_id, status_setting.status, entity_data)
-                return
-            if comparison_value >= status_setting.from_amount:
-                self.set_field_if_different(
-                    entity_id, status_setting.field_id, status_setting.status, entity_data)
-
-    def apply_status_settings(self, entity_id: int, sum_: int, amount: int, entity_data) -> None:
-        """Сравнить переданное значение со всеми настройками Статуса клиента в зависимости от типа зависимости"""
-
-        logger.info(
-            f"\n\n\nApplying status settings:\nsum: {sum_}\namount: {amount}\n, data:\n{entity_data}\n\nstatus settings:\n{self.status_settings}\n\n\n")
-        for status_setting in self.status_settings:
-            if status_setting.dependency_type == "quantity":
-                self.apply_one_status_setting(
-                    entity_id, status_setting, amount, entity_data)
-            else:
-                self.apply_one_status_setting(
-                    entity_id, status_setting, sum_, entity_data)
+            f"Applying status settings: entity: {entity_id} sum: {sum_} amount: {amount}")
+        if statuses is None:
+            statuses = self.status_index.lookup(sum_, amount)
+        for field_id, status in statuses.items():
+            self.set_field_if_different(
+                entity_id, field_id, status, entity_data)
 
     @abstractmethod
-    def check(self):
-        """Запустить проверку для сущности"""
+    def apply_totals(self):
+        """Применить настройки к сущности по сумме и количеству успешных сделок"""
 
         pass
 
-    @abstractmethod
-    def run_check(self):
-        """Запустить проверку для всех сущностей"""
+    def check(self, entity_id, entity_data: EntityRecord) -> None:
+        """Запустить проверку для сущности"""
 
-        pass
+        success_leads, active_leads = self.get_success_leads(
+            entity_id, months=self.setting.months, entity_data=entity_data)
+        self.apply_totals(entity_id, entity_data, sum(
+            success_leads), len(success_leads), active_leads)
+
+    def apply_aggregate(self, entity: EntityRecord, aggregates: Dict[int, EntityAggregate]) -> None:
+        """Применить настройки к сущности по ее итогам, у сущности без сделок итоги нулевые"""
+
+        aggregate = aggregates.get(entity.id) or EntityAggregate()
+        self.apply_totals(entity.id, entity, aggregate.sum, aggregate.amount,
+                          aggregate.active_leads, aggregate.statuses, aggregate.lead_fields)
+
+    def run_aggregated_check(self, aggregates: Dict[int, EntityAggregate],
+                             entities: Iterable[EntityRecord] = None,
+                             checkpoint: Checkpoint = None) -> None:
+        """
+        Запустить проверку по заранее собранным итогам сделок, без запросов сделок
+        для каждой сущности. entities - какие сущности проверять, по умолчанию все
+        постранично конвейером: после каждой записанной страницы позиция сохраняется
+        в checkpoint, если он есть
+        """
+
+        if entities is not None:
+            for entity in entities:
+                self.apply_aggregate(entity, aggregates)
+            self.set_many_fields()
+            return
+
+        start_page, processed, pending = (1, 0, {}) if checkpoint is None \
+            else checkpoint.get_position(self.entity)
+        self.load_pending(pending)
+        CheckPipeline(self, aggregates, checkpoint).run(start_page, processed)
 
 
 class CompanyChecker(EntityChecker):
     """Класс для проверки компаний"""
 
+    entity = "companies"
+
     @property
     def setting(self) -> CompanySetting:
-        if self._setting is None:
-            self._setting = services.get_company_setting(self._session)
-        return self._setting
+        return self._snapshot.company_setting
 
     @property
-    def status_settings(self) -> List[StatusSetting]:
-        if self._status_settings is None:
-            self._status_settings = services.get_status_settings_for_company(
-                self._session)
-        return self._status_settings
+    def status_settings(self) -> Tuple[StatusSetting, ...]:
+        return self._snapshot.company_status_settings
 
-    def check(self, company_id, company_data) -> None:
-        success_leads, active_leads = self.get_success_leads(
-            company_id, months=self.setting.months)
-        sum_ = sum(success_leads)
-        amount = len(success_leads)
-        self.apply_status_settings(company_id, sum_, amount, company_data)
+    @property
+    def status_index(self) -> StatusIndex:
+        return self._snapshot.company_status_index
+
+    def apply_totals(self, company_id, company_data, sum_: int, amount: int, active_leads: List[int],
+                     statuses: Dict[int, str] = None, lead_fields: Dict[int, dict] = None) -> None:
+        self.apply_status_settings(
+            company_id, sum_, amount, company_data, statuses)
 
         # if last_full_payment is not None:
         # self.set_field(
@@ -173,41 +283,30 @@ class CompanyChecker(EntityChecker):
 
         self.set_field_if_different(
             company_id, self.setting.company_field_id, sum_, company_data)
-        self.update_active_leads(active_leads, sum_)
-
-    def run_check(self) -> None:
-        for company in self._manager.get_many():
-            self.check(company["id"], company)
-        self.set_many_fields()
+        self.update_active_leads(active_leads, sum_, lead_fields)
 
 
 class ContactChecker(EntityChecker):
     """Класс для проверки контактов"""
 
+    entity = "contacts"
+
     @property
     def setting(self) -> ContactSetting:
-        if self._setting is None:
-            self._setting = services.get_contact_setting(self._session)
-        return self._setting
+        return self._snapshot.contact_setting
 
     @property
-    def status_settings(self) -> List[StatusSetting]:
-        if self._status_settings is None:
-            self._status_settings = services.get_status_settings_for_contact(
-                self._session)
-        return self._status_settings
+    def status_settings(self) -> Tuple[StatusSetting, ...]:
+        return self._snapshot.contact_status_settings
 
-    def check(self, contact_id, contact_data) -> None:
-        success_leads, active_leads = self.get_success_leads(
-            contact_id, months=self.setting.months)
-        sum_ = sum(success_leads)
-        amount = len(success_leads)
-        self.apply_status_settings(contact_id, sum_, amount, contact_data)
+    @property
+    def status_index(self) -> StatusIndex:
+        return self._snapshot.contact_status_index
+
+    def apply_totals(self, contact_id, contact_data, sum_: int, amount: int, active_leads: List[int],
+                     statuses: Dict[int, str] = None, lead_fields: Dict[int, dict] = None) -> None:
+        self.apply_status_settings(
+            contact_id, sum_, amount, contact_data, statuses)
         self.set_field_if_different(
             contact_id, self.setting.contact_field_id, amount, contact_data)
-        self.update_active_leads(active_leads, amount)
-
-    def run_check(self) -> None:
-        for contact in self._manager.get_many():
-            self.check(contact["id"], contact)
-        self.set_many_fields()
+        self.update_active_leads(active_leads, amount, lead_fields)
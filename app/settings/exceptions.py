@@ -0,0 +1,9 @@
+class StatusSettingsValidationError(ValueError):
+    """Класс исключение для пересекающихся или разрывных диапазонов в настройках Статуса клиента"""
+
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(message)
+
+    def __str__(self):
+        return f'Invalid status settings: {self.message}'
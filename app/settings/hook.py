@@ -2,50 +2,50 @@ from __future__ import annotations
 
 from app.amocrm.base import AmoCRM
 from .entity_checkers import ContactChecker, CompanyChecker
+from .snapshot import SettingsSnapshot, get_settings_snapshot
+from .mirror import LeadsMirror
 from app.amocrm.managers import ContactManager, CompanyManager, LeadManager, MetaManager
-from app.amocrm.helpers import get_lead_id_from_data, get_lead_main_contact_id
+from app.amocrm.identity_map import IdentityMap
+from app.amocrm.records import LeadRecord
+from app.amocrm.helpers import get_deleted_lead_ids, get_lead_ids_from_data, get_lead_main_contact_id
 
 from sqlmodel import Session
-from typing import Tuple
+from typing import Dict, Iterable, List, Set
 
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
 
 class HookHandler:
-    """Класс для обработки хука на обновление сделки"""
+    """Класс для обработки хука на обновление сделок"""
 
-    def __init__(self, amocrm: AmoCRM, session: Session) -> None:
-        self.manager = MetaManager(amocrm, session)
+    def __init__(self, amocrm: AmoCRM, session: Session, snapshot: SettingsSnapshot = None) -> None:
+        snapshot = snapshot or get_settings_snapshot(session)
+        # Каждая сущность запрашивается не больше одного раза за обработку хука
+        self.manager = MetaManager(amocrm, session, IdentityMap(), snapshot.lead_field_ids)
         self._contact_checker = ContactChecker(
-            self.manager.contacts, self.manager.leads, session)
+            self.manager.contacts, self.manager.leads, session, snapshot)
         self._company_checker = CompanyChecker(
-            self.manager.companies, self.manager.leads, session)
+            self.manager.companies, self.manager.leads, session, snapshot)
+        self._mirror = LeadsMirror(session)
 
-    # У этого контакта есть только id и ссылка
+    def get_hook_leads(self, data) -> List[LeadRecord]:
+        """Получить все сделки хука одним пакетом"""
 
-    def get_contact_company_id(self, contact_id: int) -> Tuple[str, dict] | Tuple[None, None]:
-        """Получить id компании, прикрепленной к контакту"""
+        return list(self.manager.leads.get_many_by_ids(get_lead_ids_from_data(data)))
 
-        if contact_id is None:
-            return None, None
-        contact_data = self.manager.contacts.get_one(contact_id)
-        contact_companies = contact_data["_embedded"]["companies"]
-        try:
-            return contact_companies[0]["id"], contact_data
-        except IndexError:
-            if contact_data:
-                return None, contact_data
-            return None, None
+    def group_by_entities(self, leads: Iterable[LeadRecord]) -> Dict[str, Set[int]]:
+        """
+        Сгруппировать сделки по сущностям, итоги которых они меняют: основные контакты,
+        компании основных контактов и компании самих сделок
+        """
 
-    def get_main_contact_and_company_ids(self, data) -> Tuple[int, int, dict | None]:
-        """Получить id контакта и id его компании"""
-
-        lead_id = get_lead_id_from_data(data)
-        lead = self.manager.leads.get_one(lead_id)
-        main_contact_id = get_lead_main_contact_id(lead)
-        company_id, contact_data = self.get_contact_company_id(main_contact_id)
-        return main_contact_id, company_id, contact_data
+        contact_ids = {get_lead_main_contact_id(lead) for lead in leads} - {None}
+        company_ids = {company_id for lead in leads for company_id in lead.company_ids}
+        for contact in self.manager.contacts.get_many_by_ids(contact_ids, with_leads=True):
+            if contact.company_ids:
+                company_ids.add(contact.company_ids[0])
+        return {"contacts": contact_ids, "companies": company_ids}
 
     def set_many_fields(self) -> None:
         """Установить сравненные с настройками поля для сущностей"""
@@ -53,14 +53,46 @@ class HookHandler:
         self._company_checker.set_many_fields()
         self._contact_checker.set_many_fields()
 
-    def handle(self, data) -> None:
-        """Провести проверку контакта и компании, если она есть"""
-
-        main_contact_id, company_id, contact_data = self.get_main_contact_and_company_ids(
-            data)
-        if main_contact_id is not None:
-            self._contact_checker.check(main_contact_id, contact_data)
-        if company_id is not None:
-            company_data = self.manager.companies.get_one(company_id)
-            self._company_checker.check(company_id, company_data)
+    def update_mirror(self, data) -> Dict[str, Set[int]]:
+        """
+        Обновить копию сделок: удалить удаленные, записать запрошенные во время хука.
+        Возвращает сущности, от которых сделки отвязались или были удалены
+        """
+
+        unlinked = self._mirror.delete(get_deleted_lead_ids(data))
+        for entity, entity_ids in self._mirror.upsert(self.manager.identity_map.values("leads")).items():
+            unlinked[entity].update(entity_ids)
+        return unlinked
+
+    def resolve(self, data) -> Dict[str, Set[int]]:
+        """
+        Обновить копию сделок и найти контакты и компании, которые нужно пересчитать:
+        связанные со сделками хука и прежних владельцев, от которых сделки ушли
+        """
+
+        leads = self.get_hook_leads(data)
+        entity_ids = self.group_by_entities(leads)
+        for entity, unlinked_ids in self.update_mirror(data).items():
+            entity_ids[entity].update(unlinked_ids)
+        return entity_ids
+
+    def recompute(self, entity_ids: Dict[str, Iterable[int]]) -> None:
+        """
+        Провести проверку контактов и компаний, каждой сущности один раз. Сущности
+        запрашиваются пакетами, обновления уходят одним PATCH на тип сущности
+        """
+
+        for contact in self.manager.contacts.get_many_by_ids(
+                entity_ids.get("contacts", ()), with_leads=True):
+            self._contact_checker.check(contact.id, contact)
+        for company in self.manager.companies.get_many_by_ids(
+                entity_ids.get("companies", ()), with_leads=True):
+            self._company_checker.check(company.id, company)
         self.set_many_fields()
+        logger.info(
+            f"Hook identity map: {self.manager.identity_map.stats()}")
+
+    def handle(self, data) -> None:
+        """Провести проверку всех контактов и компаний, затронутых сделками хука"""
+
+        self.recompute(self.resolve(data))
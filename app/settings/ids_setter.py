@@ -40,21 +40,32 @@ class StageIdsSetter:
     def get_inactive_stage_ids(self) -> List[int]:
         """Получить ids неактивных этапов"""
 
-        inactive_statuses = []
         if self.stage_ids.inactive_stage_ids is None or len(self.stage_ids.inactive_stage_ids) == 0:
+            inactive_statuses = []
             response = self.amocrm.make_request(
                 "get", "api/v4/leads/pipelines")
             for pipeline in response["_embedded"]["pipelines"]:
                 for status in pipeline["_embedded"]["statuses"]:
                     if not status["is_editable"] and not status['id'] in inactive_statuses:
                         inactive_statuses.append(status["id"])
-        self.stage_ids.inactive_stage_ids = inactive_statuses
-        self.session.flush()
+            self.stage_ids.inactive_stage_ids = inactive_statuses
+            self.session.flush()
+
+    def get_current_ids(self) -> tuple:
+        """Текущие id воронки и этапов для сравнения до и после установки"""
+
+        return (self.stage_ids.pipeline_id, self.stage_ids.success_stage_id,
+                tuple(self.stage_ids.inactive_stage_ids or ()))
 
     def set_ids(self) -> None:
+        before = self.get_current_ids()
         self.get_pipeline_id()
         self.get_success_stage_id()
         self.get_inactive_stage_ids()
+        # Версия меняется только вместе с id: иначе каждый старт и обновление токена
+        # сбрасывали бы чекпоинты и отметки инкрементальных проверок
+        if self.get_current_ids() != before:
+            services.bump_settings_version(self.session)
         self.session.commit()
         # update_data = UpdateStageIds(
         #     pipeline_id, success_stage_id, inactive_stage_ids)
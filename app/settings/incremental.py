@@ -0,0 +1,106 @@
+from app.amocrm.helpers import get_created_from
+from app.amocrm.managers import EntityManager
+from .aggregation import aggregate_entities
+from .entity_checkers import EntityChecker
+from .mirror import LINKS, LeadsMirror
+from .snapshot import SettingsSnapshot
+from . import services
+
+import time
+from sqlmodel import Session
+from typing import Set, Union
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+
+def save_check_watermark(session: Session, entity: str, started_at: int, version: int) -> None:
+    """Запомнить начало проверки сущностей и версию настроек, с которыми она прошла"""
+
+    services.set_watermark(session, f"{entity}_check", started_at)
+    services.set_watermark(session, f"{entity}_check_settings", version)
+    # Отвязанные до начала проверки сущности ей уже проверены
+    LeadsMirror(session).prune_unlinked(entity, started_at)
+
+
+class IncrementalCheck:
+    """
+    Проверка только тех сущностей одного типа (contacts | companies), на итоги
+    которых что-то могло повлиять с прошлой проверки: изменены они сами, их сделки
+    или их успешные сделки вышли из окна months. Отметка прошлой проверки
+    хранится отдельно для каждого типа сущности вместе с версией настроек
+    """
+
+    def __init__(self, entity: str, checker: EntityChecker, manager: EntityManager,
+                 session: Session, snapshot: SettingsSnapshot, started_at: int = None) -> None:
+        self._entity = entity
+        self._checker = checker
+        self._manager = manager
+        self._session = session
+        self._snapshot = snapshot
+        self._mirror = LeadsMirror(session)
+        # Изменения во время проверки попадут в следующую, возобновленная
+        # проверка считается начатой тогда же, когда и прерванная
+        self.started_at = started_at or int(time.time())
+
+    @property
+    def watermark_name(self) -> str:
+        return f"{self._entity}_check"
+
+    @property
+    def settings_watermark_name(self) -> str:
+        return f"{self._entity}_check_settings"
+
+    def get_since(self) -> Union[int, None]:
+        """Начало прошлой проверки или None, если нужна полная: ее не было или настройки изменились"""
+
+        since = services.get_watermark(self._session, self.watermark_name)
+        version = services.get_watermark(self._session, self.settings_watermark_name)
+        if since == 0 or version != self._snapshot.version:
+            return None
+        return since
+
+    def get_aged_out_ids(self, since: int) -> Set[int]:
+        """Сущности, успешные сделки которых вышли из окна months с прошлой проверки"""
+
+        months = self._checker.setting.months
+        links = LINKS[self._entity]
+        entity_ids = set()
+        for lead in self._mirror.get_success_leads_created_between(
+                self._snapshot.stage_ids, get_created_from(months, since),
+                get_created_from(months, self.started_at)):
+            entity_ids.update(getattr(lead, links))
+        return entity_ids
+
+    def get_lead_changed_ids(self, since: int) -> Set[int]:
+        """Сущности, сделки которых изменились с прошлой проверки"""
+
+        links = LINKS[self._entity]
+        entity_ids = set()
+        for lead in self._mirror.get_updated_leads(since):
+            entity_ids.update(getattr(lead, links))
+        return entity_ids
+
+    def run(self, since: int) -> int:
+        """Проверить затронутые сущности, копия сделок уже должна быть догнана"""
+
+        entities = {entity.id: entity for entity in self._manager.get_updated_since(since)}
+        updated = len(entities)
+        affected = (set(entities) | self.get_lead_changed_ids(since) | self.get_aged_out_ids(since)
+                    | self._mirror.get_unlinked_ids(self._entity, since))
+        entities.update((entity.id, entity) for entity in self._manager.get_many_by_ids(
+            entity_id for entity_id in affected if entity_id not in entities))
+
+        aggregates = aggregate_entities(
+            self._mirror.get_entity_leads(LINKS[self._entity], list(entities)),
+            self._entity, self._snapshot.stage_ids, self._checker.setting.months)
+        self._checker.run_aggregated_check(aggregates, entities.values())
+
+        logger.info(f"Incremental {self._entity} check since {since}: {len(entities)} checked, "
+                    f"{updated} updated themselves")
+        return len(entities)
+
+    def save(self) -> None:
+        """Запомнить начало этой проверки и версию настроек, с которыми она прошла"""
+
+        save_check_watermark(self._session, self._entity, self.started_at, self._snapshot.version)
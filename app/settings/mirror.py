@@ -0,0 +1,265 @@
+from app.amocrm.base import AmoCRM
+from app.amocrm.helpers import chunked, get_created_from
+from app.amocrm.managers import LeadManager
+from app.amocrm.records import LeadRecord
+from .schemas import MirroredLead, StageIds, UnlinkedEntity
+from . import services
+
+import time
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+from typing import Dict, Generator, Iterable, List, Set
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+# Имя отметки синхронизации сделок в SyncWatermark
+LEADS_WATERMARK = "leads"
+# Прерванный обход: до какого updated_at (сверху вниз) он дошел и какая отметка у него будет
+LEADS_CURSOR = "leads_cursor"
+LEADS_PASS_WATERMARK = "leads_pass"
+# С какого момента удаленные сделки уже убраны из копии
+LEADS_DELETED_WATERMARK = "leads_deleted"
+# Поле связей в копии сделок для каждого типа сущности
+LINKS = {"contacts": "contact_ids", "companies": "company_ids"}
+
+
+def record_to_row(lead: LeadRecord) -> dict:
+    """Запись сделки -> строка таблицы копии"""
+
+    return {
+        "id": lead.id,
+        "price": lead.price,
+        "status_id": lead.status_id,
+        "pipeline_id": lead.pipeline_id,
+        "created_at": lead.created_at,
+        "updated_at": lead.updated_at,
+        "paid": None if lead.paid is None else str(lead.paid),
+        "main_contact_id": lead.main_contact_id,
+        "contact_ids": list(lead.contact_ids),
+        "company_ids": list(lead.company_ids),
+        "fields": {str(field_id): value for field_id, value in lead.fields.items()},
+    }
+
+
+def get_unlinked(old_rows, new_leads: Dict[int, LeadRecord] = None) -> Dict[str, Set[int]]:
+    """
+    Сущности, которые потеряли связь со сделкой: были в старых связях и нет в новых.
+    Без новых сделок (удаление) - все старые связи
+    """
+
+    new_leads = new_leads or {}
+    unlinked = {entity: set() for entity in LINKS}
+    for row in old_rows:
+        lead = new_leads.get(row.id)
+        for entity, links in LINKS.items():
+            unlinked[entity].update(
+                set(getattr(row, links)) - set(getattr(lead, links) if lead is not None else ()))
+    return unlinked
+
+
+def row_to_record(row) -> LeadRecord:
+    """Строка таблицы копии -> запись сделки"""
+
+    return LeadRecord(row.id, row.price, row.status_id, row.pipeline_id, row.created_at,
+                      row.updated_at, row.paid, row.main_contact_id,
+                      tuple(row.contact_ids), tuple(row.company_ids),
+                      {int(field_id): value for field_id, value in (row.fields or {}).items()})
+
+
+class LeadsMirror:
+    """
+    Локальная копия сделок amoCRM и их связей с контактами и компаниями.
+    Догоняется по updated_at с сохраненной отметки и обновляется из хуков,
+    проверки и LeadsAggregator читают сделки только из нее
+    """
+
+    # Сколько сделок записывать в базу одним запросом
+    chunk_size = AmoCRM.MAX_LIMIT
+
+    def __init__(self, session: Session, lead_manager: LeadManager = None) -> None:
+        self._session = session
+        self._lead_manager = lead_manager
+
+    def upsert(self, leads: Iterable[LeadRecord]) -> Dict[str, Set[int]]:
+        """
+        Записать сделки в копию, более старая версия сделки не затирает новую.
+        Возвращает сущности, от которых сделки отвязались: {"contacts": {...}, "companies": {...}}
+        """
+
+        table = MirroredLead.__table__
+        unlinked = {entity: set() for entity in LINKS}
+        for chunk in chunked(leads, self.chunk_size):
+            # В одном INSERT ... ON CONFLICT сделка должна встречаться один раз
+            latest = {}
+            for lead in chunk:
+                if lead.id not in latest or latest[lead.id].updated_at <= lead.updated_at:
+                    latest[lead.id] = lead
+            old_rows = self._session.execute(
+                select(table.c.id, table.c.contact_ids, table.c.company_ids).where(
+                    table.c.id.in_(list(latest)))).all()
+            for entity, entity_ids in get_unlinked(old_rows, latest).items():
+                unlinked[entity].update(entity_ids)
+            statement = insert(table).values(
+                [record_to_row(lead) for lead in latest.values()])
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column.name: statement.excluded[column.name]
+                      for column in table.columns if column.name != "id"},
+                where=table.c.updated_at <= statement.excluded.updated_at)
+            self._session.execute(statement)
+        return unlinked
+
+    def delete(self, lead_ids: List[int]) -> Dict[str, Set[int]]:
+        """Удалить сделки из копии, возвращает сущности, с которыми они были связаны"""
+
+        if not lead_ids:
+            return {entity: set() for entity in LINKS}
+        table = MirroredLead.__table__
+        old_rows = self._session.execute(delete(table).where(table.c.id.in_(lead_ids)).returning(
+            table.c.id, table.c.contact_ids, table.c.company_ids)).all()
+        return get_unlinked(old_rows)
+
+    def save_unlinked(self, unlinked: Dict[str, Set[int]]) -> None:
+        """Запомнить отвязанные сущности для следующих инкрементальных проверок"""
+
+        changed_at = int(time.time())
+        rows = [{"entity": entity, "entity_id": entity_id, "changed_at": changed_at}
+                for entity, entity_ids in unlinked.items() for entity_id in entity_ids]
+        for chunk in chunked(rows, self.chunk_size):
+            self._session.execute(insert(UnlinkedEntity.__table__).values(chunk))
+
+    def get_unlinked_ids(self, entity: str, since: int) -> Set[int]:
+        """Сущности одного типа, от которых сделки отвязались не раньше since"""
+
+        table = UnlinkedEntity.__table__
+        return {row.entity_id for row in self._session.execute(select(table.c.entity_id).where(
+            table.c.entity == entity, table.c.changed_at >= since))}
+
+    def prune_unlinked(self, entity: str, before: int) -> None:
+        """Удалить отвязанные сущности, уже учтенные проверкой, начатой в before"""
+
+        table = UnlinkedEntity.__table__
+        self._session.execute(delete(table).where(
+            table.c.entity == entity, table.c.changed_at < before))
+
+    def sync(self) -> int:
+        """
+        Догнать копию: запросить сделки, измененные начиная с отметки, затем убрать удаленные.
+        Сделки идут от новых к старым, поэтому измененная во время обхода сделка
+        сдвигает страницы назад (повтор), а не вперед (пропуск). Отметка сдвигается
+        после полного обхода, но после каждой записанной пачки сохраняется курсор:
+        прерванный обход (например, первый, по всем сделкам) продолжается с него
+        """
+
+        since = services.get_watermark(self._session, LEADS_WATERMARK)
+        cursor = services.get_watermark(self._session, LEADS_CURSOR) or None
+        if cursor is None:
+            watermark = since
+            if not services.get_watermark(self._session, LEADS_DELETED_WATERMARK):
+                # Удаленные до первого обхода в копию не попадут, сверять их не нужно
+                services.set_watermark(self._session, LEADS_DELETED_WATERMARK, int(time.time()))
+        else:
+            watermark = services.get_watermark(self._session, LEADS_PASS_WATERMARK)
+            logger.info(f"Resuming leads mirror sync from updated_at {cursor}")
+        count = 0
+        # Сделки новее курсора уже записаны, с равным updated_at запрашиваются повторно
+        for chunk in chunked(self._lead_manager.get_updated_since(since, cursor), self.chunk_size):
+            count += len({lead.id for lead in chunk})
+            self.save_unlinked(self.upsert(chunk))
+            watermark = max(watermark, max(lead.updated_at for lead in chunk))
+            services.set_watermark(self._session, LEADS_CURSOR, min(lead.updated_at for lead in chunk))
+            services.set_watermark(self._session, LEADS_PASS_WATERMARK, watermark)
+            self._session.commit()
+        services.set_watermark(self._session, LEADS_WATERMARK, watermark)
+        services.set_watermark(self._session, LEADS_CURSOR, 0)
+        self._session.commit()
+        logger.info(f"Leads mirror synced: {count} leads updated since {since}")
+        self.reconcile_deleted()
+        return count
+
+    def reconcile_deleted(self) -> int:
+        """
+        Убрать из копии сделки, удаленные в amoCRM с прошлой сверки, по событиям lead_deleted.
+        Хук delete_lead мог потеряться, а удаленная сделка иначе так и считалась бы в итогах
+        """
+
+        since = services.get_watermark(self._session, LEADS_DELETED_WATERMARK)
+        started_at = int(time.time())
+        count = 0
+        for chunk in chunked(self._lead_manager.get_deleted_since(since), self.chunk_size):
+            count += len(chunk)
+            self.save_unlinked(self.delete(chunk))
+            self._session.commit()
+        services.set_watermark(self._session, LEADS_DELETED_WATERMARK, started_at)
+        self._session.commit()
+        logger.info(f"Leads mirror reconciled: {count} deleted leads since {since}")
+        return count
+
+    def iter_records(self, statement) -> Generator[LeadRecord, None, None]:
+        """Читать сделки из копии потоком, не загружая всю выборку в память"""
+
+        result = self._session.execute(statement.execution_options(stream_results=True))
+        for row in result:
+            yield row_to_record(row)
+
+    def get_success_leads_created_between(self, stage_ids: StageIds, created_from: int,
+                                          created_to: int = None) -> Generator[LeadRecord, None, None]:
+        """Сделки на успешном этапе, созданные в промежутке [created_from, created_to)"""
+
+        if stage_ids.pipeline_id is None or stage_ids.success_stage_id is None:
+            return
+        table = MirroredLead.__table__
+        statement = select(table).where(
+            table.c.status_id == stage_ids.success_stage_id,
+            table.c.pipeline_id == stage_ids.pipeline_id,
+            table.c.created_at >= created_from)
+        if created_to is not None:
+            statement = statement.where(table.c.created_at < created_to)
+        yield from self.iter_records(statement)
+
+    def get_success_leads_since(self, stage_ids: StageIds, months: int) -> Generator[LeadRecord, None, None]:
+        """Сделки на успешном этапе, созданные не раньше чем months месяцев назад"""
+
+        yield from self.get_success_leads_created_between(stage_ids, get_created_from(months))
+
+    def get_active_leads(self, stage_ids: StageIds) -> Generator[LeadRecord, None, None]:
+        """Сделки на активных этапах всех воронок"""
+
+        table = MirroredLead.__table__
+        statement = select(table)
+        if stage_ids.inactive_stage_ids:
+            statement = statement.where(
+                table.c.status_id.notin_(stage_ids.inactive_stage_ids))
+        yield from self.iter_records(statement)
+
+    def get_many_by_ids(self, lead_ids: Iterable[int]) -> List[LeadRecord]:
+        """Сделки копии по списку id"""
+
+        table = MirroredLead.__table__
+        lead_ids = list(dict.fromkeys(lead_ids))
+        result = []
+        for chunk in chunked(lead_ids, self.chunk_size):
+            result.extend(self.iter_records(
+                select(table).where(table.c.id.in_(chunk))))
+        return result
+
+    def get_updated_leads(self, updated_from: int) -> Generator[LeadRecord, None, None]:
+        """Сделки копии, измененные не раньше updated_from"""
+
+        table = MirroredLead.__table__
+        yield from self.iter_records(
+            select(table).where(table.c.updated_at >= updated_from))
+
+    def get_entity_leads(self, links: str, entity_ids: Iterable[int]) -> Generator[LeadRecord, None, None]:
+        """Сделки, связанные с любой из сущностей, без повторов. links - contact_ids или company_ids"""
+
+        column = MirroredLead.__table__.c[links]
+        seen = set()
+        for chunk in chunked(entity_ids, self.chunk_size):
+            for lead in self.iter_records(
+                    select(MirroredLead.__table__).where(column.overlap(chunk))):
+                if lead.id not in seen:
+                    seen.add(lead.id)
+                    yield lead
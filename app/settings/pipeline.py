@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from app.amocrm.base import AmoCRM
+from app.app_settings import get_settings
+from .aggregation import EntityAggregate
+from .checkpoint import Checkpoint
+
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+if TYPE_CHECKING:
+    from .entity_checkers import EntityChecker
+
+# Конец потока данных для следующей стадии
+DONE = object()
+
+
+class PipelineStats:
+    """Счетчики стадий конвейера для логов: сколько прошло через каждую стадию"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.fetched_pages = 0
+        self.evaluated = 0
+        self.written_pages = 0
+
+    def add(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def as_dict(self, fetch_queue: queue.Queue, write_queue: queue.Queue) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self._lock:
+            return {
+                "fetch_queue": fetch_queue.qsize(),
+                "write_queue": write_queue.qsize(),
+                "fetched_pages": self.fetched_pages,
+                "evaluated": self.evaluated,
+                "written_pages": self.written_pages,
+                "evaluated_per_second": round(self.evaluated / elapsed, 1),
+            }
+
+
+class CheckPipeline:
+    """
+    Проверка всех сущностей конвейером из трех стадий, которые работают одновременно:
+    поток чтения страниц, пул потоков расчета и запись пакетными PATCH запросами.
+    Очереди между стадиями ограничены, поэтому быстрая стадия ждет медленную.
+    Запись идет в вызывающем потоке: только он работает с сессией базы (чекпоинт)
+    """
+
+    def __init__(self, writer: EntityChecker, aggregates: Dict[int, EntityAggregate],
+                 checkpoint: Checkpoint = None, evaluators: int = None, queue_size: int = None) -> None:
+        settings = get_settings()
+        self._writer = writer
+        self._aggregates = aggregates
+        self._checkpoint = checkpoint
+        self._evaluators = evaluators or settings.check_pipeline_evaluators
+        queue_size = queue_size or settings.check_pipeline_queue_size
+        self._fetch_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self.stats = PipelineStats()
+
+    def put(self, target: queue.Queue, item) -> None:
+        """Положить в очередь с ожиданием места, пока конвейер не остановлен"""
+
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fail(self, error: BaseException) -> None:
+        logger.exception(f"Check pipeline stage failed: {error!r}")
+        self._errors.append(error)
+        self._stop.set()
+
+    def produce(self, start_page: int) -> None:
+        """Стадия 1: читать страницы сущностей"""
+
+        try:
+            for page, entities in self._writer._manager.get_pages(
+                    limit=AmoCRM.MAX_LIMIT, with_leads=False, start_page=start_page):
+                if self._stop.is_set():
+                    break
+                self.put(self._fetch_queue, (page, entities))
+                self.stats.add("fetched_pages")
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in range(self._evaluators):
+                self.put(self._fetch_queue, DONE)
+
+    def evaluate(self) -> None:
+        """Стадия 2: посчитать обновления страницы, ничего не отправляя"""
+
+        checker = self._writer.copy(auto_flush=False)
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._fetch_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if item is DONE:
+                    break
+                page, entities = item
+                for entity in entities:
+                    checker.apply_aggregate(entity, self._aggregates)
+                self.stats.add("evaluated", len(entities))
+                self.put(self._write_queue, (page, len(entities), checker.take_pending()))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.put(self._write_queue, DONE)
+
+    def write(self, start_page: int, processed: int) -> None:
+        """
+        Стадия 3: копить обновления и отправлять полными пакетами. Страницы приходят
+        не по порядку, чекпоинт сдвигается до первой еще не записанной страницы
+        """
+
+        next_page = start_page
+        written = set()
+        finished = 0
+        while finished < self._evaluators:
+            try:
+                item = self._write_queue.get(timeout=1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+                continue
+            if item is DONE:
+                finished += 1
+                continue
+            page, count, pending = item
+            self._writer.add_pending(pending)
+            processed += count
+            written.add(page)
+            self.stats.add("written_pages")
+            while next_page in written:
+                written.remove(next_page)
+                next_page += 1
+            if self._checkpoint is not None:
+                self._checkpoint.save(self._writer.entity, next_page, processed,
+                                      self._writer.dump_pending())
+            logger.info(f"Check pipeline {self._writer.entity}: "
+                        f"{self.stats.as_dict(self._fetch_queue, self._write_queue)}")
+
+    def run(self, start_page: int = 1, processed: int = 0) -> None:
+        """Запустить стадии и дождаться, пока все обновления будут отправлены"""
+
+        threads = [threading.Thread(target=self.produce, args=(start_page,), daemon=True)]
+        threads += [threading.Thread(target=self.evaluate, daemon=True)
+                    for _ in range(self._evaluators)]
+        for thread in threads:
+            thread.start()
+        try:
+            self.write(start_page, processed)
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
+        self._writer.set_many_fields()
@@ -1,13 +1,16 @@
-from fastapi import APIRouter, Depends, Request, Response, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse
 
-from app.amocrm.base import AmoCRM
-from app.integrations.deps import get_amocrm, get_session
+from app.amocrm.async_base import AsyncAmoCRM
+from app.integrations.deps import get_async_amocrm, get_session
 from .schemas import ContactSetting, CompanySetting, StatusSetting
 from app.app_settings import get_settings
 from app.settings.schemas import StatusSetting
 from . import services
-from .tasks import company_check, contact_check, handle_hook_on_background
-from app.amocrm.managers import MetaManager
+from .snapshot import invalidate_settings_snapshot
+from .exceptions import StatusSettingsValidationError
+from .tasks import company_check, contact_check, full_check, sharded_check, handle_hook_on_background
+from app.amocrm.async_managers import AsyncMetaManager
 
 from sqlmodel import Session
 from typing import List
@@ -48,7 +51,13 @@ def get_custom_status_settings(session: Session = Depends(get_session)):
 @router.post("/status", status_code=201)
 def save_status_settings(status_settings: List[StatusSetting], session: Session = Depends(get_session)):
     """Сохранить настройки Статуса клиента"""
-    return services.save_status_settings(session, status_settings)
+    try:
+        result = services.save_status_settings(session, status_settings)
+    except StatusSettingsValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.message)
+    invalidate_settings_snapshot(session)
+    return result
 
 
 @router.get("/contact", status_code=200, response_model=ContactSetting)
@@ -60,6 +69,7 @@ def get_contact_setting(session: Session = Depends(get_session)):
 @router.post("/contact", status_code=201)
 def set_contact_setting(contact_setting: ContactSetting, session: Session = Depends(get_session)):
     """Установить настройки для проверки контакта"""
+    invalidate_settings_snapshot(session)
     return services.set_contact_setting(session, contact_setting)
 
 
@@ -72,26 +82,58 @@ def get_company_setting(session: Session = Depends(get_session)):
 @router.post("/company", status_code=201)
 def set_company_setting(company_setting: CompanySetting, session: Session = Depends(get_session)):
     """Установить настройки для проверки компании"""
+    invalidate_settings_snapshot(session)
     return services.set_company_setting(session, company_setting)
 
 
 @router.get("/get-custom-fields")
-def get_entity_fields(amocrm: AmoCRM = Depends(get_amocrm), session: Session = Depends(get_session)):
-    """Получить кастомные поля всех сущностей"""
-    manager = MetaManager(amocrm, session)
-    return manager.get_custom_fields()
+async def get_entity_fields(request: Request, amocrm: AsyncAmoCRM = Depends(get_async_amocrm), session: Session = Depends(get_session)):
+    """Получить кастомные поля всех сущностей, 304 если они не изменились"""
+    manager = AsyncMetaManager(amocrm, session)
+    data, etag = await manager.get_custom_fields_cached()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return JSONResponse(data, headers=headers)
+
+
+@router.post("/reset-custom-fields-cache")
+def reset_custom_fields_cache(amocrm: AsyncAmoCRM = Depends(get_async_amocrm), session: Session = Depends(get_session)):
+    """Сбросить кэш кастомных полей, например после их изменения в amoCRM"""
+    AsyncMetaManager(amocrm, session).invalidate_custom_fields()
 
 
 @router.post("/run-contact-check")
-def run_contact_check():
-    """Запустить проверку контактов"""
-    contact_check.delay()
+def run_contact_check(incremental: bool = False, from_scratch: bool = False):
+    """
+    Запустить проверку контактов, incremental - только затронутых с прошлой проверки,
+    from_scratch - не продолжать прерванную проверку, а начать заново
+    """
+    contact_check.delay(incremental, from_scratch)
 
 
 @router.post("/run-company-check")
-def run_company_check():
-    """Запустить проверку компаний"""
-    company_check.delay()
+def run_company_check(incremental: bool = False, from_scratch: bool = False):
+    """
+    Запустить проверку компаний, incremental - только затронутых с прошлой проверки,
+    from_scratch - не продолжать прерванную проверку, а начать заново
+    """
+    company_check.delay(incremental, from_scratch)
+
+
+@router.post("/run-full-check")
+def run_full_check(from_scratch: bool = False):
+    """
+    Запустить проверку контактов и компаний за один проход по сделкам,
+    from_scratch - не продолжать прерванную проверку, а начать заново
+    """
+    full_check.delay(from_scratch)
+
+
+@router.post("/run-sharded-check")
+def run_sharded_check(shards: int = None):
+    """Запустить полную проверку, разбитую на шарды, которые выполняются на всех воркерах"""
+    sharded_check.delay(shards)
 
 
 @router.post("/handle-hook")
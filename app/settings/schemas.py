@@ -1,5 +1,6 @@
 from app.database import DatabaseModel
 from pydantic import BaseModel
+from sqlalchemy import BigInteger, Index, JSON
 from sqlmodel import Field, ARRAY, Column, Integer
 from typing import Optional, List
 
@@ -48,6 +49,70 @@ class CompanyCheckStatus(DatabaseModel, BaseModel, table=True):
     running: bool = False
 
 
+class SettingsVersion(DatabaseModel, BaseModel, table=True):
+    """Версия настроек, увеличивается при каждом изменении настроек"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = 0
+
+
+class SyncWatermark(DatabaseModel, BaseModel, table=True):
+    """Отметка синхронизации: до какого updated_at данные amoCRM уже получены"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, sa_column_kwargs={"unique": True})
+    value: int = 0
+
+
+class UnlinkedEntity(DatabaseModel, BaseModel, table=True):
+    """
+    Сущность, от которой при синхронизации копии отвязалась сделка: ее итоги
+    нужно пересчитать, хотя по текущим связям копии она не затронута
+    """
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    entity: str = Field(index=True)
+    entity_id: int = Field(sa_column=Column(BigInteger, nullable=False))
+    changed_at: int = Field(index=True)
+
+
+class CheckCheckpoint(DatabaseModel, BaseModel, table=True):
+    """Точка возобновления прерванной проверки"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True, sa_column_kwargs={"unique": True})  # contacts | companies | full
+    entity: str  # contacts | companies, какие сущности сейчас проверяются
+    page: int = 1  # следующая непроверенная страница
+    processed: int = 0
+    version: int  # версия настроек, с которыми проверка началась
+    started_at: int
+    updated_at: int
+    pending: dict = Field(default_factory=dict, sa_column=Column(JSON))
+
+
+class MirroredLead(DatabaseModel, BaseModel, table=True):
+    """Локальная копия сделки amoCRM с ее контактами и компаниями"""
+
+    __table_args__ = (
+        Index("ix_mirroredleads_contact_ids", "contact_ids", postgresql_using="gin"),
+        Index("ix_mirroredleads_company_ids", "company_ids", postgresql_using="gin"),
+    )
+
+    id: int = Field(sa_column=Column(BigInteger, primary_key=True, autoincrement=False))
+    price: int = Field(sa_column=Column(BigInteger, nullable=False))
+    status_id: int = Field(index=True)
+    pipeline_id: int
+    created_at: int = Field(index=True)
+    updated_at: int
+    paid: Optional[str] = None
+    main_contact_id: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    contact_ids: List[int] = Field(sa_column=Column(ARRAY(BigInteger), nullable=False))
+    company_ids: List[int] = Field(sa_column=Column(ARRAY(BigInteger), nullable=False))
+    # Значения полей, которые пишут проверки (lead_field_id настроек), ключи JSON - строки.
+    # После смены lead_field_id поля нет, и значение отправляется, пока сделка не обновится
+    fields: dict = Field(default={}, sa_column=Column(JSON, nullable=False, server_default="{}"))
+
+
 class UpdateStageIds(BaseModel):
     """Схема обновления объекта id и воронок"""
 
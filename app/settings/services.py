@@ -1,4 +1,5 @@
-from .schemas import StatusSetting, ContactSetting, CompanySetting, ContactCheckStatus, CompanyCheckStatus, StageIds, UpdateStageIds
+from .schemas import StatusSetting, ContactSetting, CompanySetting, ContactCheckStatus, CompanyCheckStatus, StageIds, UpdateStageIds, SettingsVersion, SyncWatermark
+from .status_index import validate_status_settings
 from sqlmodel import Session
 from typing import List
 
@@ -21,8 +22,9 @@ def get_status_settings_for_contact(session: Session) -> List[StatusSetting]:
 
 
 def save_status_settings(session: Session, status_settings: List[StatusSetting]) -> List[StatusSetting]:
-    """Сохранить настройки статуса клиента"""
+    """Сохранить настройки статуса клиента, пересекающиеся и разрывные диапазоны не сохраняются"""
 
+    validate_status_settings(status_settings)
     delete_status_settings(session)
     result = []
     for status_setting in status_settings:
@@ -133,3 +135,43 @@ def set_stage_ids(session: Session, update_data: UpdateStageIds) -> StageIds:
         return StageIds.create(session, **update_data.dict())
     instance.update(session, **update_data.dict())
     return instance
+
+
+def get_settings_version(session: Session) -> int:
+    """Получить текущую версию настроек"""
+
+    instance = session.query(SettingsVersion).first()
+    if instance is None:
+        return 0
+    return instance.version
+
+
+def bump_settings_version(session: Session) -> int:
+    """Увеличить версию настроек, чтобы процессы перечитали снимок настроек"""
+
+    instance = session.query(SettingsVersion).first()
+    if instance is None:
+        instance = SettingsVersion.create(session, version=1)
+    else:
+        instance.update(session, version=instance.version + 1)
+    return instance.version
+
+
+def get_watermark(session: Session, name: str) -> int:
+    """Получить отметку синхронизации, 0 если синхронизации еще не было"""
+
+    instance = session.query(SyncWatermark).where(SyncWatermark.name == name).first()
+    if instance is None:
+        return 0
+    return instance.value
+
+
+def set_watermark(session: Session, name: str, value: int) -> SyncWatermark:
+    """Установить отметку синхронизации"""
+
+    instance = session.query(SyncWatermark).where(SyncWatermark.name == name).first()
+    if instance is None:
+        instance = SyncWatermark.create(session, name=name, value=value)
+    else:
+        instance.update(session, value=value)
+    return instance
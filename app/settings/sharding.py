@@ -0,0 +1,50 @@
+from app.amocrm.base import AmoCRM
+from app.amocrm.managers import EntityManager
+from .aggregation import aggregate_entities
+from .entity_checkers import EntityChecker
+from .mirror import LINKS, LeadsMirror
+from .schemas import StageIds
+
+from typing import List
+
+from celery.utils.log import get_task_logger
+logger = get_task_logger(__name__)
+
+
+def run_shard(checker: EntityChecker, manager: EntityManager, mirror: LeadsMirror,
+              stage_ids: StageIds, shard: int, shards: int) -> dict:
+    """
+    Проверить свою часть сущностей: страницы shard + 1, shard + 1 + shards, ...
+    Итоги считаются по копии сделок только для сущностей страницы
+    """
+
+    months = checker.setting.months
+    processed = 0
+    for page, entities in manager.get_pages(limit=AmoCRM.MAX_LIMIT, with_leads=False,
+                                            start_page=shard + 1, step=shards):
+        aggregates = aggregate_entities(
+            mirror.get_entity_leads(LINKS[checker.entity], [entity.id for entity in entities]),
+            checker.entity, stage_ids, months)
+        for entity in entities:
+            checker.apply_aggregate(entity, aggregates)
+        processed += len(entities)
+        logger.info(f"Shard {shard + 1}/{shards} {checker.entity} page {page}: {processed} processed")
+    checker.set_many_fields()
+    return {"entity": checker.entity, "shard": shard, "processed": processed,
+            "entities_sent": checker.sent["entities"], "leads_sent": checker.sent["leads"]}
+
+
+def merge_shard_results(results: List[dict]) -> dict:
+    """Сложить результаты шардов по типам сущностей"""
+
+    totals = {}
+    for result in results:
+        entity_totals = totals.setdefault(result["entity"], {
+            "shards": 0, "processed": 0, "entities_sent": 0, "leads_sent": 0,
+            "requests": 0, "retries": 0})
+        entity_totals["shards"] += 1
+        for key in ("processed", "entities_sent", "leads_sent"):
+            entity_totals[key] += result[key]
+        for key in ("requests", "retries"):
+            entity_totals[key] += result["requests"][key]
+    return totals
@@ -0,0 +1,89 @@
+from .schemas import CompanySetting, ContactSetting, StageIds, StatusSetting
+from .status_index import StatusIndex
+from . import services
+from app.app_settings import get_settings
+
+import threading
+from sqlmodel import Session
+from typing import NamedTuple, Tuple, Union
+
+
+class SettingsSnapshot(NamedTuple):
+    """
+    Неизменяемый снимок настроек для проверок. Объекты отвязаны от сессии,
+    поэтому во время проверки к базе не обращаемся
+    """
+
+    version: int
+    stage_ids: StageIds
+    contact_setting: Union[ContactSetting, None]
+    company_setting: Union[CompanySetting, None]
+    contact_status_settings: Tuple[StatusSetting, ...]
+    company_status_settings: Tuple[StatusSetting, ...]
+    contact_status_index: StatusIndex
+    company_status_index: StatusIndex
+    lead_paid_field: int
+    # Поля сделок, которые пишут проверки контактов и компаний
+    lead_field_ids: Tuple[int, ...]
+
+
+_lock = threading.Lock()
+_snapshot: Union[SettingsSnapshot, None] = None
+
+
+def detach(instance):
+    """Скопировать объект модели без привязки к сессии"""
+
+    if instance is None:
+        return None
+    return instance.__class__(**instance.dict())
+
+
+def load_settings_snapshot(session: Session, version: int) -> SettingsSnapshot:
+    """Прочитать все настройки для проверок из базы"""
+
+    contact_status_settings = tuple(
+        detach(setting) for setting in services.get_status_settings_for_contact(session))
+    company_status_settings = tuple(
+        detach(setting) for setting in services.get_status_settings_for_company(session))
+    contact_setting = detach(services.get_contact_setting(session))
+    company_setting = detach(services.get_company_setting(session))
+    return SettingsSnapshot(
+        version=version,
+        stage_ids=detach(services.get_stage_ids(session)),
+        contact_setting=contact_setting,
+        company_setting=company_setting,
+        contact_status_settings=contact_status_settings,
+        company_status_settings=company_status_settings,
+        contact_status_index=StatusIndex(contact_status_settings),
+        company_status_index=StatusIndex(company_status_settings),
+        lead_paid_field=get_settings().lead_paid_field,
+        lead_field_ids=tuple(sorted({int(setting.lead_field_id)
+                                     for setting in (contact_setting, company_setting)
+                                     if setting is not None})),
+    )
+
+
+def get_settings_snapshot(session: Session) -> SettingsSnapshot:
+    """
+    Получить снимок настроек. Снимок хранится в процессе и перечитывается,
+    только если версия настроек в базе изменилась - это один запрос на задачу
+    """
+
+    global _snapshot
+
+    version = services.get_settings_version(session)
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = load_settings_snapshot(session, version)
+        return _snapshot
+
+
+def invalidate_settings_snapshot(session: Session) -> None:
+    """Отметить, что настройки изменились: все процессы перечитают снимок"""
+
+    global _snapshot
+
+    services.bump_settings_version(session)
+    with _lock:
+        _snapshot = None
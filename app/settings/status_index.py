@@ -0,0 +1,115 @@
+from .schemas import StatusSetting
+from .exceptions import StatusSettingsValidationError
+
+from bisect import bisect_right
+import numpy as np
+from typing import Dict, Iterable, List, Tuple, Union
+
+
+# Нижняя граница диапазона без from_amount
+NO_LOWER_BOUND = float("-inf")
+
+
+def lower_bound(status_setting: StatusSetting) -> Union[int, float]:
+    if status_setting.from_amount is None:
+        return NO_LOWER_BOUND
+    return status_setting.from_amount
+
+
+def group_status_settings(status_settings: Iterable[StatusSetting], with_entity_type: bool = False
+                          ) -> Dict[tuple, List[StatusSetting]]:
+    """Сгруппировать настройки по (dependency_type, field_id) и отсортировать по нижней границе"""
+
+    groups: Dict[tuple, List[StatusSetting]] = {}
+    for status_setting in status_settings:
+        key = (status_setting.dependency_type, int(status_setting.field_id))
+        if with_entity_type:
+            key = (status_setting.entity_type,) + key
+        groups.setdefault(key, []).append(status_setting)
+    for group in groups.values():
+        group.sort(key=lower_bound)
+    return groups
+
+
+def validate_status_settings(status_settings: Iterable[StatusSetting]) -> None:
+    """
+    Проверить, что диапазоны одного поля для одного типа сущности и типа зависимости
+    не пересекаются и идут без разрывов, и что поле зависит только от суммы или
+    только от количества: у поля одно значение, второй тип зависимости его бы перезаписал
+    """
+
+    groups = group_status_settings(status_settings, with_entity_type=True)
+    dependency_types: Dict[Tuple[str, int], str] = {}
+    for entity_type, dependency_type, field_id in groups:
+        other = dependency_types.setdefault((entity_type, field_id), dependency_type)
+        if other != dependency_type:
+            raise StatusSettingsValidationError(
+                f"({entity_type!r}, {field_id}): field is used for both '{other}' and '{dependency_type}'")
+
+    for key, group in groups.items():
+        for status_setting in group:
+            if status_setting.from_amount is not None and status_setting.from_amount > status_setting.to_amount:
+                raise StatusSettingsValidationError(
+                    f"{key}: from_amount {status_setting.from_amount} > to_amount {status_setting.to_amount}")
+        for previous, current in zip(group, group[1:]):
+            if lower_bound(current) <= previous.to_amount:
+                raise StatusSettingsValidationError(
+                    f"{key}: '{previous.status}' and '{current.status}' overlap")
+            if lower_bound(current) > previous.to_amount + 1:
+                raise StatusSettingsValidationError(
+                    f"{key}: gap between '{previous.status}' and '{current.status}'")
+
+
+class StatusIndex:
+    """
+    Настройки Статуса клиента, скомпилированные в отсортированные диапазоны
+    по (dependency_type, field_id). Поиск статуса - бинарный, на каждое поле одно значение
+    """
+
+    def __init__(self, status_settings: Iterable[StatusSetting]) -> None:
+        self._groups: List[Tuple[str, int, List[Union[int, float]], List[int], List[str]]] = []
+        for (dependency_type, field_id), group in group_status_settings(status_settings).items():
+            self._groups.append((
+                dependency_type,
+                field_id,
+                [lower_bound(status_setting) for status_setting in group],
+                [status_setting.to_amount for status_setting in group],
+                [status_setting.status for status_setting in group],
+            ))
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    @staticmethod
+    def find(lows: List[Union[int, float]], highs: List[int], value: int) -> int:
+        """Найти индекс диапазона, в который попадает value, или -1"""
+
+        index = bisect_right(lows, value) - 1
+        if index >= 0 and value <= highs[index]:
+            return index
+        return -1
+
+    def lookup(self, sum_: int, amount: int) -> Dict[int, str]:
+        """Получить статус для каждого поля по сумме и количеству успешных сделок"""
+
+        result = {}
+        for dependency_type, field_id, lows, highs, statuses in self._groups:
+            value = amount if dependency_type == "quantity" else sum_
+            index = self.find(lows, highs, value)
+            if index >= 0:
+                result[field_id] = statuses[index]
+        return result
+
+    def lookup_many(self, sums: np.ndarray, amounts: np.ndarray) -> List[Dict[int, str]]:
+        """Пакетный lookup: статусы по полям для массивов сумм и количеств"""
+
+        result: List[Dict[int, str]] = [{} for _ in range(len(sums))]
+        for dependency_type, field_id, lows, highs, statuses in self._groups:
+            values = amounts if dependency_type == "quantity" else sums
+            indexes = np.searchsorted(
+                np.asarray(lows, dtype=float), values, side="right") - 1
+            found = indexes >= 0
+            found[found] = values[found] <= np.asarray(highs)[indexes[found]]
+            for position in np.flatnonzero(found):
+                result[position][field_id] = statuses[indexes[position]]
+        return result
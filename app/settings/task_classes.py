@@ -1,30 +1,77 @@
 from app.worker import app
+from app.logger import logger
 from app.integrations.deps import get_amocrm_from_first_integration
 from app.database import get_session
 from . import services
+from .snapshot import get_settings_snapshot
+from .checkpoint import CheckLock
 from app.amocrm.managers import ContactManager, CompanyManager, LeadManager
+from app.amocrm.rate_limit import PRIORITY_HIGH, PRIORITY_LOW
+
+import resource
+from celery.exceptions import Ignore
 
 
 class EntityCheck(app.Task):
     """Базовый класс для пре-настройки проверок сущностей"""
 
+    # Приоритет в общем лимите запросов к amoCRM
+    rate_priority = PRIORITY_HIGH
+
     def before_start(self, *args, **kwargs) -> None:
         """Запускается до начала работы таска Celery"""
 
         self.session = next(get_session())
-        self.amocrm = get_amocrm_from_first_integration()
-        self.lead_manager = LeadManager(self.amocrm, self.session)
+        self.amocrm = get_amocrm_from_first_integration(self.rate_priority)
+        # Настройки читаются один раз на задачу
+        self.snapshot = get_settings_snapshot(self.session)
+        self.lead_manager = LeadManager(self.amocrm, self.session,
+                                        lead_field_ids=self.snapshot.lead_field_ids)
+        # ru_maxrss - пик за всю жизнь процесса воркера, поэтому запоминаем его до задачи
+        self.maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
     def after_return(self, *args, **kwargs) -> None:
         """Запускается после окончания работы таска Celery"""
 
+        logger.info(f"{self.name} amoCRM requests: {self.amocrm.stats.as_dict()}")
+        # На Linux в килобайтах. Рост пика виден, только если задача превысила
+        # прежний пик процесса; сравнение путей на одних данных - bench/records.py
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logger.info(f"{self.name} process peak memory: {maxrss} KB, "
+                    f"raised by this task: {maxrss - self.maxrss_before} KB")
         self.session.commit()
         self.session.close()
 
 
-class ContactCheckTask(EntityCheck):
+class LockedCheck(EntityCheck):
+    """
+    Проверка с чекпоинтом, которую одновременно ведет только один воркер. Если она уже
+    идет (например, ее перезапустил другой воркер после старта), задача пропускается
+    """
+
+    # Имя чекпоинта и отметки запущенной проверки: contacts | companies | full
+    check_name: str
+
+    def before_start(self, *args, **kwargs) -> None:
+        self.check_lock = CheckLock(self.check_name)
+        super().before_start(*args, **kwargs)
+        if not self.check_lock.acquire():
+            logger.info(f"{self.check_name} check is already running, skipping")
+            # after_return для пропущенной задачи не вызывается
+            self.session.close()
+            raise Ignore()
+
+    def after_return(self, *args, **kwargs) -> None:
+        self.check_lock.release()
+        super().after_return(*args, **kwargs)
+
+
+class ContactCheckTask(LockedCheck):
     """Класс для пре-настройки проверок контактов"""
 
+    rate_priority = PRIORITY_LOW
+    check_name = "contacts"
+
     def before_start(self, *args, **kwargs) -> None:
         super().before_start(*args, **kwargs)
         services.set_contact_check_status(self.session, True)
@@ -36,9 +83,12 @@ class ContactCheckTask(EntityCheck):
         super().after_return(*args, **kwargs)
 
 
-class CompanyCheckTask(EntityCheck):
+class CompanyCheckTask(LockedCheck):
     """Класс для пре-настройки проверок компаний"""
 
+    rate_priority = PRIORITY_LOW
+    check_name = "companies"
+
     def before_start(self, *args, **kwargs) -> None:
         super().before_start(*args, **kwargs)
         services.set_company_check_status(self.session, True)
@@ -48,3 +98,41 @@ class CompanyCheckTask(EntityCheck):
     def after_return(self, *args, **kwargs) -> None:
         services.set_company_check_status(self.session, False)
         super().after_return(*args, **kwargs)
+
+
+class FullCheckTask(LockedCheck):
+    """Класс для пре-настройки общей проверки контактов и компаний"""
+
+    rate_priority = PRIORITY_LOW
+    check_name = "full"
+
+    def before_start(self, *args, **kwargs) -> None:
+        super().before_start(*args, **kwargs)
+        services.set_contact_check_status(self.session, True)
+        services.set_company_check_status(self.session, True)
+        self.contact_manager = ContactManager(self.amocrm, self.session)
+        self.company_manager = CompanyManager(self.amocrm, self.session)
+        self.session.commit()
+
+    def after_return(self, *args, **kwargs) -> None:
+        services.set_contact_check_status(self.session, False)
+        services.set_company_check_status(self.session, False)
+        super().after_return(*args, **kwargs)
+
+
+class ShardedCheckTask(EntityCheck):
+    """Координатор шардированной проверки: статусы сбрасывает финальный шаг chord"""
+
+    rate_priority = PRIORITY_LOW
+
+    def before_start(self, *args, **kwargs) -> None:
+        super().before_start(*args, **kwargs)
+        services.set_contact_check_status(self.session, True)
+        services.set_company_check_status(self.session, True)
+        self.session.commit()
+
+
+class ShardTask(EntityCheck):
+    """Класс для шарда проверки, шарды делят общий лимит запросов аккаунта"""
+
+    rate_priority = PRIORITY_LOW
@@ -1,30 +1,225 @@
-from app.worker import app
+from app.worker import (app, CHECKS_QUEUE, PRIORITY_CALLBACK, PRIORITY_HOOK,
+                        PRIORITY_SHARD)
+from app.database import engine
 from .hook import HookHandler
-from .entity_checkers import ContactChecker, CompanyChecker
-from .task_classes import EntityCheck, ContactCheckTask, CompanyCheckTask
+from .debounce import HookDebouncer
+from .entity_checkers import EntityChecker, ContactChecker, CompanyChecker
+from .checkpoint import Checkpoint, CheckLock, get_checkpoints
+from .incremental import IncrementalCheck, save_check_watermark
+from .mirror import LeadsMirror
+from .vectorized import VectorizedLeadsAggregator
+from .sharding import merge_shard_results, run_shard
+from .task_classes import (EntityCheck, ContactCheckTask, CompanyCheckTask, FullCheckTask,
+                           ShardedCheckTask, ShardTask)
+from . import services
+from app.amocrm.managers import ContactManager, CompanyManager
+from app.app_settings import get_settings
+from app.logger import logger
 
+import time
+from celery import chord
+from celery.signals import worker_ready
+from sqlmodel import Session
 
-@app.task(base=EntityCheck, bind=True, ignore_result=True)
+
+# Подтверждается после выполнения: хук, прерванный вместе с воркером, выполнится снова.
+# Проверкам это не нужно - они продолжаются с чекпоинта, а долгое неподтвержденное
+# сообщение RabbitMQ закрывает по consumer_timeout
+@app.task(base=EntityCheck, bind=True, ignore_result=True, acks_late=True, priority=PRIORITY_HOOK)
 def handle_hook_on_background(self, request_data) -> None:
-    """Обработать хук на изменение сделки"""
+    """
+    Обработать хук на изменение сделки: найти затронутые контакт и компанию
+    и отложить их пересчет на окно, в которое сольются хуки по тем же сущностям
+    """
+
+    handler = HookHandler(self.amocrm, self.session, self.snapshot)
+    entity_ids = handler.resolve(request_data)
+    debouncer = HookDebouncer.from_settings()
+    scheduled = None if debouncer is None else debouncer.add(entity_ids)
+    if scheduled is None:
+        handler.recompute(entity_ids)
+    elif scheduled:
+        recompute_hooked_entities.apply_async(countdown=debouncer.window)
+
+
+@app.task(base=EntityCheck, bind=True, ignore_result=True, priority=PRIORITY_HOOK)
+def recompute_hooked_entities(self) -> None:
+    """Пересчитать сущности, накопленные хуками за окно, каждую один раз"""
+
+    pending = HookDebouncer.from_settings().pop()
+    handler = HookHandler(self.amocrm, self.session, self.snapshot)
+    handler.recompute(pending)
+    hooked = sum(sum(pending[entity].values()) for entity in ("contacts", "companies"))
+    recomputed = sum(len(pending[entity]) for entity in ("contacts", "companies"))
+    logger.info(f"Hook debounce: {pending['events']} hooks, {recomputed} entities recomputed, "
+                f"{hooked - recomputed} recomputes collapsed")
+
+
+def aggregate_from_mirror(task: EntityCheck) -> VectorizedLeadsAggregator:
+    """Догнать копию сделок изменениями из amoCRM и посчитать итоги по ней"""
+
+    LeadsMirror(task.session, task.lead_manager).sync()
+    snapshot = task.snapshot
+    aggregator = VectorizedLeadsAggregator(snapshot.stage_ids,
+                                           contact_months=snapshot.contact_setting.months,
+                                           company_months=snapshot.company_setting.months,
+                                           contact_index=snapshot.contact_status_index,
+                                           company_index=snapshot.company_status_index)
+    return aggregator.collect(LeadsMirror(task.session))
+
+
+def run_entity_check(task: EntityCheck, entity: str, checker: EntityChecker,
+                     incremental: bool, from_scratch: bool) -> None:
+    """
+    Проверить сущности одного типа: в инкрементальном режиме только затронутые
+    с прошлой проверки, если она была с теми же настройками, иначе все.
+    Прерванная полная проверка продолжается с сохраненной страницы
+    """
 
-    handler = HookHandler(self.amocrm, self.session)
-    handler.handle(request_data)
+    checkpoint = Checkpoint(task.session, entity, task.snapshot.version)
+    if from_scratch:
+        checkpoint.clear()
+    check = IncrementalCheck(entity, checker, task.manager, task.session, task.snapshot,
+                             started_at=checkpoint.started_at)
+    since = check.get_since() if incremental and not checkpoint.exists else None
+    if since is None:
+        checker.run_aggregated_check(
+            getattr(aggregate_from_mirror(task), entity), checkpoint=checkpoint)
+        checkpoint.clear()
+    else:
+        LeadsMirror(task.session, task.lead_manager).sync()
+        check.run(since)
+    check.save()
 
 
 @app.task(base=ContactCheckTask, bind=True, ignore_result=True)
-def contact_check(self) -> None:
+def contact_check(self, incremental: bool = False, from_scratch: bool = False) -> None:
     """Запустить проверку контактов"""
 
     contact_checker = ContactChecker(
-        self.manager, self.lead_manager, self.session)
-    contact_checker.run_check()
+        self.manager, self.lead_manager, self.session, self.snapshot)
+    run_entity_check(self, "contacts", contact_checker, incremental, from_scratch)
 
 
 @app.task(base=CompanyCheckTask, bind=True, ignore_result=True)
-def company_check(self) -> None:
+def company_check(self, incremental: bool = False, from_scratch: bool = False) -> None:
     """Запустить проверку компаний"""
 
     company_checker = CompanyChecker(
-        self.manager, self.lead_manager, self.session)
-    company_checker.run_check()
+        self.manager, self.lead_manager, self.session, self.snapshot)
+    run_entity_check(self, "companies", company_checker, incremental, from_scratch)
+
+
+@app.task(base=FullCheckTask, bind=True, ignore_result=True)
+def full_check(self, from_scratch: bool = False) -> None:
+    """Запустить проверку контактов и компаний за один проход по копии сделок"""
+
+    contact_checker = ContactChecker(
+        self.contact_manager, self.lead_manager, self.session, self.snapshot)
+    company_checker = CompanyChecker(
+        self.company_manager, self.lead_manager, self.session, self.snapshot)
+    checkpoint = Checkpoint(self.session, "full", self.snapshot.version)
+    if from_scratch:
+        checkpoint.clear()
+    checks = [IncrementalCheck("contacts", contact_checker, self.contact_manager, self.session,
+                               self.snapshot, started_at=checkpoint.started_at),
+              IncrementalCheck("companies", company_checker, self.company_manager, self.session,
+                               self.snapshot, started_at=checkpoint.started_at)]
+    aggregator = aggregate_from_mirror(self)
+    for checker in (contact_checker, company_checker):
+        if not checkpoint.is_done(checker.entity):
+            checker.run_aggregated_check(
+                getattr(aggregator, checker.entity), checkpoint=checkpoint)
+    checkpoint.clear()
+    # Полная проверка тоже точка отсчета для инкрементальных
+    for check in checks:
+        check.save()
+
+
+# Проверки с чекпоинтом по имени чекпоинта
+RESUMABLE_CHECKS = {"contacts": contact_check, "companies": company_check, "full": full_check}
+
+
+@worker_ready.connect
+def resume_interrupted_checks(sender=None, **kwargs) -> None:
+    """
+    Перезапустить проверки, прерванные вместе с воркером, они продолжатся с сохраненной
+    страницы. Чекпоинт есть и у идущей проверки, поэтому решает resume_check: проверка с
+    живой отметкой не перезапускается. Отметка упавшего воркера истекает за check_lock_ttl,
+    ее проверяют после этого срока
+    """
+
+    # Перезапускает только воркер проверок, иначе воркер хуков продублирует задачи
+    if sender is not None and CHECKS_QUEUE not in sender.app.amqp.queues.consume_from:
+        return
+    with Session(engine) as session:
+        for checkpoint in get_checkpoints(session):
+            lock = CheckLock(checkpoint.name)
+            resume_check.apply_async((checkpoint.name,), countdown=lock.ttl if lock.is_held() else 0)
+
+
+@app.task(ignore_result=True, priority=PRIORITY_CALLBACK)
+def resume_check(name: str) -> None:
+    """Продолжить проверку с чекпоинтом, если ее не ведет живой воркер"""
+
+    with Session(engine) as session:
+        if name not in {checkpoint.name for checkpoint in get_checkpoints(session)}:
+            return
+    if CheckLock(name).is_held():
+        logger.info(f"{name} check is still running, not resuming")
+        return
+    RESUMABLE_CHECKS[name].delay()
+
+
+# Менеджер и проверяющий класс для каждого типа сущностей
+ENTITY_CLASSES = {"contacts": (ContactManager, ContactChecker),
+                  "companies": (CompanyManager, CompanyChecker)}
+
+
+@app.task(base=ShardedCheckTask, bind=True, ignore_result=True)
+def sharded_check(self, shards: int = None) -> None:
+    """
+    Полная проверка, разбитая на шарды по страницам списка сущностей. Шарды
+    выполняются параллельно на всех воркерах, финальный шаг складывает итоги
+    """
+
+    shards = shards or get_settings().check_shards
+    started_at = int(time.time())
+    LeadsMirror(self.session, self.lead_manager).sync()
+    header = [check_shard.s(entity, shard, shards)
+              for entity in ENTITY_CLASSES for shard in range(shards)]
+    callback = merge_shards.s(started_at, self.snapshot.version)
+    chord(header)(callback.on_error(sharded_check_failed.s()))
+
+
+@app.task(base=ShardTask, bind=True, priority=PRIORITY_SHARD)
+def check_shard(self, entity: str, shard: int, shards: int) -> dict:
+    """Проверить один шард сущностей одного типа"""
+
+    manager_class, checker_class = ENTITY_CLASSES[entity]
+    manager = manager_class(self.amocrm, self.session)
+    checker = checker_class(manager, self.lead_manager, self.session, self.snapshot)
+    result = run_shard(checker, manager, LeadsMirror(self.session),
+                       self.snapshot.stage_ids, shard, shards)
+    result["requests"] = self.amocrm.stats.as_dict()
+    return result
+
+
+@app.task(base=EntityCheck, bind=True, ignore_result=True, priority=PRIORITY_CALLBACK)
+def merge_shards(self, results, started_at: int, version: int) -> None:
+    """Сложить итоги шардов, запомнить отметку для инкрементальных проверок и снять статусы"""
+
+    logger.info(f"Sharded check totals: {merge_shard_results(results)}")
+    for entity in ENTITY_CLASSES:
+        save_check_watermark(self.session, entity, started_at, version)
+    services.set_contact_check_status(self.session, False)
+    services.set_company_check_status(self.session, False)
+
+
+@app.task(base=EntityCheck, bind=True, ignore_result=True, priority=PRIORITY_CALLBACK)
+def sharded_check_failed(self, *args, **kwargs) -> None:
+    """Шард упал: снять статусы проверок, иначе они останутся запущенными"""
+
+    logger.error(f"Sharded check failed: {args}")
+    services.set_contact_check_status(self.session, False)
+    services.set_company_check_status(self.session, False)
@@ -0,0 +1,144 @@
+from app.amocrm.helpers import get_created_from
+from app.amocrm.records import LeadRecord
+from .aggregation import EntityAggregate, LeadsAggregator
+from .mirror import LeadsMirror
+from .schemas import StageIds
+from .status_index import StatusIndex
+
+from array import array
+from typing import Dict
+
+import numpy as np
+
+
+class LeadColumns:
+    """
+    Сделки в колоночном виде: по массиву на поле сделки и таблицы связей
+    (индекс сделки, id сущности) для контактов и компаний
+    """
+
+    def __init__(self) -> None:
+        self.lead_ids = array("q")
+        self.prices = array("q")
+        self.status_ids = array("q")
+        self.pipeline_ids = array("q")
+        self.created_at = array("q")
+        self.contact_links = (array("q"), array("q"))
+        self.company_links = (array("q"), array("q"))
+
+    def __len__(self) -> int:
+        return len(self.lead_ids)
+
+    def add(self, lead: LeadRecord) -> None:
+        """Добавить сделку и ее связи с контактами и компаниями"""
+
+        index = len(self.lead_ids)
+        self.lead_ids.append(lead.id)
+        self.prices.append(lead.price)
+        self.status_ids.append(lead.status_id)
+        self.pipeline_ids.append(lead.pipeline_id)
+        self.created_at.append(lead.created_at)
+        for links, entity_ids in ((self.contact_links, lead.contact_ids),
+                                  (self.company_links, lead.company_ids)):
+            for entity_id in entity_ids:
+                links[0].append(index)
+                links[1].append(entity_id)
+
+    @staticmethod
+    def to_numpy(values: array) -> np.ndarray:
+        return np.frombuffer(values, dtype=np.int64) if len(values) else np.zeros(0, dtype=np.int64)
+
+
+def classify(columns: LeadColumns, stage_ids: StageIds, months: int):
+    """Маски успешных (в окне months) и активных сделок, как в classify_success_and_active_leads"""
+
+    status_ids = LeadColumns.to_numpy(columns.status_ids)
+    pipeline_ids = LeadColumns.to_numpy(columns.pipeline_ids)
+    created_at = LeadColumns.to_numpy(columns.created_at)
+
+    success = ((status_ids == (stage_ids.success_stage_id or -1))
+               & (pipeline_ids == (stage_ids.pipeline_id or -1))
+               & (created_at >= get_created_from(months)))
+    inactive = np.isin(status_ids, np.asarray(
+        stage_ids.inactive_stage_ids or [], dtype=np.int64))
+    return success, ~success & ~inactive
+
+
+def aggregate_links(columns: LeadColumns, links, success: np.ndarray, active: np.ndarray,
+                    status_index: StatusIndex, lead_fields: Dict[int, dict] = None) -> Dict[int, EntityAggregate]:
+    """
+    Group-by по id сущности: сумма и количество успешных, активные сделки и статусы.
+    lead_fields - текущие поля сделок, которые могут оказаться активными
+    """
+
+    link_leads = LeadColumns.to_numpy(links[0])
+    link_entities = LeadColumns.to_numpy(links[1])
+    if len(link_entities) == 0:
+        return {}
+    lead_ids = LeadColumns.to_numpy(columns.lead_ids)
+    prices = LeadColumns.to_numpy(columns.prices)
+
+    entity_ids, inverse = np.unique(link_entities, return_inverse=True)
+    size = len(entity_ids)
+
+    link_success = success[link_leads]
+    sums = np.bincount(inverse[link_success], weights=prices[link_leads[link_success]],
+                       minlength=size).round().astype(np.int64)
+    amounts = np.bincount(inverse[link_success], minlength=size)
+
+    link_active = active[link_leads]
+    active_entities = inverse[link_active]
+    order = np.argsort(active_entities, kind="stable")
+    active_entities = active_entities[order]
+    active_leads = lead_ids[link_leads[link_active]][order]
+    bounds = np.searchsorted(active_entities, np.arange(size + 1))
+
+    statuses = status_index.lookup_many(sums, amounts)
+    lead_fields = lead_fields or {}
+    aggregates = {}
+    for i in range(size):
+        entity_leads = active_leads[bounds[i]:bounds[i + 1]].tolist()
+        aggregates[int(entity_ids[i])] = EntityAggregate(
+            int(sums[i]), int(amounts[i]), entity_leads, statuses[i],
+            {lead_id: lead_fields[lead_id] for lead_id in entity_leads if lead_id in lead_fields})
+    return aggregates
+
+
+class VectorizedLeadsAggregator(LeadsAggregator):
+    """
+    Тот же результат, что у LeadsAggregator, но сделки складываются в колонки,
+    а итоги и статусы считаются пакетно через numpy
+    """
+
+    def __init__(self, stage_ids: StageIds, contact_months: int, company_months: int,
+                 contact_index: StatusIndex, company_index: StatusIndex) -> None:
+        super().__init__(stage_ids, contact_months, company_months)
+        self._contact_index = contact_index
+        self._company_index = company_index
+        self.columns = LeadColumns()
+        # Поля нужны только активным сделкам, остальные не держим в памяти
+        self.lead_fields: Dict[int, dict] = {}
+
+    def add(self, lead: LeadRecord) -> None:
+        self.columns.add(lead)
+        if lead.fields and lead.status_id not in (self._stage_ids.inactive_stage_ids or ()):
+            self.lead_fields[lead.id] = lead.fields
+
+    def aggregate(self) -> "VectorizedLeadsAggregator":
+        """Посчитать итоги для контактов и компаний по собранным колонкам"""
+
+        success, active = classify(
+            self.columns, self._stage_ids, self._contact_months)
+        self.contacts = aggregate_links(
+            self.columns, self.columns.contact_links, success, active, self._contact_index,
+            self.lead_fields)
+        success, active = classify(
+            self.columns, self._stage_ids, self._company_months)
+        self.companies = aggregate_links(
+            self.columns, self.columns.company_links, success, active, self._company_index,
+            self.lead_fields)
+        return self
+
+    def collect(self, mirror: LeadsMirror) -> "VectorizedLeadsAggregator":
+        super().collect(mirror)
+        return self.aggregate()
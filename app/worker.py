@@ -3,15 +3,43 @@ from celery import Celery
 from kombu import Queue, Exchange
 
 
+# Очереди: хуки ждут секунды, проверки могут идти часами - у них свои воркеры
+HOOKS_QUEUE = "hooks"
+CHECKS_QUEUE = "checks"
+
+# Приоритеты сообщений внутри очереди, больше - раньше
+MAX_PRIORITY = 10
+PRIORITY_HOOK = 9
+PRIORITY_CALLBACK = 7
+PRIORITY_CHECK = 5
+PRIORITY_SHARD = 3
+
+
 app = Celery(__name__)
 app.conf.broker_url = os.environ.get("CELERY_BROKER_URL")
+# Нужен для chord в шардированной проверке
+app.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND")
 app.autodiscover_tasks(packages=["app.settings"])
 
 
+exchange = Exchange("settings", type="topic", auto_delete=True)
 app.conf.task_queues = (
-    Queue("settings", Exchange("settings", type="topic",
-          auto_delete=True), routing_key="app.settings.*"),
+    Queue(HOOKS_QUEUE, exchange, routing_key="app.settings.hooks",
+          queue_arguments={"x-max-priority": MAX_PRIORITY}),
+    Queue(CHECKS_QUEUE, exchange, routing_key="app.settings.checks",
+          queue_arguments={"x-max-priority": MAX_PRIORITY}),
 )
 
+# Точное имя задачи важнее шаблона
 app.conf.task_routes = {
-    "app.settings.tasks.*": {"queue": "settings", "routing_key": "app.settings.tasks"}}
+    "app.settings.tasks.handle_hook_on_background": {
+        "queue": HOOKS_QUEUE, "routing_key": "app.settings.hooks"},
+    "app.settings.tasks.recompute_hooked_entities": {
+        "queue": HOOKS_QUEUE, "routing_key": "app.settings.hooks"},
+    "app.settings.tasks.*": {"queue": CHECKS_QUEUE, "routing_key": "app.settings.checks"}}
+app.conf.task_queue_max_priority = MAX_PRIORITY
+app.conf.task_default_priority = PRIORITY_CHECK
+
+# Процесс воркера резервирует одно сообщение, а не пачку: долгая задача
+# не держит у себя хуки, которые могли бы забрать свободные процессы
+app.conf.worker_prefetch_multiplier = 1
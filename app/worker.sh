@@ -8,5 +8,9 @@ while ! nc -z $RABBIT_HOST $RABBIT_PORT; do
     sleep 0.1
 done
 echo "RabbitMQ started"
-celery -A app.worker worker --loglevel=INFO -Q settings
+# Очереди и число процессов задаются для каждого воркера в docker-compose
+[ -z $CELERY_QUEUES ] && CELERY_QUEUES="hooks,checks"
+[ -z $CELERY_CONCURRENCY ] && CELERY_CONCURRENCY="4"
+celery -A app.worker worker --loglevel=INFO -Q $CELERY_QUEUES \
+    --concurrency $CELERY_CONCURRENCY -n "${CELERY_QUEUES%%,*}@%h"
 exec "$@"
\ No newline at end of file
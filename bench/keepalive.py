@@ -0,0 +1,89 @@
+"""
+Задержка запросов: общая сессия с keep-alive (get_http_session) против нового
+соединения на каждый запрос. По умолчанию против локального сервера, --url
+позволяет замерить реальный хост, где видна цена TCP и TLS рукопожатий.
+Запуск: python -m bench.keepalive [--requests 500] [--url https://...]
+"""
+from bench.common import report
+
+import argparse
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from app.amocrm.http_pool import get_http_session
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Короткий JSON ответ по HTTP/1.1, соединение остается открытым"""
+
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело одним пакетом, иначе Nagle и отложенный ACK добавляют ~40 мс
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        body = b'{"_embedded": {}}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def new_connection(url: str) -> None:
+    with requests.Session() as session:
+        session.get(url, timeout=30).content
+
+
+def keep_alive(url: str) -> None:
+    get_http_session().get(url, timeout=30).content
+
+
+def measure(function, url: str, count: int) -> list:
+    # Первый запрос открывает соединение пула, в замер не входит
+    function(url)
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        function(url)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def summary(latencies: list) -> str:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    return f"{statistics.mean(latencies):.2f}, {statistics.median(latencies):.2f}, {p95:.2f}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--url", default=None)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/api/v4/leads"
+
+    report(f"keepalive: {url}, {args.requests} requests, mean ms, p50 ms, p95 ms")
+    report(f"keepalive: new connection, {summary(measure(new_connection, url, args.requests))}")
+    report(f"keepalive: keep-alive, {summary(measure(keep_alive, url, args.requests))}")
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
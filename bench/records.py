@@ -0,0 +1,72 @@
+"""
+Память под сделки: полные JSON ответы amoCRM (dict) против записей LeadRecord
+со __slots__ на одних и тех же данных, замер через tracemalloc.
+Запуск: python -m bench.records [--sizes 10000 100000]
+"""
+from bench.common import report
+
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from app.amocrm.records import LeadRecord
+
+
+def make_lead_data(lead_id: int, rng: random.Random) -> dict:
+    """Сделка в том виде, в каком ее отдает /api/v4/leads?with=contacts"""
+
+    now = int(time.time())
+    return {
+        "id": lead_id, "name": f"Сделка #{lead_id}", "price": rng.randint(0, 50000),
+        "responsible_user_id": 100, "group_id": 0, "status_id": rng.choice((142, 143, 1, 2)),
+        "pipeline_id": 10, "loss_reason_id": None, "created_by": 100, "updated_by": 100,
+        "created_at": now - rng.randint(0, 800 * 86400), "updated_at": now, "closed_at": None,
+        "closest_task_at": None, "is_deleted": False, "score": None, "account_id": 1,
+        "labor_cost": None,
+        "custom_fields_values": [
+            {"field_id": 1, "field_name": "Оплачено", "field_code": None, "field_type": "numeric",
+             "values": [{"value": str(rng.randint(0, 50000))}]},
+        ],
+        "_links": {"self": {"href": f"https://test.amocrm.ru/api/v4/leads/{lead_id}"}},
+        "_embedded": {
+            "tags": [],
+            "companies": [{"id": rng.randrange(1000), "_links": {"self": {"href": "..."}}}],
+            "contacts": [{"id": rng.randrange(5000), "is_main": True,
+                          "_links": {"self": {"href": "..."}}}],
+        },
+    }
+
+
+def measure(build) -> int:
+    """Сколько байт занимает результат build, пока он жив"""
+
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    report("records: leads, dict MB, LeadRecord MB, ratio")
+    for size in args.sizes:
+        # Каждый путь разбирает ответ сам, как при чтении страницы из amoCRM
+        rng = random.Random(1)
+        payload = json.dumps([make_lead_data(lead_id, rng) for lead_id in range(size)])
+        dicts = measure(lambda: json.loads(payload))
+        records = measure(lambda: [LeadRecord.from_data(data) for data in json.loads(payload)])
+        report(f"records: {size}, {dicts / 2 ** 20:.1f}, {records / 2 ** 20:.1f}, "
+               f"{dicts / records:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
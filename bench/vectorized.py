@@ -0,0 +1,89 @@
+"""
+Итоги по сделкам: построчный LeadsAggregator против VectorizedLeadsAggregator
+на одних и тех же сделках. Запуск: python -m bench.vectorized [--sizes 10000 100000 1000000]
+"""
+from bench.common import report
+
+import argparse
+import gc
+import random
+import time
+
+from app.amocrm.records import LeadRecord
+from app.settings.aggregation import LeadsAggregator
+from app.settings.schemas import StageIds, StatusSetting
+from app.settings.status_index import StatusIndex
+from app.settings.vectorized import VectorizedLeadsAggregator
+
+STAGE_IDS = StageIds(pipeline_id=10, success_stage_id=142, inactive_stage_ids=[142, 143])
+STATUS_SETTINGS = [
+    StatusSetting(status="Новый", dependency_type="sum", entity_type="contact", field_id=5,
+                  from_amount=None, to_amount=10000),
+    StatusSetting(status="Постоянный", dependency_type="sum", entity_type="contact", field_id=5,
+                  from_amount=10001, to_amount=10 ** 12),
+    StatusSetting(status="Частый", dependency_type="quantity", entity_type="contact", field_id=6,
+                  from_amount=3, to_amount=10 ** 6),
+]
+
+
+def make_leads(count: int, seed: int = 1) -> list:
+    """Сделки со связями: примерно по 10 сделок на контакт и 30 на компанию"""
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    contacts = max(count // 10, 1)
+    companies = max(count // 30, 1)
+    return [
+        LeadRecord(lead_id, rng.randint(0, 50000), rng.choice((142, 143, 1, 2, 3)),
+                   rng.choice((10, 11)), now - rng.randint(0, 800 * 86400), now, None, None,
+                   (rng.randrange(contacts),),
+                   (rng.randrange(companies),) if rng.random() < 0.6 else ())
+        for lead_id in range(count)
+    ]
+
+
+def run_per_lead(leads: list, index: StatusIndex) -> dict:
+    aggregator = LeadsAggregator(STAGE_IDS, contact_months=12, company_months=24)
+    for lead in leads:
+        aggregator.add(lead)
+    # Статусы построчный путь ищет для каждой сущности отдельно
+    for aggregate in aggregator.contacts.values():
+        aggregate.statuses = index.lookup(aggregate.sum, aggregate.amount)
+    for aggregate in aggregator.companies.values():
+        aggregate.statuses = index.lookup(aggregate.sum, aggregate.amount)
+    return aggregator.contacts
+
+
+def run_vectorized(leads: list, index: StatusIndex) -> dict:
+    aggregator = VectorizedLeadsAggregator(STAGE_IDS, contact_months=12, company_months=24,
+                                           contact_index=index, company_index=index)
+    for lead in leads:
+        aggregator.add(lead)
+    return aggregator.aggregate().contacts
+
+
+def measure(function, *args) -> tuple:
+    gc.collect()
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    index = StatusIndex(STATUS_SETTINGS)
+    report("vectorized: leads, per-lead s, vectorized s, speedup")
+    for size in args.sizes:
+        leads = make_leads(size)
+        per_lead, expected = measure(run_per_lead, leads, index)
+        vectorized, result = measure(run_vectorized, leads, index)
+        for entity_id, aggregate in expected.items():
+            assert (result[entity_id].sum, result[entity_id].amount) == (aggregate.sum, aggregate.amount)
+        report(f"vectorized: {size}, {per_lead:.3f}, {vectorized:.3f}, {per_lead / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
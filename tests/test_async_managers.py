@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+import requests
+
+from app.amocrm.async_base import AsyncAmoCRM
+from app.amocrm.async_managers import AsyncContactManager, AsyncLeadManager, collect
+from app.amocrm.base import AmoCRM
+from app.amocrm.identity_map import IdentityMap
+from app.amocrm.managers import ContactManager
+from app.amocrm.rate_limit import TokenBucket
+from app.settings.schemas import StageIds
+
+
+def make_lead(lead_id: int) -> dict:
+    return {"id": lead_id, "price": 100, "status_id": 142 if lead_id % 2 else 1,
+            "pipeline_id": 7, "created_at": 2 ** 31,
+            "_embedded": {"contacts": [{"id": 1, "is_main": True}]}}
+
+
+def matches(lead: dict, params: dict) -> bool:
+    """Проверить сделку на filter[statuses] и filter[created_at][from], как amoCRM"""
+
+    statuses = {value for key, value in params.items()
+                if key.startswith("filter[statuses]") and key.endswith("[status_id]")}
+    if statuses and lead["status_id"] not in statuses:
+        return False
+    return lead["created_at"] >= params.get("filter[created_at][from]", 0)
+
+
+PIPELINES = {"_embedded": {"pipelines": [
+    {"id": 7, "_embedded": {"statuses": [{"id": 1}, {"id": 142}, {"id": 143}]}}]}}
+
+
+class FakeAsyncAmoCRM:
+    """Асинхронный клиент без сети: сделки по filter[id][] и статусам, считает одновременные запросы"""
+
+    is_async = True
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_many(self, entity, path, params=None, limit=50, start_page=1):
+        self.calls.append((path, dict(params or {})))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        for entity_id in (params or {}).get("filter[id][]", []):
+            if matches(make_lead(entity_id), params):
+                yield make_lead(entity_id)
+
+    async def make_request(self, method, path, params=None):
+        self.calls.append((path, dict(params or {})))
+        return PIPELINES
+
+
+class PagedAsyncAmoCRM(AsyncAmoCRM):
+    """Клиент, который отдает страницы из памяти вместо amoCRM"""
+
+    def __init__(self, pages: int) -> None:
+        super().__init__("test", "client-id", "secret", access_token="token",
+                         http_session=requests.Session(), rate_limiter=TokenBucket(1000, 1000))
+        self.pages = pages
+        self.requested = []
+
+    async def get_page(self, path, params, page, limit):
+        self.requested.append(page)
+        if page > self.pages:
+            return {}
+        links = {"next": {}} if page < self.pages else {}
+        return {"_embedded": {"contacts": [{"id": page}]}, "_links": links}
+
+
+def test_bulk_lead_lookup_fetches_chunks_concurrently():
+    amocrm = FakeAsyncAmoCRM()
+    identity_map = IdentityMap()
+    manager = AsyncLeadManager(amocrm, None, identity_map, lead_field_ids=(5,))
+
+    leads = asyncio.run(manager.get_many_by_ids(list(range(1, 601)) + [1, 2]))
+
+    assert [lead.id for lead in leads] == list(range(1, 601))
+    assert len(amocrm.calls) == 3
+    assert amocrm.max_in_flight == 3
+    assert identity_map.get("leads", 600) is leads[-1]
+
+    again = asyncio.run(manager.get_many_by_ids([1, 600]))
+    assert [lead.id for lead in again] == [1, 600]
+    assert len(amocrm.calls) == 3
+
+
+def test_contact_success_leads_use_async_lead_lookup():
+    amocrm = FakeAsyncAmoCRM()
+    manager = AsyncContactManager(amocrm, None, IdentityMap())
+    contact = manager.parse({"id": 1, "_embedded": {"leads": [{"id": 1}, {"id": 2}, {"id": 3}]}})
+    stage_ids = StageIds(pipeline_id=7, success_stage_id=142, inactive_stage_ids=[142, 143])
+
+    success, active = asyncio.run(manager.get_success_leads(1, 6, contact, stage_ids))
+
+    assert success == [100, 100]
+    assert active == [2]
+    assert [path for path, _ in amocrm.calls] == ["api/v4/leads/pipelines", "api/v4/leads", "api/v4/leads"]
+    assert all("filter[statuses][0][status_id]" in params for _, params in amocrm.calls[1:])
+
+
+def test_async_client_pages_are_sequential():
+    amocrm = PagedAsyncAmoCRM(pages=5)
+
+    pages = asyncio.run(collect(amocrm.get_pages("contacts", "api/v4/contacts", start_page=2, step=2)))
+
+    assert [page for page, _ in pages] == [2, 4]
+    assert amocrm.requested == [2, 4, 6]
+
+
+def test_managers_reject_a_client_of_the_other_kind():
+    with pytest.raises(TypeError):
+        ContactManager(FakeAsyncAmoCRM(), None)
+    with pytest.raises(TypeError):
+        AsyncContactManager(AmoCRM("test", "client-id", "secret", http_session=requests.Session(),
+                                   rate_limiter=TokenBucket(1000, 1000)), None)
@@ -0,0 +1,53 @@
+import time
+
+import fakeredis
+import pytest
+
+from app.settings import checkpoint
+from app.settings.checkpoint import CheckLock
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Общий Redis: у каждого вызова get_redis свой клиент, как у отдельного воркера"""
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(checkpoint, "get_redis", lambda: fakeredis.FakeRedis(server=server))
+    return server
+
+
+def test_second_worker_sees_a_running_check(server):
+    owner = CheckLock("full", ttl=5)
+    assert owner.acquire()
+
+    other = CheckLock("full", ttl=5)
+    assert other.is_held()
+    assert not other.acquire()
+    assert CheckLock("contacts", ttl=5).acquire()
+
+    owner.release()
+    assert not other.is_held()
+    assert other.acquire()
+    other.release()
+
+
+def test_heartbeat_keeps_a_long_check_alive(server):
+    owner = CheckLock("full", ttl=1)
+    assert owner.acquire()
+
+    time.sleep(1.5)
+
+    assert CheckLock("full", ttl=1).is_held()
+    owner.release()
+
+
+def test_lock_of_a_dead_worker_expires(server):
+    owner = CheckLock("full", ttl=1)
+    assert owner.acquire()
+    # Воркер упал: продлевать отметку некому
+    owner._stop.set()
+    owner._thread.join()
+
+    time.sleep(1.2)
+
+    assert not CheckLock("full", ttl=1).is_held()
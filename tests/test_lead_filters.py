@@ -0,0 +1,60 @@
+from app.amocrm.helpers import get_success_and_active_leads, make_success_and_active_filters
+from app.amocrm.identity_map import IdentityMap
+from app.amocrm.managers import LeadManager
+from app.settings.schemas import StageIds
+
+STAGE_IDS = StageIds(pipeline_id=7, success_stage_id=142, inactive_stage_ids=[143])
+PIPELINES = [{"id": 7, "_embedded": {"statuses": [{"id": 1}, {"id": 142}, {"id": 143}]}}]
+NOW = 2 ** 31
+
+
+def make_lead(lead_id: int, status_id: int, created_at: int = NOW) -> dict:
+    return {"id": lead_id, "price": 100, "status_id": status_id, "pipeline_id": 7,
+            "created_at": created_at, "_embedded": {"contacts": [{"id": 1, "is_main": True}]}}
+
+
+class FakeAmoCRM:
+    """Клиент без сети: отбирает сделки по filter[id][], filter[statuses] и filter[created_at]"""
+
+    def __init__(self, leads) -> None:
+        self.leads = {lead["id"]: lead for lead in leads}
+        self.calls = []
+
+    def make_request(self, method, path, params=None):
+        self.calls.append((path, {}))
+        return {"_embedded": {"pipelines": PIPELINES}}
+
+    def get_many(self, entity, path, params=None, limit=50, start_page=1):
+        self.calls.append((path, dict(params)))
+        statuses = {value for key, value in params.items() if key.endswith("[status_id]")}
+        for lead_id in params["filter[id][]"]:
+            lead = self.leads.get(lead_id)
+            if lead and lead["status_id"] in statuses \
+                    and lead["created_at"] >= params.get("filter[created_at][from]", 0):
+                yield lead
+
+
+def test_filters_cover_success_window_and_active_statuses():
+    success, active = make_success_and_active_filters(STAGE_IDS, 6, PIPELINES)
+
+    assert success["filter[statuses][0][pipeline_id]"] == 7
+    assert success["filter[statuses][0][status_id]"] == 142
+    assert "filter[created_at][from]" in success
+    assert [value for key, value in active.items() if key.endswith("[status_id]")] == [1, 142]
+    assert "filter[created_at][from]" not in active
+
+
+def test_only_leads_that_affect_totals_are_transferred():
+    amocrm = FakeAmoCRM([make_lead(1, 142), make_lead(2, 1), make_lead(3, 143),
+                         make_lead(4, 142, created_at=0)])
+    manager = LeadManager(amocrm, None, IdentityMap())
+
+    success, active = get_success_and_active_leads(manager, 6, [1, 2, 3, 4], STAGE_IDS)
+
+    # Сделка 1 попадает в обе выборки, но считается один раз
+    assert success == [100]
+    assert active == [2, 4]
+    assert amocrm.calls[0][0] == "api/v4/leads/pipelines"
+
+    get_success_and_active_leads(manager, 6, [1, 2, 5], STAGE_IDS)
+    assert [path for path, _ in amocrm.calls].count("api/v4/leads/pipelines") == 1
@@ -0,0 +1,88 @@
+import pytest
+
+from app.amocrm.records import LeadRecord
+from app.settings import mirror
+from app.settings.mirror import (LEADS_CURSOR, LEADS_DELETED_WATERMARK, LEADS_WATERMARK,
+                                 LeadsMirror)
+
+
+class FakeSession:
+    def commit(self) -> None:
+        pass
+
+
+class FakeLeadManager:
+    """Сделки amoCRM в памяти: отдает их от новых к старым, как get_updated_since"""
+
+    def __init__(self, updated_at, deleted=(), fail_after: int = None) -> None:
+        self.leads = [LeadRecord(lead_id, 0, 1, 1, 0, updated)
+                      for lead_id, updated in enumerate(updated_at, start=1)]
+        self.deleted = list(deleted)
+        self.fail_after = fail_after
+        self.calls = []
+
+    def get_updated_since(self, updated_from, updated_to=None):
+        self.calls.append((updated_from, updated_to))
+        leads = sorted((lead for lead in self.leads if lead.updated_at >= updated_from
+                        and (updated_to is None or lead.updated_at <= updated_to)),
+                       key=lambda lead: lead.updated_at, reverse=True)
+        for index, lead in enumerate(leads):
+            if self.fail_after is not None and index == self.fail_after:
+                raise ConnectionError("worker restarted")
+            yield lead
+
+    def get_deleted_since(self, deleted_from):
+        yield from self.deleted
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Отметки SyncWatermark и записанная копия сделок в памяти"""
+
+    watermarks = {}
+    saved, deleted = [], []
+    monkeypatch.setattr(mirror.services, "get_watermark",
+                        lambda session, name: watermarks.get(name, 0))
+    monkeypatch.setattr(mirror.services, "set_watermark",
+                        lambda session, name, value: watermarks.__setitem__(name, value))
+    monkeypatch.setattr(LeadsMirror, "upsert",
+                        lambda self, leads: saved.extend(lead.id for lead in leads) or {})
+    monkeypatch.setattr(LeadsMirror, "delete", lambda self, lead_ids: deleted.extend(lead_ids) or {})
+    monkeypatch.setattr(LeadsMirror, "save_unlinked", lambda self, unlinked: None)
+    monkeypatch.setattr(LeadsMirror, "chunk_size", 2)
+    return watermarks, saved, deleted
+
+
+def test_interrupted_first_sync_resumes_from_cursor(store):
+    watermarks, saved, _ = store
+    updated_at = [100, 200, 300, 400, 500, 600]
+    manager = FakeLeadManager(updated_at, fail_after=4)
+
+    with pytest.raises(ConnectionError):
+        LeadsMirror(FakeSession(), manager).sync()
+
+    assert saved == [6, 5, 4, 3]
+    assert LEADS_WATERMARK not in watermarks
+    assert watermarks[LEADS_CURSOR] == 300
+
+    manager.fail_after = None
+    LeadsMirror(FakeSession(), manager).sync()
+
+    assert manager.calls[-1] == (0, 300)
+    assert saved[4:] == [3, 2, 1]
+    assert watermarks[LEADS_WATERMARK] == 600
+    assert watermarks[LEADS_CURSOR] == 0
+
+    LeadsMirror(FakeSession(), manager).sync()
+    assert manager.calls[-1] == (600, None)
+
+
+def test_sync_removes_leads_deleted_without_a_hook(store):
+    watermarks, _, deleted = store
+    watermarks[LEADS_WATERMARK] = 50
+    watermarks[LEADS_DELETED_WATERMARK] = 10
+
+    LeadsMirror(FakeSession(), FakeLeadManager([100], deleted=[7, 8, 9])).sync()
+
+    assert deleted == [7, 8, 9]
+    assert watermarks[LEADS_DELETED_WATERMARK] > 10
@@ -0,0 +1,77 @@
+import time
+
+import fakeredis
+import pytest
+
+from app.amocrm.rate_limit import PRIORITY_HIGH, PRIORITY_LOW, RedisTokenBucket
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_bucket(server, rate: float, capacity: float, reserve: float = 0) -> RedisTokenBucket:
+    """Bucket отдельного клиента Redis - как у отдельного процесса воркера"""
+
+    return RedisTokenBucket(fakeredis.FakeRedis(server=server), "amocrm:rate:test",
+                            rate, capacity, reserve)
+
+
+def drain(bucket: RedisTokenBucket, priority: str = PRIORITY_HIGH) -> int:
+    """Сколько токенов удается забрать подряд без ожидания"""
+
+    taken = 0
+    while bucket.try_acquire(priority) == 0:
+        taken += 1
+    return taken
+
+
+def test_state_is_kept_in_redis(server):
+    bucket = make_bucket(server, rate=0.001, capacity=3)
+
+    assert bucket.try_acquire() == 0
+    tokens = float(fakeredis.FakeRedis(server=server).hget("amocrm:rate:test", "tokens"))
+    assert tokens == pytest.approx(2, abs=0.01)
+
+
+def test_refills_at_rate_up_to_capacity(server):
+    bucket = make_bucket(server, rate=20, capacity=2)
+
+    assert drain(bucket) == 2
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 1 / 20
+    time.sleep(0.15)
+    # За 0.15 с пришло бы 3 токена, но больше capacity не копится
+    assert drain(bucket) == 2
+
+
+def test_low_priority_leaves_reserve_for_high(server):
+    bucket = make_bucket(server, rate=0.001, capacity=5, reserve=2)
+
+    assert drain(bucket, PRIORITY_LOW) == 3
+    assert bucket.try_acquire(PRIORITY_LOW) > 0
+    assert drain(bucket, PRIORITY_HIGH) == 2
+    assert bucket.try_acquire(PRIORITY_HIGH) > 0
+
+
+def test_clients_share_one_bucket(server):
+    first = make_bucket(server, rate=0.001, capacity=4)
+    second = make_bucket(server, rate=0.001, capacity=4)
+
+    taken = 0
+    for _ in range(4):
+        taken += first.try_acquire() == 0
+        taken += second.try_acquire() == 0
+
+    assert taken == 4
+    assert first.try_acquire() > 0
+    assert second.try_acquire() > 0
+
+
+def test_falls_back_to_local_bucket_without_redis(server):
+    bucket = make_bucket(server, rate=0.001, capacity=2)
+    server.connected = False
+
+    assert drain(bucket) == 2
+    assert bucket.try_acquire() > 0
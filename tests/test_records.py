@@ -0,0 +1,96 @@
+from app.amocrm.identity_map import IdentityMap
+from app.amocrm.managers import CompanyManager, ContactManager
+from app.amocrm.records import EntityRecord, LeadRecord
+
+
+def make_contact(with_leads: bool = True) -> dict:
+    """Контакт в виде ответа amoCRM: с with=leads и привязанной компанией"""
+
+    embedded = {"companies": [{"id": 30}]}
+    if with_leads:
+        embedded["leads"] = [{"id": 10}, {"id": 11}]
+    return {
+        "id": 1,
+        "name": "Контакт",
+        "custom_fields_values": [
+            {"field_id": 100, "values": [{"value": "VIP"}, {"value": "second"}]},
+            {"field_id": 101, "values": [{"value": 5}]},
+            {"field_id": 102, "values": []},
+        ],
+        "_embedded": embedded,
+    }
+
+
+def test_contact_from_data():
+    record = EntityRecord.from_data(make_contact())
+
+    assert record.id == 1
+    assert record.fields == {100: "VIP", 101: 5, 102: None}
+    assert record.lead_ids == (10, 11)
+    assert record.company_ids == (30,)
+
+
+def test_contact_without_leads_requested():
+    record = EntityRecord.from_data(make_contact(with_leads=False))
+
+    assert record.lead_ids is None
+    assert record.company_ids == (30,)
+
+
+def test_minimal_entity():
+    record = EntityRecord.from_data({"id": 1})
+
+    assert record.fields == {}
+    assert record.lead_ids is None
+    assert record.company_ids == ()
+
+
+def test_managers_parse_and_cache_records():
+    identity_map = IdentityMap()
+    contacts = ContactManager(None, None, identity_map)
+    companies = CompanyManager(None, None, identity_map)
+
+    contact = contacts.cache("contacts", 1, make_contact())
+    parsed = list(companies.parse_many([{"id": 30, "_embedded": {"leads": []}}]))
+
+    assert contacts.get_cached("contacts", 1) is contact
+    assert contact.lead_ids == (10, 11)
+    assert parsed[0].id == 30
+    assert parsed[0].lead_ids == ()
+
+
+def make_lead() -> dict:
+    """Сделка с основным контактом, компанией и лишними кастомными полями"""
+
+    return {
+        "id": 10, "price": 500, "status_id": 142, "pipeline_id": 7,
+        "created_at": 1000, "updated_at": 2000,
+        "custom_fields_values": [
+            {"field_id": 1, "values": [{"value": "500"}]},
+            {"field_id": 200, "values": [{"value": 3}]},
+            {"field_id": 201, "values": [{"value": "unused"}]},
+            {"field_id": 202, "values": [{"value": "unused"}]},
+        ],
+        "_embedded": {"contacts": [{"id": 1, "is_main": True}, {"id": 2}],
+                      "companies": [{"id": 30}]},
+    }
+
+
+def test_lead_keeps_only_requested_fields():
+    record = LeadRecord.from_data(make_lead(), (200, 203))
+
+    assert record.paid == "500"
+    assert record.fields == {200: 3}
+    assert record.main_contact_id == 1
+    assert record.contact_ids == (1, 2)
+    assert record.company_ids == (30,)
+
+
+def test_lead_manager_parses_with_its_field_ids():
+    identity_map = IdentityMap()
+    contacts = ContactManager(None, None, identity_map, lead_field_ids=(201,))
+
+    lead = contacts.lead_manager().cache("leads", 10, make_lead())
+
+    assert lead.fields == {201: "unused"}
+    assert identity_map.get("leads", 10) is lead
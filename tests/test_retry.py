@@ -0,0 +1,206 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from app.amocrm import base
+from app.amocrm.base import AmoCRM
+from app.amocrm.exceptions import (BadResponseCustomException, TooManyRequestsCustomException,
+                                   UnexpectedResponseCustomException)
+from app.amocrm.rate_limit import TokenBucket
+from app.app_settings import get_settings
+
+
+class FakeAmoCRMServer(ThreadingHTTPServer):
+    """Локальный сервер, который отвечает по расписанию: [(код, заголовки), ...]"""
+
+    def __init__(self, schedule) -> None:
+        super().__init__(("127.0.0.1", 0), FakeAmoCRMHandler)
+        self.schedule = list(schedule)
+        self.attempts = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeAmoCRMHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        server = self.server
+        status, headers = server.schedule[min(server.attempts, len(server.schedule) - 1)]
+        server.attempts += 1
+        body = json.dumps({"attempt": server.attempts}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.do_GET()
+
+    do_PATCH = do_POST
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class LocalAmoCRM(AmoCRM):
+    """Клиент, который ходит в локальный сервер вместо аккаунта amoCRM"""
+
+    def __init__(self, url: str) -> None:
+        super().__init__("test", "client-id", "secret", access_token="token",
+                         http_session=requests.Session(), rate_limiter=TokenBucket(1000, 1000))
+        self._url = url
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "amocrm_max_retries", 3)
+    monkeypatch.setattr(settings, "amocrm_retry_base_delay", 1)
+    monkeypatch.setattr(settings, "amocrm_retry_max_delay", 8)
+    return settings
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Задержки перед повторами: записываются вместо реального ожидания"""
+
+    delays = []
+    monkeypatch.setattr(base.time, "sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(schedule) -> FakeAmoCRMServer:
+        server = FakeAmoCRMServer(schedule)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_retries_until_success(settings, sleeps, serve):
+    server = serve([(429, {}), (503, {}), (200, {})])
+    amocrm = LocalAmoCRM(server.url)
+
+    assert amocrm.make_request("get", "api/v4/leads") == {"attempt": 3}
+    assert server.attempts == 3
+    assert len(sleeps) == 2
+    stats = amocrm.stats.as_dict()
+    assert stats["requests"] == 3
+    assert stats["retries"] == 2
+    assert stats["retries_by_status"] == {"429": 1, "503": 1}
+
+
+def test_backoff_is_bounded_by_exponent_and_max_delay(settings, sleeps, serve):
+    server = serve([(429, {})] * 3 + [(200, {})])
+    amocrm = LocalAmoCRM(server.url)
+
+    for _ in range(20):
+        server.attempts = 0
+        amocrm.make_request("get", "api/v4/leads")
+
+    assert len(sleeps) == 60
+    for index, delay in enumerate(sleeps):
+        attempt = index % 3
+        assert 0 <= delay <= min(settings.amocrm_retry_max_delay,
+                                 settings.amocrm_retry_base_delay * 2 ** attempt)
+
+
+def test_retry_after_is_respected(settings, sleeps, serve):
+    server = serve([(429, {"Retry-After": "5"}), (200, {})])
+
+    LocalAmoCRM(server.url).make_request("get", "api/v4/leads")
+
+    assert server.attempts == 2
+    assert 5 <= sleeps[0] <= settings.amocrm_retry_max_delay
+
+
+def test_retry_after_is_capped_by_max_delay(settings, sleeps, serve):
+    server = serve([(429, {"Retry-After": "3600"}), (200, {})])
+
+    LocalAmoCRM(server.url).make_request("get", "api/v4/leads")
+
+    assert sleeps == [settings.amocrm_retry_max_delay]
+
+
+def test_retries_stop_at_configured_limit(settings, sleeps, serve):
+    server = serve([(429, {})])
+    amocrm = LocalAmoCRM(server.url)
+
+    with pytest.raises(TooManyRequestsCustomException):
+        amocrm.make_request("get", "api/v4/leads")
+
+    assert server.attempts == settings.amocrm_max_retries + 1
+    assert len(sleeps) == settings.amocrm_max_retries
+    assert amocrm.stats.last_call_retries == settings.amocrm_max_retries
+
+
+def test_client_errors_are_not_retried(settings, sleeps, serve):
+    server = serve([(400, {}), (200, {})])
+
+    with pytest.raises(BadResponseCustomException):
+        LocalAmoCRM(server.url).make_request("get", "api/v4/leads")
+
+    assert server.attempts == 1
+    assert sleeps == []
+
+
+def test_writes_are_not_retried_after_server_error(settings, sleeps, serve):
+    server = serve([(503, {}), (200, {})])
+
+    with pytest.raises(UnexpectedResponseCustomException):
+        LocalAmoCRM(server.url).make_request("patch", "api/v4/leads", "[]")
+
+    assert server.attempts == 1
+    assert sleeps == []
+
+
+def test_writes_are_retried_after_429(settings, sleeps, serve):
+    server = serve([(429, {}), (200, {})])
+
+    assert LocalAmoCRM(server.url).make_request("post", "api/v4/webhooks", {}) == {"attempt": 2}
+    assert len(sleeps) == 1
+
+
+def test_auth_requests_are_not_retried(settings, sleeps, serve):
+    server = serve([(429, {}), (200, {})])
+
+    with pytest.raises(TooManyRequestsCustomException):
+        LocalAmoCRM(server.url).make_request("post", "oauth2/access_token", {}, is_auth=True)
+
+    assert server.attempts == 1
+    assert sleeps == []
+
+
+def test_writes_are_retried_when_connection_is_refused(settings, sleeps, serve):
+    server = serve([(200, {})])
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    amocrm = LocalAmoCRM(url)
+
+    with pytest.raises(requests.ConnectionError):
+        amocrm.make_request("post", "api/v4/webhooks", {})
+
+    assert amocrm.stats.as_dict()["requests"] == settings.amocrm_max_retries + 1
+    assert len(sleeps) == settings.amocrm_max_retries